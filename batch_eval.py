@@ -0,0 +1,312 @@
+"""
+Batch Evaluation
+Replays archived customer messages (JSONL or CSV) through the chatbot in
+parallel chunks, streaming per-message results, a summary and a diff
+against a previous run
+
+Run with: python batch_eval.py messages.jsonl -o results.jsonl --previous old.jsonl
+"""
+
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from collections import Counter, deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from itertools import islice
+from typing import Callable, Deque, Dict, Iterable, Iterator, List, Optional, TextIO, Tuple
+
+from chatbot_engine import CustomerSupportChatbot
+
+# Result fields, in output column order
+RESULT_FIELDS = ["id", "message", "intent", "confidence", "faq_id"]
+
+# Per-process engine of an evaluation worker, set by _load_engine
+_engine: Optional[CustomerSupportChatbot] = None
+
+
+def read_messages(path: str, fmt: Optional[str] = None, text_field: str = "message",
+                  id_field: str = "id", on_skip: Optional[Callable[[int], None]] = None
+                  ) -> Iterator[Tuple[str, str]]:
+    """
+    Lazily yield (id, message) pairs from a JSONL or CSV file
+
+    JSONL lines may be objects (text in text_field, id in id_field) or plain
+    JSON strings. Records without an id are numbered by their line. Lines
+    that are not valid JSON are skipped, and on_skip is called with their
+    line number.
+    """
+    fmt = fmt or ("csv" if path.lower().endswith(".csv") else "jsonl")
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        if fmt == "csv":
+            for number, row in enumerate(csv.DictReader(f), 1):
+                yield str(row.get(id_field) or number), row.get(text_field) or ""
+            return
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                if on_skip:
+                    on_skip(number)
+                continue
+            if isinstance(record, dict):
+                yield str(record.get(id_field, number)), str(record.get(text_field) or "")
+            else:
+                yield str(number), str(record)
+
+
+def _load_engine(faq_file: str):
+    """Build this worker's engine (process pool initializer)"""
+    global _engine
+    _engine = CustomerSupportChatbot(faq_file)
+
+
+def _evaluate_chunk(chunk: List[Tuple[str, str]]) -> List[Dict]:
+    """Results for one chunk of (id, message) pairs"""
+    responses = _engine.process_messages([text for _, text in chunk], user_id="batch-eval",
+                                         record_history=False)
+    return [
+        {"id": record_id, "message": text, "intent": response["intent"],
+         "confidence": round(response["confidence"], 6), "faq_id": response["faq_id"]}
+        for (record_id, text), response in zip(chunk, responses)
+    ]
+
+
+def _chunks(messages: Iterable[Tuple[str, str]], size: int) -> Iterator[List[Tuple[str, str]]]:
+    iterator = iter(messages)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def evaluate(messages: Iterable[Tuple[str, str]], faq_file: str = "faq_data.json",
+             workers: int = 1, chunk_size: int = 1000) -> Iterator[Dict]:
+    """
+    Yield one result per message, in input order
+
+    Chunks are scored on a pool of worker processes, each with its own
+    engine. At most two chunks per worker are read ahead, so memory stays
+    bounded however long the input is.
+    """
+    if workers <= 1:
+        _load_engine(faq_file)
+        for chunk in _chunks(messages, chunk_size):
+            yield from _evaluate_chunk(chunk)
+        return
+
+    with ProcessPoolExecutor(workers, initializer=_load_engine, initargs=(faq_file,)) as pool:
+        pending: Deque[Future] = deque()
+        for chunk in _chunks(messages, chunk_size):
+            pending.append(pool.submit(_evaluate_chunk, chunk))
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+class _ResultWriter:
+    """Writes results as JSONL or CSV, flushing after every chunk's worth"""
+
+    def __init__(self, f: TextIO, fmt: str):
+        self._f = f
+        self._csv = csv.DictWriter(f, RESULT_FIELDS) if fmt == "csv" else None
+        if self._csv:
+            self._csv.writeheader()
+
+    def write(self, result: Dict):
+        if self._csv:
+            self._csv.writerow(result)
+        else:
+            self._f.write(json.dumps(result, ensure_ascii=False) + "\n")
+
+
+def _read_results(path: str) -> Iterator[Dict]:
+    """Lazily read a previous run's results file (JSONL or CSV)"""
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        if path.lower().endswith(".csv"):
+            for row in csv.DictReader(f):
+                row["confidence"] = float(row["confidence"] or 0.0)
+                yield row
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def _as_text(value) -> str:
+    """A result field as CSV results hold it: text, empty for None"""
+    return "" if value is None else str(value)
+
+
+class RunDiff:
+    """Streaming comparison of a run against a previous run of the same input
+
+    Results are paired by position; a pair whose ids differ is counted as
+    unaligned instead of compared.
+    """
+
+    def __init__(self, previous: Iterator[Dict], tolerance: float = 1e-6):
+        self._previous = previous
+        self.tolerance = tolerance
+        self.compared = 0
+        self.unaligned = 0
+        self.intent_changed = 0
+        self.faq_changed = 0
+        self.confidence_up = 0
+        self.confidence_down = 0
+        self.transitions: Counter = Counter()
+
+    def compare(self, result: Dict) -> Optional[Dict]:
+        """Compare one result with its previous counterpart; returns a diff row if it changed"""
+        before = next(self._previous, None)
+        if before is None or str(before.get("id")) != str(result["id"]):
+            self.unaligned += 1
+            return None
+        self.compared += 1
+        intent_changed = _as_text(before.get("intent")) != _as_text(result["intent"])
+        faq_changed = _as_text(before.get("faq_id")) != _as_text(result["faq_id"])
+        delta = result["confidence"] - float(before.get("confidence") or 0.0)
+        if intent_changed:
+            self.intent_changed += 1
+            self.transitions[f"{before.get('intent')} -> {result['intent']}"] += 1
+        if faq_changed:
+            self.faq_changed += 1
+        if delta > self.tolerance:
+            self.confidence_up += 1
+        elif delta < -self.tolerance:
+            self.confidence_down += 1
+        if not (intent_changed or faq_changed or abs(delta) > self.tolerance):
+            return None
+        return {
+            "id": result["id"], "message": result["message"],
+            "intent_before": before.get("intent"), "intent_after": result["intent"],
+            "faq_id_before": before.get("faq_id"), "faq_id_after": result["faq_id"],
+            "confidence_before": before.get("confidence"), "confidence_after": result["confidence"],
+        }
+
+    def finish(self):
+        """Count previous results left over once the current run ends"""
+        self.unaligned += sum(1 for _ in self._previous)
+
+    def summary(self, top: int = 20) -> Dict:
+        return {
+            "compared": self.compared,
+            "unaligned": self.unaligned,
+            "intent_changed": self.intent_changed,
+            "faq_changed": self.faq_changed,
+            "confidence_up": self.confidence_up,
+            "confidence_down": self.confidence_down,
+            "top_transitions": dict(self.transitions.most_common(top)),
+        }
+
+
+def run_evaluation(input_path: str, output_path: str, faq_file: str = "faq_data.json",
+                   workers: int = 1, chunk_size: int = 1000, input_format: Optional[str] = None,
+                   text_field: str = "message", id_field: str = "id", previous: Optional[str] = None,
+                   diff_path: Optional[str] = None) -> Dict:
+    """
+    Evaluate every message of input_path and stream the results to output_path
+
+    Returns:
+        The summary: message count, skipped malformed lines, counts per
+        intent, fallback rate, mean confidence, throughput and, with
+        previous, the diff counts. It is
+        also written next to the output as <output>.summary.json.
+    """
+    started = time.perf_counter()
+    output_format = "csv" if output_path.lower().endswith(".csv") else "jsonl"
+    intents: Counter = Counter()
+    confidence_total = 0.0
+    count = 0
+    skipped = 0
+
+    def skip(number: int):
+        nonlocal skipped
+        skipped += 1
+
+    diff = RunDiff(_read_results(previous)) if previous else None
+    diff_file = open(diff_path, "w", encoding="utf-8") if diff and diff_path else None
+    try:
+        with open(output_path, "w", encoding="utf-8", newline="") as out:
+            writer = _ResultWriter(out, output_format)
+            messages = read_messages(input_path, input_format, text_field, id_field, skip)
+            for result in evaluate(messages, faq_file, workers, chunk_size):
+                writer.write(result)
+                count += 1
+                intents[result["intent"] or "none"] += 1
+                confidence_total += result["confidence"]
+                if diff:
+                    row = diff.compare(result)
+                    if row and diff_file:
+                        diff_file.write(json.dumps(row, ensure_ascii=False) + "\n")
+                if count % chunk_size == 0:
+                    out.flush()
+        if diff:
+            diff.finish()
+    finally:
+        if diff_file:
+            diff_file.close()
+
+    elapsed = time.perf_counter() - started
+    summary = {
+        "input": input_path,
+        "faq_file": faq_file,
+        "messages": count,
+        "skipped_lines": skipped,
+        "intents": dict(intents.most_common()),
+        "fallback_rate": intents["fallback"] / count if count else 0.0,
+        "mean_confidence": confidence_total / count if count else 0.0,
+        "elapsed_s": elapsed,
+        "messages_per_s": count / elapsed if elapsed else 0.0,
+    }
+    if diff:
+        summary["diff"] = diff.summary()
+        summary["diff"]["previous"] = previous
+    with open(output_path + ".summary.json", "w", encoding="utf-8") as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Evaluate a message log against the FAQ catalog"""
+    parser = argparse.ArgumentParser(description="Replay archived messages through the chatbot")
+    parser.add_argument("input", help="messages as JSONL or CSV")
+    parser.add_argument("--output", "-o", required=True, help="results file (.jsonl or .csv)")
+    parser.add_argument("--faq-file", default="faq_data.json", help="FAQ JSON file")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="worker processes")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="messages per work unit")
+    parser.add_argument("--format", choices=["jsonl", "csv"], help="input format (default: by extension)")
+    parser.add_argument("--text-field", default="message", help="field or column holding the message")
+    parser.add_argument("--id-field", default="id", help="field or column holding the message id")
+    parser.add_argument("--previous", help="results of an earlier run over the same input to diff against")
+    parser.add_argument("--diff", help="write the changed results here (JSONL; needs --previous)")
+    args = parser.parse_args(argv)
+
+    summary = run_evaluation(args.input, args.output, args.faq_file, args.workers, args.chunk_size,
+                             args.format, args.text_field, args.id_field, args.previous, args.diff)
+    print(f"Evaluated {summary['messages']} messages in {summary['elapsed_s']:.1f}s "
+          f"({summary['messages_per_s']:.0f}/s)")
+    if summary["skipped_lines"]:
+        print(f"Skipped {summary['skipped_lines']} malformed input lines")
+    print(f"Fallback rate {summary['fallback_rate']:.1%}, mean confidence {summary['mean_confidence']:.3f}")
+    for intent, count in list(summary["intents"].items())[:10]:
+        print(f"  {intent}: {count}")
+    if "diff" in summary:
+        diff = summary["diff"]
+        print(f"Against {args.previous}: {diff['intent_changed']} intent and {diff['faq_changed']} FAQ "
+              f"changes in {diff['compared']} messages ({diff['unaligned']} unaligned); confidence "
+              f"up {diff['confidence_up']}, down {diff['confidence_down']}")
+        for transition, count in list(diff["top_transitions"].items())[:10]:
+            print(f"  {transition}: {count}")
+    print(f"Summary written to {args.output}.summary.json")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,350 @@
+"""
+Benchmark Harness
+Generates synthetic FAQ catalogs and query traffic, measures the chatbot's
+startup time, latency, throughput and memory, and compares runs
+
+Run with: python benchmark.py --sizes 10 1000 10000 100000 -o results.json
+"""
+
+import argparse
+import gc
+import json
+import math
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from typing import Dict, List, Optional, Sequence
+
+from catalog_snapshot import write_snapshot
+from chatbot_engine import CustomerSupportChatbot
+
+# Share of each kind of query in the generated traffic
+DEFAULT_MIX = {
+    "exact": 0.3,       # an FAQ question, with random casing and punctuation
+    "paraphrase": 0.3,  # an FAQ question with words dropped, swapped or added
+    "intent": 0.15,     # an intent pattern inside a longer sentence
+    "greeting": 0.1,
+    "goodbye": 0.05,
+    "noise": 0.1,       # words that match nothing
+}
+
+_TOPICS = [
+    "order", "package", "refund", "return", "shipping", "delivery", "payment",
+    "card", "account", "password", "subscription", "invoice", "warranty",
+    "discount", "coupon", "gift", "exchange", "size", "stock", "address",
+]
+_OBJECTS = [
+    "item", "product", "purchase", "parcel", "plan", "membership", "voucher",
+    "receipt", "label", "tracking number", "bank transfer", "credit", "bundle",
+]
+_TEMPLATES = [
+    "how do i {verb} my {topic}",
+    "can i {verb} my {topic} {object}",
+    "what is your {topic} policy",
+    "where is my {topic} {object}",
+    "how long does {topic} take for a {object}",
+    "do you offer {topic} on {object} orders",
+    "why was my {topic} {object} declined",
+    "is it possible to {verb} the {topic} after checkout",
+    "what happens if my {object} {topic} is late",
+    "who do i contact about {topic} for my {object}",
+]
+_VERBS = ["track", "cancel", "change", "update", "check", "renew", "request", "apply", "use", "reset"]
+_INTENT_NAMES = ["status", "problem", "question", "request", "help"]
+_FILLERS = ["please", "quickly", "again", "today", "now", "actually", "just"]
+_SYNONYMS = {
+    "order": "purchase", "package": "parcel", "refund": "money back", "how": "in what way",
+    "cancel": "stop", "check": "see", "change": "modify", "where": "whereabouts",
+}
+_GREETINGS = ["hi", "hello", "hey there", "good morning", "hello, anyone there?", "hey"]
+_GOODBYES = ["thanks, bye", "thank you", "goodbye!", "ok done", "see you"]
+
+
+def _word(rng: random.Random, length: int) -> str:
+    return "".join(rng.choice("bcdfghjklmnpqrstvwxz") for _ in range(length))
+
+
+def generate_catalog(n_faqs: int, n_intents: Optional[int] = None, seed: int = 0) -> Dict:
+    """
+    Synthetic catalog in the faq_data.json layout
+
+    Questions are built from support-style templates over a vocabulary that
+    grows with the catalog, so posting lists stay realistic at large sizes.
+    Intents default to one per 20 FAQs (at least 5), with 3 to 6 patterns each.
+    """
+    rng = random.Random(seed)
+    n_intents = max(5, n_faqs // 20) if n_intents is None else n_intents
+    # Extra synthetic topic words keep big catalogs from collapsing onto a few questions
+    topics = _TOPICS + [_word(rng, rng.randint(4, 9)) for _ in range(max(0, n_faqs // 10))]
+
+    def fill(template: str) -> str:
+        return template.format(verb=rng.choice(_VERBS), topic=rng.choice(topics), object=rng.choice(_OBJECTS))
+
+    faqs = []
+    for idx in range(n_faqs):
+        question = fill(rng.choice(_TEMPLATES))
+        if rng.random() < 0.7:
+            question = question[0].upper() + question[1:] + "?"
+        faqs.append({"question": question, "answer": f"Answer {idx}: {question}"})
+
+    intents = []
+    for idx in range(n_intents):
+        topic = rng.choice(topics)
+        patterns = [f"{topic} {rng.choice(_INTENT_NAMES)}"]
+        for _ in range(rng.randint(2, 5)):
+            patterns.append(f"{rng.choice(_VERBS)} {topic}" if rng.random() < 0.5
+                            else f"my {topic} {rng.choice(_OBJECTS)}")
+        intents.append({
+            "name": f"{topic}_{idx}",
+            "patterns": patterns,
+            "response": f"Intent {idx} about {topic}. Your order ID is {{order_id}}",
+        })
+    return {"intents": intents, "faqs": faqs}
+
+
+def generate_queries(catalog: Dict, count: int, seed: int = 0,
+                     mix: Optional[Dict[str, float]] = None) -> List[str]:
+    """Realistic query traffic against a catalog, drawn according to mix"""
+    rng = random.Random(seed)
+    mix = mix or DEFAULT_MIX
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    questions = [faq["question"] for faq in catalog.get("faqs", []) if faq.get("question")]
+    patterns = [p for intent in catalog.get("intents", []) for p in intent.get("patterns", []) if p]
+
+    queries = []
+    for kind in rng.choices(kinds, weights, k=count):
+        if kind == "exact" and questions:
+            query = rng.choice(questions)
+            query = query.lower() if rng.random() < 0.5 else query.rstrip("?") + rng.choice(["", "?", "??", "!"])
+        elif kind == "paraphrase" and questions:
+            words = rng.choice(questions).rstrip("?").lower().split()
+            if len(words) > 3 and rng.random() < 0.5:
+                del words[rng.randrange(len(words))]
+            words = [_SYNONYMS.get(word, word) if rng.random() < 0.3 else word for word in words]
+            if rng.random() < 0.5:
+                words.insert(rng.randint(0, len(words)), rng.choice(_FILLERS))
+            query = " ".join(words)
+        elif kind == "intent" and patterns:
+            query = f"{rng.choice(['i need help with', 'question about', 'about'])} {rng.choice(patterns)}"
+        elif kind == "greeting":
+            query = rng.choice(_GREETINGS)
+        elif kind == "goodbye":
+            query = rng.choice(_GOODBYES)
+        else:
+            query = " ".join(_word(rng, rng.randint(3, 8)) for _ in range(rng.randint(1, 6)))
+        queries.append(query)
+    return queries
+
+
+def percentile(sorted_values: Sequence[float], fraction: float) -> float:
+    """Nearest-rank percentile of an ascending sequence"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(fraction * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def _timed_startup(faq_file: str, use_snapshot: bool, repeat: int = 3) -> float:
+    """Best-of-repeat seconds to construct a chatbot over faq_file"""
+    best = float("inf")
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        CustomerSupportChatbot(faq_file, use_snapshot=use_snapshot)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def benchmark_catalog(faq_file: str, queries: Sequence[str], warmup: int = 100,
+                      engine_options: Optional[Dict] = None) -> Dict:
+    """
+    Measure one catalog file under the given query traffic
+
+    Returns:
+        Dict with startup seconds (from JSON and from a snapshot), latency
+        percentiles in milliseconds, throughput in messages per second and
+        peak traced memory in MB for loading the catalog and serving the queries
+    """
+    engine_options = engine_options or {}
+    with open(faq_file, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    results = {
+        "faqs": len(data.get("faqs", [])),
+        "intents": len(data.get("intents", [])),
+        "queries": len(queries),
+        "startup_json_s": _timed_startup(faq_file, use_snapshot=False),
+    }
+    snapshot = write_snapshot(faq_file)
+    try:
+        results["startup_snapshot_s"] = _timed_startup(faq_file, use_snapshot=True)
+    finally:
+        os.remove(snapshot)
+
+    chatbot = CustomerSupportChatbot(faq_file, use_snapshot=False, **engine_options)
+    for query in queries[:warmup]:
+        chatbot.process_message(query, "bench")
+    latencies = []
+    gc.collect()
+    started = time.perf_counter()
+    for query in queries:
+        start = time.perf_counter()
+        chatbot.process_message(query, "bench")
+        latencies.append(time.perf_counter() - start)
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    results["latency_ms"] = {
+        "p50": percentile(latencies, 0.50) * 1000,
+        "p95": percentile(latencies, 0.95) * 1000,
+        "p99": percentile(latencies, 0.99) * 1000,
+        "mean": sum(latencies) / len(latencies) * 1000 if latencies else 0.0,
+        "max": latencies[-1] * 1000 if latencies else 0.0,
+    }
+    results["throughput_per_s"] = len(queries) / elapsed if elapsed else 0.0
+    del chatbot
+
+    # Traced separately: tracemalloc slows every allocation down
+    gc.collect()
+    tracemalloc.start()
+    try:
+        chatbot = CustomerSupportChatbot(faq_file, use_snapshot=False, **engine_options)
+        for query in queries:
+            chatbot.process_message(query, "bench")
+        results["peak_memory_mb"] = tracemalloc.get_traced_memory()[1] / (1 << 20)
+    finally:
+        tracemalloc.stop()
+    return results
+
+
+def run_benchmarks(sizes: Sequence[int], n_queries: int = 2000, seed: int = 0,
+                   engine_options: Optional[Dict] = None) -> Dict:
+    """Benchmark a synthetic catalog of each size; returns a JSON-ready report"""
+    runs = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            catalog = generate_catalog(size, seed=seed)
+            faq_file = os.path.join(tmp, f"faq_{size}.json")
+            with open(faq_file, "w", encoding="utf-8") as f:
+                json.dump(catalog, f)
+            queries = generate_queries(catalog, n_queries, seed=seed)
+            random.seed(seed)  # greeting and fallback replies are random
+            runs.append(benchmark_catalog(faq_file, queries, engine_options=engine_options))
+    return {
+        "meta": {
+            "timestamp": datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "seed": seed,
+            "engine_options": engine_options or {},
+        },
+        "runs": runs,
+    }
+
+
+# Metrics compared between runs; True where higher is better
+COMPARED_METRICS = {
+    "startup_json_s": False,
+    "startup_snapshot_s": False,
+    "latency_ms.p50": False,
+    "latency_ms.p95": False,
+    "latency_ms.p99": False,
+    "throughput_per_s": True,
+    "peak_memory_mb": False,
+}
+
+
+def _metric(run: Dict, name: str) -> Optional[float]:
+    value = run
+    for part in name.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return None
+        value = value[part]
+    return value
+
+
+def compare_reports(baseline: Dict, current: Dict, tolerance: float = 0.1) -> List[Dict]:
+    """
+    Per-size metric changes between two reports
+
+    Returns:
+        One row per catalog size and metric present in both, with the relative
+        change and whether it is a regression beyond the tolerance
+    """
+    previous = {run["faqs"]: run for run in baseline.get("runs", [])}
+    rows = []
+    for run in current.get("runs", []):
+        before = previous.get(run["faqs"])
+        if before is None:
+            continue
+        for name, higher_is_better in COMPARED_METRICS.items():
+            old, new = _metric(before, name), _metric(run, name)
+            if old is None or new is None or not old:
+                continue
+            change = (new - old) / old
+            worse = -change if higher_is_better else change
+            rows.append({"faqs": run["faqs"], "metric": name, "before": old, "after": new,
+                         "change": change, "regression": worse > tolerance})
+    return rows
+
+
+def _print_report(report: Dict):
+    print(f"{'faqs':>8} {'start json':>11} {'start snap':>11} {'p50 ms':>8} {'p95 ms':>8} "
+          f"{'p99 ms':>8} {'msg/s':>9} {'peak MB':>8}")
+    for run in report["runs"]:
+        latency = run["latency_ms"]
+        print(f"{run['faqs']:>8} {run['startup_json_s']:>11.4f} {run['startup_snapshot_s']:>11.4f} "
+              f"{latency['p50']:>8.3f} {latency['p95']:>8.3f} {latency['p99']:>8.3f} "
+              f"{run['throughput_per_s']:>9.0f} {run['peak_memory_mb']:>8.1f}")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Run the benchmarks, or write a synthetic catalog with --write-catalog"""
+    parser = argparse.ArgumentParser(description="Benchmark the chatbot on synthetic catalogs and traffic")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 1000, 10000],
+                        help="FAQ counts of the synthetic catalogs (up to 100000)")
+    parser.add_argument("--queries", type=int, default=2000, help="queries per catalog")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--shards", type=int, default=0, help="benchmark sharded matching with N workers")
+    parser.add_argument("--output", "-o", help="write the JSON report here")
+    parser.add_argument("--compare", help="previous JSON report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="relative change reported as a regression (default 0.1)")
+    parser.add_argument("--write-catalog", metavar="PATH",
+                        help="only write a synthetic catalog of the first size to PATH")
+    args = parser.parse_args(argv)
+
+    if args.write_catalog:
+        with open(args.write_catalog, "w", encoding="utf-8") as f:
+            json.dump(generate_catalog(args.sizes[0], seed=args.seed), f, indent=2)
+        print(f"Wrote {args.write_catalog} with {args.sizes[0]} FAQs")
+        return 0
+
+    engine_options = {"shards": args.shards} if args.shards else None
+    report = run_benchmarks(args.sizes, args.queries, args.seed, engine_options)
+    _print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nSaved results to {args.output}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        rows = compare_reports(baseline, report, args.tolerance)
+        print(f"\nCompared with {args.compare}:")
+        for row in rows:
+            flag = "  REGRESSION" if row["regression"] else ""
+            print(f"{row['faqs']:>8} {row['metric']:<20} {row['before']:>10.4f} -> "
+                  f"{row['after']:>10.4f} ({row['change']:+.1%}){flag}")
+        if any(row["regression"] for row in rows):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
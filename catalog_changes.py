@@ -0,0 +1,490 @@
+"""
+Incremental Catalog Changes
+Adds, edits and removes FAQs and intent patterns without recompiling the
+whole catalog, and keeps an append-only log of the changes next to the FAQ
+file until they are compacted into it
+
+A change is a dict, also the change log's line format:
+    {"op": "add_faq", "faq": {"question": "...", "answer": "..."}}
+    {"op": "update_faq", "faq_id": 3, "faq": {"answer": "..."}}
+    {"op": "remove_faq", "faq_id": 3}
+    {"op": "add_intent_pattern", "intent": "refund", "pattern": "...", "response": "..."}
+    {"op": "update_intent_pattern", "intent": "refund", "pattern": "...", "new_pattern": "..."}
+    {"op": "remove_intent_pattern", "intent": "refund", "pattern": "..."}
+"""
+
+import json
+import logging
+import os
+from bisect import bisect_left, bisect_right, insort
+from typing import Dict, FrozenSet, List, Optional, Sequence, Set, Tuple
+
+from faq_catalog import CompiledCatalog, FAQEntry, IntentEntry, next_catalog_version
+
+logger = logging.getLogger(__name__)
+
+_UNCHANGED = object()
+
+
+class _Layered:
+    """Entries of a base catalog with some slots replaced, removed (None) or appended"""
+
+    def __init__(self, base, changes: Dict[int, Optional[object]], size: int):
+        self._base = base
+        self._changes = changes
+        self._size = size
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __getitem__(self, slot: int):
+        entry = self._changes.get(slot, _UNCHANGED)
+        return self._base[slot] if entry is _UNCHANGED else entry
+
+    def live(self) -> List:
+        """Entries that were not removed, in catalog order"""
+        return [entry for entry in map(self.__getitem__, range(self._size)) if entry is not None]
+
+
+def _without(shared: Dict[int, int], masked) -> Dict[int, int]:
+    """Candidates without the masked entries"""
+    for idx in masked:
+        shared.pop(idx, None)
+    return shared
+
+
+class PatchedCatalog(CompiledCatalog):
+    """CompiledCatalog with a few changed entries layered over it
+
+    Entries keep their slot in the base catalog; added ones take new slots at
+    the end and removed ones leave a hole, so slot order is catalog order.
+    Each change compiles only the changed entry and appends it to a small
+    delta catalog; the slot it replaces is masked out of the base indexes,
+    and an earlier version of it in the delta is marked dead. Delta entries
+    are in change order, so their hits are ranked by slot before being
+    merged with the base's, ties going to the earlier slot as in a fully
+    compiled catalog. An intent is always changed as a whole, so each intent
+    lives in exactly one layer.
+
+    The base may be a compiled or a snapshot catalog; it is only read. Like
+    the base, a patched catalog is immutable: with_faq and with_intent
+    return a new one, in time that does not grow with the size of the base.
+    """
+
+    def __init__(self, base: CompiledCatalog):
+        """
+        Args:
+            base: Compiled or snapshot catalog the changes apply to
+        """
+        # The base constructor compiles from JSON; only the changes are compiled here
+        self.version = next_catalog_version()
+        self._batch_scorer = None
+        self.derived = {}
+        self.base = base
+        self.keywords = base.keywords
+        # Slot -> new entry, or None for a removed FAQ
+        self.faq_changes: Dict[int, Optional[FAQEntry]] = {}
+        self.intent_changes: Dict[int, IntentEntry] = {}
+        self.faqs = _Layered(base.faqs, self.faq_changes, len(base.faqs))
+        self.intents = _Layered(base.intents, self.intent_changes, len(base.intents))
+        # Base slots and patterns replaced by a change
+        self.masked_faqs: List[int] = []
+        self.masked_patterns: List[int] = []
+        self._removed_faqs: List[int] = []  # sorted
+        self.delta = CompiledCatalog({"faqs": [], "intents": []})
+        # Delta entry -> slot, and slot -> its current delta entry
+        self._delta_faq_slots: List[int] = []
+        self._delta_faq_local: Dict[int, int] = {}
+        self._delta_intent_slots: List[int] = []
+        self._delta_intent_local: Dict[int, int] = {}
+        # Delta FAQs and patterns of entries changed again since
+        self._dead_faqs: FrozenSet[int] = frozenset()
+        self._dead_patterns: FrozenSet[int] = frozenset()
+        # Delta patterns are numbered after the base ones
+        self._pattern_offset = len(base.pattern_intent)
+
+    def _copy(self) -> "PatchedCatalog":
+        """A new catalog sharing this one's state, for a change method to replace parts of"""
+        patched = PatchedCatalog.__new__(PatchedCatalog)
+        patched.__dict__.update(self.__dict__)
+        patched.version = next_catalog_version()
+        patched._batch_scorer = None
+        patched.derived = {}
+        return patched
+
+    def with_faq(self, slot: int, faq: Optional[FAQEntry]) -> "PatchedCatalog":
+        """This catalog with the FAQ in slot replaced, or removed (None); slot len(faqs) adds one"""
+        patched = self._copy()
+        patched.faq_changes = {**self.faq_changes, slot: faq}
+        patched.faqs = _Layered(self.base.faqs, patched.faq_changes, max(len(self.faqs), slot + 1))
+        if slot < len(self.base.faqs) and slot not in self.faq_changes:
+            patched.masked_faqs = self.masked_faqs + [slot]
+        local = dict(self._delta_faq_local)
+        previous = local.pop(slot, None)
+        if previous is not None:
+            patched._dead_faqs = self._dead_faqs | {previous}
+        if faq is None:
+            patched._removed_faqs = list(self._removed_faqs)
+            insort(patched._removed_faqs, slot)
+        else:
+            local[slot] = len(self._delta_faq_slots)
+            patched._delta_faq_slots = self._delta_faq_slots + [slot]
+            patched.delta = self.delta.extended(faqs=[faq])
+        patched._delta_faq_local = local
+        return patched
+
+    def with_intent(self, slot: int, intent: IntentEntry) -> "PatchedCatalog":
+        """This catalog with the intent in slot replaced; slot len(intents) adds one"""
+        patched = self._copy()
+        patched.intent_changes = {**self.intent_changes, slot: intent}
+        patched.intents = _Layered(self.base.intents, patched.intent_changes, max(len(self.intents), slot + 1))
+        if slot < len(self.base.intents) and slot not in self.intent_changes:
+            # Base patterns are grouped by intent, so an intent's patterns are one range
+            pattern_intent = self.base.pattern_intent
+            patched.masked_patterns = self.masked_patterns + list(
+                range(bisect_left(pattern_intent, slot), bisect_right(pattern_intent, slot)))
+        local = dict(self._delta_intent_local)
+        previous = local.pop(slot, None)
+        if previous is not None:
+            pattern_intent = self.delta.pattern_intent
+            patched._dead_patterns = self._dead_patterns | set(
+                range(bisect_left(pattern_intent, previous), bisect_right(pattern_intent, previous)))
+        local[slot] = len(self._delta_intent_slots)
+        patched._delta_intent_local = local
+        patched._delta_intent_slots = self._delta_intent_slots + [slot]
+        patched.delta = self.delta.extended(intents=[intent])
+        return patched
+
+    @property
+    def data(self) -> Dict:
+        """The FAQ data in the faq_data.json layout, with the changes applied"""
+        return {
+            **self.base._settings,
+            "intents": [intent.to_dict() for intent in self.intents.live()],
+            "faqs": [faq.to_dict() for faq in self.faqs.live()],
+        }
+
+    def batch_scorer(self) -> "PatchedBatchScorer":
+        """Batch scoring of the base merged with the delta's hits (requires numpy)"""
+        if self._batch_scorer is None:
+            self._batch_scorer = PatchedBatchScorer(self)
+        return self._batch_scorer
+
+    def indexed_words(self) -> Set[str]:
+        """Words of the question and pattern indexes of both layers"""
+        return self.base.indexed_words() | self.delta.indexed_words()
+
+    def faq_id(self, idx: int):
+        """Id reported for an FAQ: its "id" field, or its position once removed FAQs are skipped"""
+        return self.faqs[idx].get("id", idx - bisect_left(self._removed_faqs, idx))
+
+    def faq_slot(self, faq_id) -> int:
+        """Slot of the FAQ with this id, or at this position; raises KeyError if there is none"""
+        found = self.base.faq_ids.get(faq_id)
+        if found in self.faq_changes:
+            found = None  # edited or removed since
+        for slot in self._delta_faq_local:
+            if self.faq_changes[slot].get("id", _UNCHANGED) == faq_id and (found is None or slot < found):
+                found = slot
+        if found is not None:
+            return found
+        if isinstance(faq_id, int) and not isinstance(faq_id, bool) and faq_id >= 0:
+            slot = faq_id
+            for removed in self._removed_faqs:
+                if removed > slot:
+                    break
+                slot += 1
+            if slot < len(self.faqs):
+                return slot
+        raise KeyError(f"Unknown FAQ: {faq_id!r}")
+
+    def intent_slot(self, name: str) -> int:
+        """Slot of the first intent with this name, or -1"""
+        found = self.base.intent_slots.get(name, -1)
+        for slot in self._delta_intent_local:
+            if self.intent_changes[slot].get("name") == name and (found < 0 or slot < found):
+                found = slot
+        return found
+
+    def _split_faqs(self, normalized_input: str, input_words: FrozenSet, shared: Optional[Dict[int, int]]
+                    ) -> Tuple[FrozenSet, Dict[int, int], Dict[int, int]]:
+        """Input words as the base keys them, and the FAQ candidates of the base (by slot) and of the delta"""
+        base_words = self.base.encode_words(input_words)
+        if shared is None:
+            return (base_words,
+                    _without(self.base.faq_overlaps(normalized_input, base_words), self.masked_faqs),
+                    _without(self.delta.faq_overlaps(normalized_input, input_words), self._dead_faqs))
+        base_shared, delta_shared = {}, {}
+        local = self._delta_faq_local
+        for slot, common in shared.items():
+            idx = local.get(slot)
+            if idx is None:
+                base_shared[slot] = common
+            else:
+                delta_shared[idx] = common
+        return base_words, base_shared, delta_shared
+
+    def _delta_faqs(self, normalized_input: str, input_words: FrozenSet, threshold: float,
+                    delta_shared: Optional[Dict[int, int]] = None) -> List[Tuple[int, float, float]]:
+        """Every delta FAQ hit, by slot, best first"""
+        if delta_shared is None:
+            delta_shared = _without(self.delta.faq_overlaps(normalized_input, input_words), self._dead_faqs)
+        if not delta_shared:
+            return []
+        slots = self._delta_faq_slots
+        hits = [(slots[idx], score, similarity) for idx, score, similarity
+                in self.delta.top_faqs(normalized_input, input_words, len(delta_shared), threshold, delta_shared)]
+        hits.sort(key=lambda hit: (-hit[1], hit[0]))
+        return hits
+
+    def faq_overlaps(self, normalized_input: str, input_words: FrozenSet) -> Dict[int, int]:
+        """Shared word counts for every FAQ slot that may score above zero"""
+        _, shared, delta_shared = self._split_faqs(normalized_input, input_words, None)
+        slots = self._delta_faq_slots
+        for idx, common in delta_shared.items():
+            shared[slots[idx]] = common
+        return shared
+
+    def top_faqs(self, normalized_input: str, input_words: FrozenSet, k: int, threshold: float = 0.0,
+                 shared: Optional[Dict[int, int]] = None) -> List[Tuple[int, float, float]]:
+        """The k best FAQs of both layers, by slot"""
+        base_words, base_shared, delta_shared = self._split_faqs(normalized_input, input_words, shared)
+        ranked = self.base.top_faqs(normalized_input, base_words, k, threshold, base_shared)
+        ranked += self._delta_faqs(normalized_input, input_words, threshold, delta_shared)
+        ranked.sort(key=lambda hit: (-hit[1], hit[0]))
+        return ranked[:k]
+
+    def merge_faq_hits(self, hits: Sequence[Tuple[int, float, float]], normalized_inputs: Sequence[str],
+                       word_sets: Sequence[FrozenSet], threshold: float) -> List[Tuple[int, float, float]]:
+        """
+        Best FAQ of both layers for each input, given the base's best with the
+        masked FAQs left out (as from BatchScorer.match_faqs)
+        """
+        merged = []
+        for best, text, words in zip(hits, normalized_inputs, word_sets):
+            delta = self._delta_faqs(text, words, threshold)
+            # Ties go to the earlier slot
+            if delta and (best[0] < 0 or (delta[0][1], -delta[0][0]) > (best[1], -best[0])):
+                best = delta[0]
+            merged.append(best)
+        return merged
+
+    def _split_patterns(self, input_words: FrozenSet, shared: Optional[Dict[int, int]]
+                        ) -> Tuple[FrozenSet, Dict[int, int], Dict[int, int]]:
+        """Input words as the base keys them, and the pattern candidates of the base and of the delta"""
+        base_words = self.base.encode_words(input_words)
+        if shared is None:
+            return (base_words,
+                    _without(self.base.pattern_overlaps(base_words), self.masked_patterns),
+                    _without(self.delta.pattern_overlaps(input_words), self._dead_patterns))
+        offset = self._pattern_offset
+        base_shared, delta_shared = {}, {}
+        for idx, common in shared.items():
+            if idx < offset:
+                base_shared[idx] = common
+            else:
+                delta_shared[idx - offset] = common
+        return base_words, base_shared, delta_shared
+
+    def pattern_overlaps(self, input_words: FrozenSet) -> Dict[int, int]:
+        """Shared word counts for every pattern sharing a word with the input"""
+        _, shared, delta_shared = self._split_patterns(input_words, None)
+        offset = self._pattern_offset
+        for idx, common in delta_shared.items():
+            shared[offset + idx] = common
+        return shared
+
+    def _delta_intents(self, input_words: FrozenSet, threshold: float,
+                       delta_shared: Optional[Dict[int, int]] = None) -> List[Tuple[int, int, float, float]]:
+        """Every delta intent hit, in catalog numbering, best first"""
+        if delta_shared is None:
+            delta_shared = _without(self.delta.pattern_overlaps(input_words), self._dead_patterns)
+        if not delta_shared:
+            return []
+        offset, slots = self._pattern_offset, self._delta_intent_slots
+        hits = [(offset + pattern, slots[intent_idx], score, confidence) for pattern, intent_idx, score, confidence
+                in self.delta.top_intents(input_words, len(self.delta.intents), threshold, delta_shared)]
+        hits.sort(key=lambda hit: (-hit[2], hit[1]))
+        return hits
+
+    @staticmethod
+    def _merge_intent(best: Tuple[int, int, float, float],
+                      delta: List[Tuple[int, int, float, float]]) -> Tuple[int, int, float, float]:
+        """The better of a base intent hit and the best delta one; ties go to the earlier intent"""
+        if delta and (best[0] < 0 or (delta[0][2], -delta[0][1]) > (best[2], -best[1])):
+            return delta[0]
+        return best
+
+    def best_intent(self, input_words: FrozenSet, threshold: float,
+                    shared: Optional[Dict[int, int]] = None) -> Tuple[int, int, float, float]:
+        """Best intent of both layers; ties go to the earlier intent"""
+        base_words, base_shared, delta_shared = self._split_patterns(input_words, shared)
+        return self._merge_intent(self.base.best_intent(base_words, threshold, base_shared),
+                                  self._delta_intents(input_words, threshold, delta_shared))
+
+    def top_intents(self, input_words: FrozenSet, k: int, threshold: float = 0.0,
+                    shared: Optional[Dict[int, int]] = None) -> List[Tuple[int, int, float, float]]:
+        """The k best intents of both layers, best first"""
+        base_words, base_shared, delta_shared = self._split_patterns(input_words, shared)
+        ranked = self.base.top_intents(base_words, k, threshold, base_shared)
+        ranked += self._delta_intents(input_words, threshold, delta_shared)
+        ranked.sort(key=lambda hit: (-hit[2], hit[1]))
+        return ranked[:k]
+
+    def merge_intent_hits(self, hits: Sequence[Tuple[int, int, float, float]], word_sets: Sequence[FrozenSet],
+                          threshold: float) -> List[Tuple[int, int, float, float]]:
+        """Best intent of both layers for each input, given the base's best with the masked patterns left out"""
+        return [self._merge_intent(best, self._delta_intents(words, threshold))
+                for best, words in zip(hits, word_sets)]
+
+
+class PatchedBatchScorer:
+    """Batch scoring for a PatchedCatalog
+
+    The base catalog's scorer, shared by every patch of it, scores with the
+    changed entries masked out; the few delta entries are scored per input
+    and merged in, as in PatchedCatalog.best_faq and best_intent.
+    """
+
+    def __init__(self, catalog: PatchedCatalog):
+        self.catalog = catalog
+        self.base = catalog.base.batch_scorer()
+
+    def match_faqs(self, normalized_inputs: Sequence[str], word_sets: Sequence[FrozenSet[str]],
+                   threshold: float) -> List[Tuple[int, float, float]]:
+        """(slot, score, similarity) of the best FAQ for each input"""
+        catalog = self.catalog
+        base_sets = [catalog.base.encode_words(words) for words in word_sets]
+        hits = self.base.match_faqs(normalized_inputs, base_sets, threshold, catalog.masked_faqs)
+        return catalog.merge_faq_hits(hits, normalized_inputs, word_sets, threshold)
+
+    def match_intents(self, word_sets: Sequence[FrozenSet[str]],
+                      threshold: float) -> List[Tuple[int, int, float, float]]:
+        """(pattern, intent slot, score, confidence) of the best intent for each input"""
+        catalog = self.catalog
+        base_sets = [catalog.base.encode_words(words) for words in word_sets]
+        hits = self.base.match_intents(base_sets, threshold, catalog.masked_patterns)
+        return catalog.merge_intent_hits(hits, word_sets, threshold)
+
+
+def apply_change(catalog: CompiledCatalog, change: Dict) -> PatchedCatalog:
+    """
+    The catalog with one change applied
+
+    Only the changed entry is compiled, in time that does not grow with
+    the size of the catalog; a snapshot catalog is layered over as it is.
+
+    Raises:
+        KeyError: The change names an FAQ, intent or pattern that does not exist
+        ValueError: The change is malformed
+    """
+    if not isinstance(catalog, PatchedCatalog):
+        catalog = PatchedCatalog(catalog)
+    op = change.get("op")
+
+    if op in ("add_faq", "update_faq"):
+        fields = change.get("faq")
+        if not isinstance(fields, dict):
+            raise ValueError(f"{op} needs the FAQ's fields")
+        if op == "add_faq":
+            return catalog.with_faq(len(catalog.faqs), FAQEntry.from_dict(fields))
+        slot = catalog.faq_slot(change.get("faq_id"))
+        return catalog.with_faq(slot, FAQEntry.from_dict({**catalog.faqs[slot].to_dict(), **fields}))
+    if op == "remove_faq":
+        return catalog.with_faq(catalog.faq_slot(change.get("faq_id")), None)
+    if op in ("add_intent_pattern", "update_intent_pattern", "remove_intent_pattern"):
+        name, pattern = change.get("intent"), change.get("pattern")
+        if not isinstance(pattern, str):
+            raise ValueError(f"{op} needs a pattern")
+        slot = catalog.intent_slot(name)
+        if slot < 0:
+            if op != "add_intent_pattern" or change.get("response") is None:
+                raise KeyError(f"Unknown intent: {name!r}")
+            # A new intent needs a response
+            return catalog.with_intent(len(catalog.intents), IntentEntry.from_dict(
+                {"name": name, "patterns": [pattern], "response": change["response"]}))
+        data = catalog.intents[slot].to_dict()
+        patterns = list(data.get("patterns", []))
+        if op == "add_intent_pattern":
+            patterns.append(pattern)
+            if change.get("response") is not None:
+                data["response"] = change["response"]
+        elif pattern not in patterns:
+            raise KeyError(f"Intent {name!r} has no pattern {pattern!r}")
+        elif op == "update_intent_pattern":
+            new_pattern = change.get("new_pattern")
+            if not isinstance(new_pattern, str):
+                raise ValueError("update_intent_pattern needs a new_pattern")
+            patterns[patterns.index(pattern)] = new_pattern
+        else:
+            patterns.remove(pattern)
+        return catalog.with_intent(slot, IntentEntry.from_dict({**data, "patterns": patterns}))
+    raise ValueError(f"Unknown catalog change: {op!r}")
+
+
+def change_log_path(faq_file: str) -> str:
+    """Default change log location for an FAQ file"""
+    return faq_file + ".changes"
+
+
+def _stamp(value) -> Optional[Tuple[int, int]]:
+    return tuple(value) if value is not None else None
+
+
+class ChangeLog:
+    """
+    Append-only JSON-lines log of the catalog changes not yet in the FAQ file
+
+    The first line names the version of the FAQ file (modification time and
+    size) the changes apply to. Compaction appends a marker naming the
+    rewritten file and how many changes it holds before replacing the FAQ
+    file, then restarts the log; after a crash between the two, the changes
+    the file already holds are not replayed again.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def read(self, source_stamp: Optional[Tuple[int, int]]) -> List[Dict]:
+        """Changes to replay onto the FAQ file with this stamp"""
+        try:
+            f = open(self.path, "r", encoding="utf-8")
+        except FileNotFoundError:
+            return []
+        changes: List[Dict] = []
+        source = None
+        with f:
+            for number, line in enumerate(f, 1):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logger.warning("Ignoring unreadable line %d of %s", number, self.path)
+                    continue
+                if "op" in record:
+                    changes.append(record)
+                elif "compacted" in record:
+                    if _stamp(record["compacted"]) == source_stamp:
+                        # The FAQ file was rewritten with these changes in it
+                        changes = changes[record.get("changes", len(changes)):]
+                        source = source_stamp
+                elif "source" in record:
+                    source = _stamp(record["source"])
+        if changes and source != source_stamp:
+            logger.warning("The FAQ file changed since %s was started; replaying its changes on top", self.path)
+        return changes
+
+    def append(self, record: Dict, source_stamp: Optional[Tuple[int, int]]):
+        """Append a change or marker, starting the log for source_stamp if there is none"""
+        if not os.path.exists(self.path):
+            self.restart(source_stamp)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def restart(self, source_stamp: Optional[Tuple[int, int]], changes: List[Dict] = ()):
+        """Replace the log with one holding changes on top of the FAQ file with this stamp"""
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(json.dumps({"source": source_stamp}) + "\n")
+            for change in changes:
+                f.write(json.dumps(change, ensure_ascii=False) + "\n")
+        os.replace(tmp, self.path)
@@ -0,0 +1,378 @@
+"""
+Binary Catalog Snapshot
+Compiles faq_data.json into a versioned binary snapshot of the normalized
+questions, token ids and inverted indexes, and loads it back memory-mapped
+
+Run with: python catalog_snapshot.py [faq_data.json] [--output PATH]
+
+Loading only reads the header; strings, word sets and postings are decoded
+from the mapped pages on access, and every process mapping the same file
+shares those pages through the OS page cache.
+"""
+
+import argparse
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from collections.abc import Sequence
+from typing import Dict, FrozenSet, Iterable, Iterator, List, Optional, Set, Tuple, Type
+
+from faq_catalog import CatalogEntry, CompiledCatalog, FAQEntry, IntentEntry, KeywordRules, next_catalog_version
+
+# Bump whenever the layout or the text normalization changes
+FORMAT_VERSION = 3
+MAGIC = b"FAQSNAP\x00"
+SECTIONS = (
+    "source",                          # the FAQ JSON, parsed only if faq_data is read
+    "vocab", "vocab_offsets",          # sorted tokens; position is the token id
+    "faq_index_ptr", "faq_index_ids",  # token id -> FAQ indexes
+    "pattern_index_ptr", "pattern_index_ids",  # token id -> pattern indexes
+    "faq_words_ptr", "faq_words_ids",  # FAQ -> token ids
+    "pattern_words_ptr", "pattern_words_ids",
+    "pattern_raw_ptr", "pattern_raw_ids",
+    "faq_sizes", "pattern_sizes",      # distinct normalized words per entry
+    "pattern_intent", "faq_short", "raw_patterns",
+    "keywords",                        # greeting/goodbye keyword lists as JSON
+    "faq_corpus", "faq_starts",        # NUL-joined normalized questions (UTF-8)
+    "faq_entries", "faq_entry_offsets",
+    "intent_entries", "intent_entry_offsets",
+    "entry_ids",                       # FAQ id and intent name -> first slot, as JSON pairs
+)
+_HEADER = struct.Struct("<8sIBxxxqqI")
+_SECTION = struct.Struct("<QQ")
+_BYTE_ORDERS = {"little": 0, "big": 1}
+
+
+def snapshot_path(faq_file: str) -> str:
+    """Default snapshot location for an FAQ file"""
+    return faq_file + ".snapshot"
+
+
+def _source_stamp(faq_file: str) -> Optional[Tuple[int, int]]:
+    """Modification time and size of the FAQ file, or None if it is missing"""
+    try:
+        stat = os.stat(faq_file)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _csr(rows: Iterable[Iterable[int]]) -> Tuple[array, array]:
+    """Compressed rows: row i is ids[ptr[i]:ptr[i + 1]]"""
+    ptr, ids = array("I", [0]), array("I")
+    for row in rows:
+        ids.extend(row)
+        ptr.append(len(ids))
+    return ptr, ids
+
+
+def _blobs(items: Iterable[bytes]) -> Tuple[bytes, array]:
+    """Concatenated byte strings and their n + 1 boundary offsets"""
+    parts, offsets = [], array("I", [0])
+    for item in items:
+        parts.append(item)
+        offsets.append(offsets[-1] + len(item))
+    return b"".join(parts), offsets
+
+
+def write_snapshot(faq_file: str, output: Optional[str] = None) -> str:
+    """Compile an FAQ file into a binary snapshot; returns the snapshot path"""
+    output = output or snapshot_path(faq_file)
+    stamp = _source_stamp(faq_file)
+    if stamp is None:
+        raise FileNotFoundError(faq_file)
+    with open(faq_file, "rb") as f:
+        source = f.read()
+    catalog = CompiledCatalog(json.loads(source.decode("utf-8")))
+
+    tokens = set()
+    for words in catalog.faq_words:
+        tokens.update(words)
+    for words, raw_words in zip(catalog.pattern_words, catalog.pattern_raw_words):
+        tokens.update(words, raw_words)
+    vocab = sorted(tokens)
+    token_id = {token: idx for idx, token in enumerate(vocab)}
+
+    def ids(words: FrozenSet[str]) -> List[int]:
+        return sorted(token_id[word] for word in words)
+
+    corpus = catalog.faq_corpus.encode("utf-8")
+    # Byte offsets of each question, plus one past the final separator
+    starts = array("I")
+    offset = 0
+    for question in catalog.faq_questions:
+        starts.append(offset)
+        offset += len(question.encode("utf-8")) + 1
+    starts.append(offset)
+
+    def entry_json(entry: CatalogEntry) -> bytes:
+        return json.dumps(entry.to_dict(), ensure_ascii=False).encode("utf-8")
+
+    vocab_blob, vocab_offsets = _blobs(token.encode("utf-8") for token in vocab)
+    faq_entries, faq_entry_offsets = _blobs(entry_json(faq) for faq in catalog.faqs)
+    intent_entries, intent_entry_offsets = _blobs(entry_json(intent) for intent in catalog.intents)
+    sections = {
+        "source": source,
+        "vocab": vocab_blob,
+        "vocab_offsets": vocab_offsets,
+        "faq_sizes": array("I", catalog.faq_sizes),
+        "pattern_sizes": array("I", catalog.pattern_sizes),
+        "pattern_intent": array("I", catalog.pattern_intent),
+        "faq_short": array("I", catalog.faq_short),
+        "raw_patterns": array("I", sorted(catalog.raw_patterns)),
+        "keywords": json.dumps(catalog.keywords.config, ensure_ascii=False).encode("utf-8"),
+        "faq_corpus": corpus,
+        "faq_starts": starts,
+        "faq_entries": faq_entries,
+        "faq_entry_offsets": faq_entry_offsets,
+        "intent_entries": intent_entries,
+        "intent_entry_offsets": intent_entry_offsets,
+        # Pairs, since FAQ ids need not be strings
+        "entry_ids": json.dumps({"faqs": list(catalog.faq_ids.items()),
+                                 "intents": list(catalog.intent_slots.items())},
+                                ensure_ascii=False).encode("utf-8"),
+    }
+    for name, index in (("faq_index", catalog.faq_index), ("pattern_index", catalog.intent_index)):
+        ptr, postings = _csr(index.get(token, ()) for token in vocab)
+        sections[name + "_ptr"], sections[name + "_ids"] = ptr, postings
+    for name, word_sets in (("faq_words", catalog.faq_words),
+                            ("pattern_words", catalog.pattern_words),
+                            ("pattern_raw", catalog.pattern_raw_words)):
+        ptr, token_ids = _csr(ids(words) for words in word_sets)
+        sections[name + "_ptr"], sections[name + "_ids"] = ptr, token_ids
+
+    header_size = _HEADER.size + _SECTION.size * len(SECTIONS)
+    table, payload = [], bytearray()
+    for name in SECTIONS:
+        data = sections[name]
+        data = data.tobytes() if isinstance(data, array) else data
+        payload.extend(b"\x00" * (-(header_size + len(payload)) % 8))  # keep arrays aligned
+        table.append((header_size + len(payload), len(data)))
+        payload.extend(data)
+
+    # Write next to the target and rename, so processes that already mapped
+    # the old snapshot keep a consistent view
+    tmp = f"{output}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, FORMAT_VERSION, _BYTE_ORDERS[sys.byteorder],
+                             stamp[0], stamp[1], len(SECTIONS)))
+        for offset, length in table:
+            f.write(_SECTION.pack(offset, length))
+        f.write(payload)
+    os.replace(tmp, output)
+    return output
+
+
+class _Strings(Sequence):
+    """Strings stored back to back in a mapped blob with n + 1 offsets"""
+
+    def __init__(self, blob: memoryview, offsets: memoryview, gap: int = 0):
+        self._blob = blob
+        self._offsets = offsets
+        self._gap = gap  # separator bytes after each string
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, idx: int) -> str:
+        if idx < 0:
+            idx += len(self)
+        return str(self._blob[self._offsets[idx]:self._offsets[idx + 1] - self._gap], "utf-8")
+
+
+class _Entries(Sequence):
+    """FAQ or intent records, each decoded from its own JSON slice on access"""
+
+    def __init__(self, blob: memoryview, offsets: memoryview, record: Type[CatalogEntry]):
+        self._strings = _Strings(blob, offsets)
+        self._record = record
+
+    def __len__(self) -> int:
+        return len(self._strings)
+
+    def __getitem__(self, idx: int) -> CatalogEntry:
+        return self._record.from_dict(json.loads(self._strings[idx]))
+
+
+class _WordSets(Sequence):
+    """Per-entry word sets stored as compressed rows of token ids"""
+
+    def __init__(self, ptr: memoryview, ids: memoryview):
+        self._ptr = ptr
+        self._ids = ids
+
+    def __len__(self) -> int:
+        return len(self._ptr) - 1
+
+    def __getitem__(self, idx: int) -> FrozenSet[int]:
+        return frozenset(self._ids[self._ptr[idx]:self._ptr[idx + 1]])
+
+
+class _Postings:
+    """Token id -> entry indexes"""
+
+    def __init__(self, ptr: memoryview, ids: memoryview):
+        self._ptr = ptr
+        self._ids = ids
+
+    def get(self, token: int, default=()) -> Sequence:
+        if token < 0:
+            return default  # not in the catalog vocabulary
+        return self._ids[self._ptr[token]:self._ptr[token + 1]]
+
+
+class SnapshotCatalog(CompiledCatalog):
+    """CompiledCatalog served straight from a memory-mapped snapshot
+
+    Index keys and word sets are token ids rather than strings, so scoring
+    never decodes the vocabulary; encode_words maps input words to ids.
+    """
+
+    def __init__(self, mapped: mmap.mmap, sections: Dict[str, Tuple[int, int]]):
+        # The base constructor compiles from JSON; everything here is a view
+        self.version = next_catalog_version()
+        self._batch_scorer = None
+        self.derived = {}
+        self._mmap = mapped
+        view = memoryview(mapped)
+
+        def raw(name: str) -> memoryview:
+            offset, length = sections[name]
+            return view[offset:offset + length]
+
+        def ints(name: str) -> memoryview:
+            return raw(name).cast("I")
+
+        self._source = raw("source")
+        self._entry_ids = raw("entry_ids")
+        self._corpus_span = sections["faq_corpus"]
+        self._vocab = _Strings(raw("vocab"), ints("vocab_offsets"))
+        self.faqs = _Entries(raw("faq_entries"), ints("faq_entry_offsets"), FAQEntry)
+        self.intents = _Entries(raw("intent_entries"), ints("intent_entry_offsets"), IntentEntry)
+        self.faq_starts = ints("faq_starts")
+        self.faq_questions = _Strings(raw("faq_corpus"), self.faq_starts, gap=1)
+        self.faq_words = _WordSets(ints("faq_words_ptr"), ints("faq_words_ids"))
+        self.faq_index = _Postings(ints("faq_index_ptr"), ints("faq_index_ids"))
+        self.faq_sizes = ints("faq_sizes")
+        self.faq_short = ints("faq_short")
+        self.pattern_intent = ints("pattern_intent")
+        self.pattern_sizes = ints("pattern_sizes")
+        self.raw_patterns = frozenset(ints("raw_patterns"))
+        self.pattern_words = _WordSets(ints("pattern_words_ptr"), ints("pattern_words_ids"))
+        self.pattern_raw_words = _WordSets(ints("pattern_raw_ptr"), ints("pattern_raw_ids"))
+        self.intent_index = _Postings(ints("pattern_index_ptr"), ints("pattern_index_ids"))
+        self.keywords = KeywordRules(json.loads(str(raw("keywords"), "utf-8")))
+
+    @property
+    def data(self) -> Dict:
+        """The full FAQ data, parsed from the embedded source on first access"""
+        if not hasattr(self, "_data"):
+            self._data = json.loads(str(self._source, "utf-8"))
+        return self._data
+
+    @property
+    def _settings(self) -> Dict:
+        """Top-level sections other than the entries, parsed from the embedded source"""
+        return {key: value for key, value in self.data.items() if key not in ("faqs", "intents")}
+
+    def _decoded_ids(self) -> Dict[str, Dict]:
+        if not hasattr(self, "_ids"):
+            pairs = json.loads(str(self._entry_ids, "utf-8"))
+            self._ids = {name: {key: slot for key, slot in items} for name, items in pairs.items()}
+        return self._ids
+
+    @property
+    def faq_ids(self) -> Dict[object, int]:
+        """First slot of each FAQ "id", decoded on first access"""
+        return self._decoded_ids()["faqs"]
+
+    @property
+    def intent_slots(self) -> Dict[str, int]:
+        """First slot of each intent name, decoded on first access"""
+        return self._decoded_ids()["intents"]
+
+    def encode_words(self, words: FrozenSet[str]) -> FrozenSet[int]:
+        """Token ids of input words; unknown words get distinct negative ids"""
+        vocab = self._vocab
+        ids = set()
+        unknown = 0
+        for word in words:
+            token = bisect_left(vocab, word)
+            if token == len(vocab) or vocab[token] != word:
+                unknown += 1
+                token = -unknown  # counts toward the set size, never shared
+            ids.add(token)
+        return frozenset(ids)
+
+    def indexed_words(self) -> Set[str]:
+        """Words of the question and pattern indexes, decoded from the vocabulary"""
+        return {word for token, word in enumerate(self._vocab)
+                if self.faq_index.get(token) or self.intent_index.get(token)}
+
+    @property
+    def faq_corpus(self) -> str:
+        offset, length = self._corpus_span
+        return self._mmap[offset:offset + length].decode("utf-8")
+
+    def find_in_questions(self, text: str) -> Iterator[int]:
+        """Yield indexes of FAQs whose normalized question contains text"""
+        # UTF-8 is self-synchronizing, so byte matches are character matches
+        needle = text.encode("utf-8")
+        base, length = self._corpus_span
+        starts = self.faq_starts
+        n_faqs = len(starts) - 1
+        pos = self._mmap.find(needle, base, base + length) if n_faqs else -1
+        while pos != -1:
+            idx = bisect_right(starts, pos - base) - 1
+            yield idx
+            if idx + 1 >= n_faqs:
+                break
+            pos = self._mmap.find(needle, base + starts[idx + 1], base + length)
+
+
+def load_snapshot(faq_file: str, snapshot_file: Optional[str] = None) -> Optional[SnapshotCatalog]:
+    """Map the snapshot of an FAQ file, or None if it is missing, stale or incompatible"""
+    snapshot_file = snapshot_file or snapshot_path(faq_file)
+    stamp = _source_stamp(faq_file)
+    if stamp is None:
+        return None
+    try:
+        with open(snapshot_file, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    try:
+        magic, version, byte_order, mtime_ns, size, n_sections = _HEADER.unpack_from(mapped, 0)
+    except struct.error:
+        mapped.close()
+        return None
+    if (magic != MAGIC or version != FORMAT_VERSION or n_sections != len(SECTIONS)
+            or byte_order != _BYTE_ORDERS[sys.byteorder] or (mtime_ns, size) != stamp):
+        mapped.close()
+        return None
+    sections = {
+        name: _SECTION.unpack_from(mapped, _HEADER.size + i * _SECTION.size)
+        for i, name in enumerate(SECTIONS)
+    }
+    return SnapshotCatalog(mapped, sections)
+
+
+def main(argv: Optional[List[str]] = None):
+    """Compile an FAQ file into its binary snapshot"""
+    parser = argparse.ArgumentParser(description="Compile faq_data.json into a binary catalog snapshot")
+    parser.add_argument("faq_file", nargs="?", default="faq_data.json", help="FAQ JSON file")
+    parser.add_argument("--output", "-o", help="snapshot path (default: <faq_file>.snapshot)")
+    args = parser.parse_args(argv)
+
+    output = write_snapshot(args.faq_file, args.output)
+    catalog = load_snapshot(args.faq_file, output)
+    print(f"Wrote {output} ({os.path.getsize(output)} bytes): "
+          f"{len(catalog.faqs)} FAQs, {len(catalog.pattern_intent)} intent patterns")
+
+
+if __name__ == "__main__":
+    main()
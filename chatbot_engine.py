@@ -3,21 +3,158 @@ Customer Support Chatbot Engine
 Handles intent recognition, FAQ matching, and conversation flow
 """
 
-import re
+import asyncio
 import json
-from typing import Dict, List, Optional
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Dict, FrozenSet, Iterable, List, Optional, Tuple, Union
 from datetime import datetime
 import random
 
+from catalog_changes import ChangeLog, apply_change, change_log_path
+from catalog_snapshot import load_snapshot
+from conversation_store import HistoryEvent, HistoryStore, InMemoryHistoryStore, SQLiteHistoryStore
+from engine_stats import EngineStats
+from faq_catalog import CompiledCatalog, jaccard, normalize_text, np
+from fuzzy_matching import FuzzyCorrector
+from response_cache import ResponseCache
+from sharded_matching import ShardedMatcher
+
+logger = logging.getLogger(__name__)
+
+
+class PerUserQueue:
+    """
+    Runs each user's async jobs one at a time, in submission order
+
+    Must be used from the event loop thread. Other users' jobs run
+    concurrently, and a user is forgotten once their last job is done.
+    """
+
+    def __init__(self):
+        # Last submitted job per user, so the next one waits for it
+        self._tails: Dict[str, asyncio.Task] = {}
+
+    def submit(self, user_id: str, job: Callable[[], Awaitable]) -> asyncio.Task:
+        """Schedule job() to run after the user's previously submitted jobs; returns its task"""
+        previous = self._tails.get(user_id)
+        task = asyncio.get_running_loop().create_task(self._run_after(previous, job))
+        self._tails[user_id] = task
+
+        def forget(done: asyncio.Task):
+            if self._tails.get(user_id) is done:
+                del self._tails[user_id]
+
+        task.add_done_callback(forget)
+        return task
+
+    @staticmethod
+    async def _run_after(previous: Optional[asyncio.Task], job: Callable[[], Awaitable]):
+        if previous is not None:
+            # Only ordering matters here; its result or error belongs to its caller
+            await asyncio.wait([previous])
+        return await job()
+
+    def __len__(self) -> int:
+        """Users with unfinished jobs"""
+        return len(self._tails)
+
 
 class CustomerSupportChatbot:
-    """Main chatbot engine for customer support"""
+    """
+    Main chatbot engine for customer support
+    
+    One instance can be shared by many threads. Matching reads an immutable
+    compiled catalog without locking (reloads swap in a new one), while
+    per-user history sits in a sharded, locked store.
+    """
     
-    def __init__(self, faq_file: str = "faq_data.json"):
-        """Initialize the chatbot with FAQ data"""
-        self.faq_data = self._load_faq_data(faq_file)
-        self.conversation_history = []
-        self.user_context = {}
+    INTENT_THRESHOLD = 0.4  # Minimum similarity threshold (increased for better accuracy)
+    FAQ_THRESHOLD = 0.35  # Minimum similarity threshold
+    
+    def __init__(self, faq_file: str = "faq_data.json", max_history_per_user: int = 100,
+                 history_ttl: Optional[float] = 86400.0, response_cache_size: int = 0,
+                 auto_reload: bool = False, reload_interval: float = 2.0, use_snapshot: bool = True,
+                 async_workers: int = 4, shards: int = 0, instrument: bool = False,
+                 history_store: Optional[HistoryStore] = None, fuzzy: bool = False,
+                 persist_changes: bool = False, compact_after: int = 256,
+                 user_context: Optional[Dict[str, Dict]] = None,
+                 context_lock: Optional[threading.Lock] = None):
+        """
+        Initialize the chatbot with FAQ data
+        
+        Args:
+            faq_file: Path to the FAQ JSON file
+            max_history_per_user: Messages kept in each user's history
+            history_ttl: Seconds of inactivity before a user's history is dropped
+                (None keeps it until cleared)
+            response_cache_size: Entries in the LRU response cache keyed on the
+                normalized message; 0 disables it
+            auto_reload: Watch the FAQ file and reload it in the background
+                when its modification time changes
+            reload_interval: Minimum seconds between checks of the FAQ file
+            use_snapshot: Load the precompiled binary snapshot of the FAQ file
+                (see catalog_snapshot.py) when it is up to date
+            async_workers: Worker threads used by process_message_async
+            shards: Worker processes to split matching over (see
+                sharded_matching.py); 0 or 1 matches in this process
+            instrument: Collect per-stage timings and result statistics
+                (see get_stats); can be switched later with set_instrumentation
+            history_store: Backend for conversation history and user context
+                (e.g. SQLiteHistoryStore); defaults to an InMemoryHistoryStore
+                built from max_history_per_user and history_ttl
+            fuzzy: Correct misspelled words to catalog words before matching
+                (see fuzzy_matching.py)
+            persist_changes: Append catalog changes (add_faq() etc.) to
+                <faq_file>.changes, replay them on load and write them into the
+                FAQ file when compacting; otherwise they only live in memory
+                until the FAQ file is reloaded
+            compact_after: Catalog changes after which they are compacted into
+                a freshly compiled catalog in the background
+            user_context: User context shared with other engines on the same
+                history store (see engine_registry.py); loaded from the store
+                when not given
+            context_lock: Lock guarding updates of a shared user_context
+        """
+        self.faq_file = faq_file
+        self.auto_reload = auto_reload
+        self.reload_interval = reload_interval
+        self.use_snapshot = use_snapshot
+        self.shards = shards
+        self._shard_lock = threading.Lock()
+        self.fuzzy = fuzzy
+        self._fuzzy_lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self.compact_after = compact_after
+        self._change_lock = threading.Lock()
+        self._change_log = ChangeLog(change_log_path(faq_file)) if persist_changes else None
+        # Changes made since the catalog was last compiled, in order
+        self._pending: List[Dict] = []
+        self._next_reload_check = 0.0
+        # Stamp before loading so an edit made during the load is not missed
+        self._source_stamp = self._file_stamp()
+        snapshot = load_snapshot(faq_file) if use_snapshot else None
+        if snapshot is not None:
+            self._catalog = snapshot
+        else:
+            self.faq_data = self._load_faq_data(faq_file)  # also compiles the catalog
+        if self._change_log is not None:
+            self._pending = self._change_log.read(self._source_stamp)
+            self._catalog = self._replay(self._catalog, self._pending)
+        self._response_cache = ResponseCache(response_cache_size) if response_cache_size > 0 else None
+        if history_store is None:
+            history_store = InMemoryHistoryStore(max_history_per_user, history_ttl)
+        self._history = history_store
+        self._stats: Optional[EngineStats] = EngineStats() if instrument else None
+        # Read on every message, so kept in memory; the store keeps a copy
+        self.user_context = self._history.load_contexts() if user_context is None else user_context
+        self._context_lock = context_lock or threading.Lock()
+        self.async_workers = async_workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._async_queue = PerUserQueue()
         self.greetings = [
             "Hi! How can I help you today?",
             "Hello! What can I assist you with?",
@@ -43,197 +180,472 @@ class CustomerSupportChatbot:
                 "faqs": []
             }
     
-    def _normalize_text(self, text: str) -> str:
-        """Normalize text for better matching"""
-        text = text.lower().strip()
-        # Remove special characters but keep spaces
-        text = re.sub(r'[^\w\s]', '', text)
-        return text
-    
-    def _calculate_similarity(self, text1: str, text2: str) -> float:
-        """Calculate simple word-based similarity"""
-        words1 = set(self._normalize_text(text1).split())
-        words2 = set(self._normalize_text(text2).split())
+    @property
+    def faq_data(self) -> Dict:
+        """FAQ and intent catalog"""
+        return self._catalog.data
+
+    @faq_data.setter
+    def faq_data(self, data: Dict):
+        """Replace the catalog and recompile its token sets and indexes"""
+        self._catalog = CompiledCatalog(data)
+
+    def _file_stamp(self) -> Optional[Tuple[int, int]]:
+        """Modification time and size of the FAQ file, or None if it is missing"""
+        try:
+            stat = os.stat(self.faq_file)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _current_catalog(self) -> CompiledCatalog:
+        """Catalog to match a message against, scheduling a reload if the file changed"""
+        if self.auto_reload:
+            now = time.monotonic()
+            if now >= self._next_reload_check:
+                self._next_reload_check = now + self.reload_interval
+                if self._file_stamp() != self._source_stamp:
+                    self.reload(background=True)
+        return self._catalog
+
+    def reload(self, background: bool = False) -> bool:
+        """
+        Re-read the FAQ file and swap in the new catalog
         
-        if not words1 or not words2:
-            return 0.0
+        The new catalog and its derived indexes are built while the current
+        one keeps serving. The swap is a single reference assignment, so every
+        message is matched against one complete catalog, old or new.
         
-        intersection = words1.intersection(words2)
-        union = words1.union(words2)
+        Returns:
+            True if a new catalog was swapped in (or, with background=True,
+            if a reload was started)
+        """
+        if background:
+            if self._reload_lock.locked():
+                return False  # a reload is already in progress
+            threading.Thread(target=self.reload, name="faq-reload", daemon=True).start()
+            return True
         
-        return len(intersection) / len(union) if union else 0.0
-    
-    def _check_greeting(self, user_input: str) -> bool:
-        """Check if user input is a greeting"""
-        greeting_keywords = [
-            'hi', 'hello', 'hey', 'greetings', 'good morning', 
-            'good afternoon', 'good evening', 'sup', 'what\'s up'
-        ]
-        normalized = self._normalize_text(user_input)
-        # Check if input starts with greeting or is very short (likely a greeting)
-        words = normalized.split()
-        if len(words) <= 3:  # Short messages are likely greetings
-            return any(keyword in normalized for keyword in greeting_keywords)
-        # For longer messages, check if it starts with a greeting
-        return words[0] in greeting_keywords or any(f"{keyword} " in normalized for keyword in greeting_keywords)
-    
-    def _check_goodbye(self, user_input: str) -> bool:
-        """Check if user input is a goodbye"""
-        goodbye_keywords = [
-            'bye', 'goodbye', 'see you', 'farewell', 'exit', 
-            'quit', 'thanks', 'thank you', 'done'
-        ]
-        normalized = self._normalize_text(user_input)
-        return any(keyword in normalized for keyword in goodbye_keywords)
-    
-    def _match_intent(self, user_input: str) -> Optional[Dict]:
-        """Match user input to an intent"""
-        best_match = None
-        best_score = 0.0
-        threshold = 0.4  # Minimum similarity threshold (increased for better accuracy)
+        with self._reload_lock:
+            stamp = self._file_stamp()
+            catalog = load_snapshot(self.faq_file) if self.use_snapshot else None
+            if catalog is None:
+                try:
+                    with open(self.faq_file, 'r', encoding='utf-8') as f:
+                        data = json.load(f)
+                except (OSError, ValueError) as e:
+                    # Missing or half-written file: keep serving the current catalog
+                    logger.warning("Could not reload %s, keeping the current catalog: %s", self.faq_file, e)
+                    return False
+                catalog = CompiledCatalog(data)
+            current = self._catalog
+            catalog.warm(getattr(current, "base", current))
+            if self.shards > 1:
+                self._sharded_matcher(catalog)  # start the new workers before the swap
+            if self.fuzzy:
+                self._fuzzy_corrector(catalog)
+            # Catalog changes only wait for the replay and swap, so none is lost in it
+            with self._change_lock:
+                pending = self._change_log.read(stamp) if self._change_log is not None else []
+                self._catalog = self._replay(catalog, pending)
+                self._pending = pending
+                self._source_stamp = stamp
+            logger.info("Reloaded FAQ catalog from %s", self.faq_file)
+            return True
+
+    def compact(self, background: bool = False) -> bool:
+        """
+        Compile the catalog afresh with the pending changes folded in
         
-        normalized_input = self._normalize_text(user_input)
+        Like a reload, the new catalog is built while the current one keeps
+        serving; changes made meanwhile are layered over it before the swap.
+        With persist_changes the FAQ file is rewritten and the change log
+        restarted.
         
-        # Check intents - try exact keyword matching first
-        for intent in self.faq_data.get("intents", []):
-            for pattern in intent.get("patterns", []):
-                # Check if pattern keywords are in the input
-                pattern_words = set(pattern.split())
-                input_words = set(normalized_input.split())
-                
-                # If all pattern words are in input, it's a strong match
-                if pattern_words.issubset(input_words) and len(pattern_words) > 0:
-                    similarity = 0.9  # High confidence for keyword match
-                else:
-                    similarity = self._calculate_similarity(normalized_input, pattern)
-                
-                if similarity > best_score and similarity >= threshold:
-                    best_score = similarity
-                    best_match = intent
+        Returns:
+            True if changes were compacted (or, with background=True, if a
+            compaction was started)
+        """
+        if background:
+            if self._reload_lock.locked():
+                return False  # a reload or compaction is already in progress
+            threading.Thread(target=self.compact, name="faq-compact", daemon=True).start()
+            return True
         
-        return best_match if best_match else None
-    
-    def _match_faq(self, user_input: str) -> Optional[Dict]:
-        """Match user input to FAQ questions"""
-        best_match = None
-        best_score = 0.0
-        threshold = 0.35  # Minimum similarity threshold
+        with self._reload_lock:
+            with self._change_lock:
+                catalog, folded = self._catalog, len(self._pending)
+            if not folded:
+                return False
+            data = catalog.data
+            compiled = CompiledCatalog(data)
+            compiled.warm(getattr(catalog, "base", catalog))
+            if self.shards > 1:
+                self._sharded_matcher(compiled)
+            if self.fuzzy:
+                self._fuzzy_corrector(compiled)
+            tmp = None
+            if self._change_log is not None:
+                tmp = f"{self.faq_file}.{os.getpid()}.tmp"
+                with open(tmp, 'w', encoding='utf-8') as f:
+                    json.dump(data, f, indent=2, ensure_ascii=False)
+                stat = os.stat(tmp)
+                stamp = (stat.st_mtime_ns, stat.st_size)  # kept by the rename
+            with self._change_lock:
+                tail = self._pending[folded:]
+                updated = self._replay(compiled, tail)
+                if tmp is not None:
+                    # Mark the changes as written before the FAQ file is, so a
+                    # crash in between never replays them twice
+                    self._change_log.append({"compacted": stamp, "changes": folded}, self._source_stamp)
+                    os.replace(tmp, self.faq_file)
+                    self._change_log.restart(stamp, tail)
+                    self._source_stamp = stamp
+                self._catalog = updated
+                self._pending = tail
+            logger.info("Compacted %d catalog changes into %s", folded, self.faq_file)
+            return True
+
+    def _replay(self, catalog: CompiledCatalog, changes: List[Dict]) -> CompiledCatalog:
+        """Layer changes over a catalog, skipping those that no longer apply"""
+        patched = catalog
+        for change in changes:
+            try:
+                patched = apply_change(patched, change)
+            except (KeyError, ValueError) as e:
+                logger.warning("Skipping catalog change %s: %s", change, e)
+        self._share_derived(catalog, patched)
+        return patched
+
+    def _share_derived(self, previous: CompiledCatalog, catalog: CompiledCatalog):
+        """Hand a patched catalog the derived structures it can reuse from the one it was layered over"""
+        if self.fuzzy and catalog is not previous:
+            # New words are only protected from correction until the next compaction indexes them
+            catalog.derived["fuzzy"] = self._fuzzy_corrector(previous).extended(catalog.delta.indexed_words())
+
+    def _change(self, change: Dict) -> CompiledCatalog:
+        """Apply one change to the live catalog (and the change log); returns the new catalog"""
+        with self._change_lock:
+            previous = self._catalog
+            catalog = apply_change(previous, change)
+            self._share_derived(previous, catalog)
+            if self._change_log is not None:
+                self._change_log.append(change, self._source_stamp)
+            self._catalog = catalog
+            self._pending.append(change)
+            due = len(self._pending) >= self.compact_after
+        if due:
+            self.compact(background=True)
+        return catalog
+
+    def add_faq(self, question: str, answer: str, **fields):
+        """
+        Add an FAQ at the end of the catalog
         
-        normalized_input = self._normalize_text(user_input)
+        Like the other catalog changes, this recompiles only the changed
+        entry; matching picks it up with the next message.
         
-        # Check FAQs - prioritize exact question matches
-        for faq in self.faq_data.get("faqs", []):
-            question = faq.get("question", "")
-            normalized_question = self._normalize_text(question)
-            
-            # Check for exact or near-exact match
-            if normalized_input == normalized_question:
-                similarity = 1.0
-            # Check if question keywords are in input
-            elif normalized_input in normalized_question or normalized_question in normalized_input:
-                similarity = 0.85
-            else:
-                similarity = self._calculate_similarity(normalized_input, normalized_question)
-            
-            if similarity > best_score and similarity >= threshold:
-                best_score = similarity
-                best_match = faq
+        Returns:
+            The new FAQ's faq_id (its "id" field, or its position)
+        """
+        catalog = self._change({"op": "add_faq", "faq": {"question": question, "answer": answer, **fields}})
+        return catalog.faq_id(len(catalog.faqs) - 1)
+    
+    def update_faq(self, faq_id, **fields):
+        """Set fields (question, answer, ...) of the FAQ with this faq_id; raises KeyError if there is none"""
+        self._change({"op": "update_faq", "faq_id": faq_id, "faq": fields})
+    
+    def remove_faq(self, faq_id):
+        """Remove the FAQ with this faq_id; later FAQs without an "id" field move up one position"""
+        self._change({"op": "remove_faq", "faq_id": faq_id})
+    
+    def add_intent_pattern(self, intent: str, pattern: str, response: Optional[str] = None):
+        """Add a pattern to an intent, creating the intent if there is none (which needs a response)"""
+        change = {"op": "add_intent_pattern", "intent": intent, "pattern": pattern}
+        if response is not None:
+            change["response"] = response
+        self._change(change)
+    
+    def update_intent_pattern(self, intent: str, pattern: str, new_pattern: str):
+        """Replace one of an intent's patterns; raises KeyError if the intent has no such pattern"""
+        self._change({"op": "update_intent_pattern", "intent": intent, "pattern": pattern,
+                      "new_pattern": new_pattern})
+    
+    def remove_intent_pattern(self, intent: str, pattern: str):
+        """Remove one of an intent's patterns; raises KeyError if the intent has no such pattern"""
+        self._change({"op": "remove_intent_pattern", "intent": intent, "pattern": pattern})
+
+    def _sharded_matcher(self, catalog: CompiledCatalog) -> ShardedMatcher:
+        """Worker pool holding the shards of a catalog, started on first use"""
+        matcher = catalog.derived.get("sharded")
+        if matcher is None:
+            with self._shard_lock:
+                matcher = catalog.derived.get("sharded")
+                if matcher is None:
+                    matcher = catalog.derived["sharded"] = ShardedMatcher(catalog.data, self.shards)
+        return matcher
+    
+    def _sharded_match(self, catalog: CompiledCatalog, normalized_inputs: List[str]
+                       ) -> List[Tuple[int, float, int, float]]:
+        """Match normalized messages on the shard workers"""
+        base = getattr(catalog, "base", None)
+        if base is None:
+            return self._sharded_matcher(catalog).match(normalized_inputs, self.FAQ_THRESHOLD, self.INTENT_THRESHOLD)
+        # The workers hold the compacted catalog: changed entries are masked
+        # there, and the changes are matched here and merged in
+        faq_hits, intent_hits = self._sharded_matcher(base).hits(
+            normalized_inputs, self.FAQ_THRESHOLD, self.INTENT_THRESHOLD, catalog.masked_faqs, catalog.masked_patterns)
+        word_sets = [frozenset(text.split()) for text in normalized_inputs]
+        faq_hits = catalog.merge_faq_hits(faq_hits, normalized_inputs, word_sets, self.FAQ_THRESHOLD)
+        intent_hits = catalog.merge_intent_hits(intent_hits, word_sets, self.INTENT_THRESHOLD)
+        return [(faq_idx, similarity, intent_idx, confidence)
+                for (faq_idx, _, similarity), (_, intent_idx, _, confidence) in zip(faq_hits, intent_hits)]
+    
+    def _fuzzy_corrector(self, catalog: CompiledCatalog) -> FuzzyCorrector:
+        """Spelling corrector over a catalog's vocabulary, built on first use"""
+        corrector = catalog.derived.get("fuzzy")
+        if corrector is None:
+            with self._fuzzy_lock:
+                corrector = catalog.derived.get("fuzzy")
+                if corrector is None:
+                    corrector = catalog.derived["fuzzy"] = FuzzyCorrector(catalog.vocabulary())
+        return corrector
+    
+    def _normalize(self, catalog: CompiledCatalog, text: str) -> str:
+        """Normalize a message for matching, correcting misspellings in fuzzy mode"""
+        normalized = normalize_text(text)
+        if self.fuzzy:
+            stats = self._stats
+            start = time.perf_counter() if stats else 0.0
+            normalized = self._fuzzy_corrector(catalog).correct(normalized)
+            if stats:
+                stats.lap("fuzzy", start)
+        return normalized
+    
+    def _normalize_text(self, text: str) -> str:
+        """Normalize text for better matching"""
+        return normalize_text(text)
+    
+    def _calculate_similarity(self, text1: str, text2: str) -> float:
+        """Calculate simple word-based similarity"""
+        words1 = frozenset(normalize_text(text1).split())
+        words2 = frozenset(normalize_text(text2).split())
+        return jaccard(words1, words2)
+    
+    def _check_greeting(self, normalized: str) -> bool:
+        """Check if normalized user input contains a greeting keyword"""
+        return "greeting" in self._catalog.keywords.match(normalized)
+    
+    def _check_goodbye(self, normalized: str) -> bool:
+        """Check if normalized user input contains a goodbye keyword"""
+        return "goodbye" in self._catalog.keywords.match(normalized)
+    
+    def _best_intent(self, catalog: CompiledCatalog, input_words: FrozenSet) -> Tuple[int, float]:
+        """Index of the best intent (or -1) and its confidence"""
+        stats = self._stats
+        if stats is None:
+            _, intent_idx, _, confidence = catalog.best_intent(input_words, self.INTENT_THRESHOLD)
+        else:
+            start = time.perf_counter()
+            shared = catalog.pattern_overlaps(input_words)
+            start = stats.lap("intent_candidates", start)
+            _, intent_idx, _, confidence = catalog.best_intent(input_words, self.INTENT_THRESHOLD, shared)
+            stats.lap("intent_score", start)
+            stats.candidates("intent", len(shared))
+        return intent_idx, confidence
+    
+    def _best_faq(self, catalog: CompiledCatalog, normalized_input: str, input_words: FrozenSet) -> Tuple[int, float]:
+        """Index of the best FAQ (or -1) and its confidence"""
+        stats = self._stats
+        if stats is None:
+            faq_idx, _, similarity = catalog.best_faq(normalized_input, input_words, self.FAQ_THRESHOLD)
+        else:
+            start = time.perf_counter()
+            shared = catalog.faq_overlaps(normalized_input, input_words)
+            start = stats.lap("faq_candidates", start)
+            faq_idx, _, similarity = catalog.best_faq(normalized_input, input_words, self.FAQ_THRESHOLD, shared)
+            stats.lap("faq_score", start)
+            stats.candidates("faq", len(shared))
+        return faq_idx, similarity
+    
+    def _match_intent(self, input_words: FrozenSet,
+                      catalog: Optional[CompiledCatalog] = None) -> Tuple[Optional[Dict], float]:
+        """
+        Match the normalized input words to an intent
         
-        return best_match if best_match else None
+        Returns:
+            The best intent (or None) and its confidence, the best plain
+            similarity over that intent's patterns
+        """
+        catalog = catalog or self._catalog
+        intent_idx, confidence = self._best_intent(catalog, input_words)
+        if intent_idx < 0:
+            return None, 0.0
+        return catalog.intents[intent_idx], confidence
+    
+    def _match_faq(self, normalized_input: str, input_words: FrozenSet,
+                   catalog: Optional[CompiledCatalog] = None) -> Tuple[Optional[Dict], float]:
+        """
+        Match the normalized input to FAQ questions
+        
+        Returns:
+            The best FAQ (or None) and its confidence, the plain word similarity
+            to its question
+        """
+        catalog = catalog or self._catalog
+        faq_idx, similarity = self._best_faq(catalog, normalized_input, input_words)
+        if faq_idx < 0:
+            return None, 0.0
+        return catalog.faqs[faq_idx], similarity
     
     def process_message(self, user_input: str, user_id: str = "default") -> Dict:
         """
         Process user message and return response
         
         Returns:
-            Dict with 'response', 'intent', 'confidence', and 'timestamp'
+            Dict with 'response', 'intent', 'confidence', 'faq_id' (the
+            answering FAQ's id or catalog position, else None) and 'timestamp'
         """
         if not user_input or not user_input.strip():
             return {
                 "response": "Please enter a message.",
                 "intent": None,
                 "confidence": 0.0,
+                "faq_id": None,
                 "timestamp": datetime.now().isoformat()
             }
         
-        # Store in conversation history
-        self.conversation_history.append({
-            "user_id": user_id,
-            "user_message": user_input,
-            "timestamp": datetime.now().isoformat()
-        })
+        stats = self._stats
+        start = time.perf_counter() if stats else 0.0
         
-        # Check for goodbye first (very specific)
-        if self._check_goodbye(user_input):
-            return {
-                "response": "Thank you for contacting us! Have a great day! 😊",
-                "intent": "goodbye",
-                "confidence": 1.0,
-                "timestamp": datetime.now().isoformat()
-            }
+        # Store in conversation history; the timestamp is formatted only when read
+        now = time.time()
+        self._history.append(user_id, HistoryEvent(user_id, user_input, now))
         
-        # Try to match FAQ first (more specific)
-        faq_match = self._match_faq(user_input)
-        faq_score = 0.0
-        if faq_match:
-            # Calculate FAQ match score
-            normalized_input = self._normalize_text(user_input)
-            normalized_question = self._normalize_text(faq_match.get("question", ""))
-            faq_score = self._calculate_similarity(normalized_input, normalized_question)
+        # Normalize once; every stage below works on these, against one catalog
+        catalog = self._current_catalog()
+        normalized_input = self._normalize(catalog, user_input)
+        input_words = catalog.encode_words(frozenset(normalized_input.split()))
+        result = self._respond(catalog, normalized_input, input_words, user_id, now=now)
+        if stats:
+            stats.lap("total", start)
+            stats.result(result["intent"], result["confidence"])
+        return result
+    
+    def process_message_async(self, user_input: str, user_id: str = "default") -> "asyncio.Task[Dict]":
+        """
+        Process a message on a worker thread without blocking the event loop
         
-        # Try to match intent
-        intent_match = self._match_intent(user_input)
-        intent_score = 0.0
-        if intent_match:
-            # Calculate intent match score
-            normalized_input = self._normalize_text(user_input)
-            best_pattern_score = 0.0
-            for pattern in intent_match.get("patterns", []):
-                score = self._calculate_similarity(normalized_input, pattern)
-                if score > best_pattern_score:
-                    best_pattern_score = score
-            intent_score = best_pattern_score
+        Must be called from the event loop thread. Returns a task to await for
+        the process_message result. Messages from the same user are processed
+        one at a time, in the order of these calls; other users' messages run
+        concurrently.
+        """
+        loop = asyncio.get_running_loop()
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.async_workers, thread_name_prefix="chatbot")
+        return self._async_queue.submit(
+            user_id, lambda: loop.run_in_executor(self._executor, self.process_message, user_input, user_id))
+    
+    def process_messages(self, batch: Iterable[Union[str, Tuple[str, str]]],
+                         user_id: str = "default", record_history: bool = True) -> List[Dict]:
+        """
+        Process a batch of messages, scoring them all against the catalog at once
         
-        # Prioritize FAQ if it has higher confidence
-        if faq_match and faq_score >= 0.4:
-            return {
-                "response": faq_match.get("answer", ""),
-                "intent": "faq",
-                "confidence": faq_score,
-                "timestamp": datetime.now().isoformat()
-            }
+        Each item is a message or a (message, user_id) pair. Results are the
+        same as calling process_message on each item in order. With
+        record_history=False (e.g. when replaying logs) the messages are not
+        added to the users' conversation history.
+        """
+        stats = self._stats
+        start = time.perf_counter() if stats else 0.0
+        items = [(item, user_id) if isinstance(item, str) else item for item in batch]
+        catalog = self._current_catalog()
+        normalized = [self._normalize(catalog, text) if text and text.strip() else None for text, _ in items]
+        pending = [idx for idx, text in enumerate(normalized) if text is not None]
+        word_sets = [catalog.encode_words(frozenset(normalized[idx].split())) for idx in pending]
         
-        # Use intent if it has good confidence
-        if intent_match and intent_score >= 0.4:
-            response = intent_match.get("response", "")
+        if self.shards > 1 and pending:
+            matches = self._sharded_match(catalog, [normalized[idx] for idx in pending])
+        elif np is None:
+            matches = [None] * len(pending)
+        else:
+            scorer = catalog.batch_scorer()
+            faq_hits = scorer.match_faqs([normalized[idx] for idx in pending], word_sets, self.FAQ_THRESHOLD)
+            intent_hits = scorer.match_intents(word_sets, self.INTENT_THRESHOLD)
+            matches = [
+                (faq_idx, faq_score, intent_idx, intent_score)
+                for (faq_idx, _, faq_score), (_, intent_idx, _, intent_score) in zip(faq_hits, intent_hits)
+            ]
+        matched = dict(zip(pending, zip(word_sets, matches)))
+        if stats and pending:
+            stats.lap("batch_match", start)
+        
+        results = []
+        for idx, (text, message_user_id) in enumerate(items):
+            if idx not in matched:
+                results.append(self.process_message(text, message_user_id))  # empty message
+                continue
+            now = time.time()
+            if record_history:
+                self._history.append(message_user_id, HistoryEvent(message_user_id, text, now))
+            input_words, match = matched[idx]
+            result = self._respond(catalog, normalized[idx], input_words, message_user_id, match, now)
+            if stats:
+                stats.result(result["intent"], result["confidence"])
+            results.append(result)
+        return results
+    
+    def _respond(self, catalog: CompiledCatalog, normalized_input: str, input_words: FrozenSet[str],
+                 user_id: str, match: Optional[Tuple[int, float, int, float]] = None,
+                 now: Optional[float] = None) -> Dict:
+        """Build the response for a normalized message, matching it unless already matched
+
+        now is the message's epoch time, formatted into the result's timestamp.
+        """
+        cache = self._response_cache
+        stats = self._stats
+        start = time.perf_counter() if stats else 0.0
+        outcome = cache.get(normalized_input, catalog.version) if cache else None
+        if stats and cache:
+            start = stats.lap("cache", start)
+        keywords: FrozenSet[str] = frozenset()
+        if outcome is None:
+            # Every keyword rule is evaluated in one pass over the input
+            keywords = catalog.keywords.match(normalized_input)
+            if stats:
+                start = stats.lap("keywords", start)
+            outcome = self._resolve(catalog, normalized_input, input_words, match, keywords)
+            # Only deterministic outcomes are cached; greeting and fallback
+            # replies are picked at random on every message
+            if cache and outcome is not None:
+                cache.put(normalized_input, catalog.version, outcome)
+        
+        timestamp = datetime.fromtimestamp(time.time() if now is None else now).isoformat()
+        if outcome is not None:
+            response, intent, confidence, personalize, faq_id = outcome
             # Handle dynamic responses
-            if "{order_id}" in response and "order_id" in self.user_context.get(user_id, {}):
-                response = response.replace("{order_id}", self.user_context[user_id]["order_id"])
-            
+            # One read of the user's context; update_user_context replaces it whole
+            context = self.user_context.get(user_id) or {}
+            if personalize and "{order_id}" in response and "order_id" in context:
+                response = response.replace("{order_id}", context["order_id"])
             return {
                 "response": response,
-                "intent": intent_match.get("name", "unknown"),
-                "confidence": intent_score,
-                "timestamp": datetime.now().isoformat()
-            }
-        
-        # Fallback to FAQ if available (lower threshold)
-        if faq_match:
-            return {
-                "response": faq_match.get("answer", ""),
-                "intent": "faq",
-                "confidence": faq_score,
-                "timestamp": datetime.now().isoformat()
+                "intent": intent,
+                "confidence": confidence,
+                "faq_id": faq_id,
+                "timestamp": timestamp
             }
         
         # Check for greetings (after other checks to avoid false positives)
-        if self._check_greeting(user_input):
+        if "greeting" in keywords:
             response = random.choice(self.greetings)
             return {
                 "response": response,
                 "intent": "greeting",
                 "confidence": 1.0,
-                "timestamp": datetime.now().isoformat()
+                "faq_id": None,
+                "timestamp": timestamp
             }
         
         # Fallback response
@@ -241,27 +653,182 @@ class CustomerSupportChatbot:
             "response": random.choice(self.fallback_responses),
             "intent": "fallback",
             "confidence": 0.0,
-            "timestamp": datetime.now().isoformat()
+            "faq_id": None,
+            "timestamp": timestamp
+        }
+    
+    def _resolve(self, catalog: CompiledCatalog, normalized_input: str, input_words: FrozenSet[str],
+                 match: Optional[Tuple[int, float, int, float]] = None,
+                 keywords: Optional[FrozenSet[str]] = None) -> Optional[Tuple[str, str, float, bool, object]]:
+        """
+        Pick the deterministic answer for a normalized message
+        
+        keywords are the catalog's keyword rules found in the message; they
+        are looked up when not given.
+        
+        Returns:
+            (response, intent, confidence, personalize, faq_id) or None when the
+            message falls through to the greeting/fallback replies. The response
+            is the raw template; personalize marks it for user_context
+            substitution. faq_id identifies the answering FAQ (its "id" field,
+            or its position in the catalog) and is None for other answers.
+        """
+        if keywords is None:
+            keywords = catalog.keywords.match(normalized_input)
+        # Check for goodbye first (very specific)
+        if "goodbye" in keywords:
+            return "Thank you for contacting us! Have a great day! 😊", "goodbye", 1.0, False, None
+        
+        if match is None and self.shards > 1:
+            stats = self._stats
+            start = time.perf_counter() if stats else 0.0
+            match = self._sharded_match(catalog, [normalized_input])[0]
+            if stats:
+                stats.lap("sharded_match", start)
+        if match is not None:
+            faq_idx, faq_score, intent_idx, intent_score = match
+        else:
+            # Try to match FAQ first (more specific)
+            faq_idx, faq_score = self._best_faq(catalog, normalized_input, input_words)
+            
+            # Try to match intent
+            intent_idx, intent_score = self._best_intent(catalog, input_words)
+        
+        # Prioritize FAQ if it has higher confidence
+        if faq_idx >= 0 and faq_score >= 0.4:
+            faq_match = catalog.faqs[faq_idx]
+            return faq_match.get("answer", ""), "faq", faq_score, False, catalog.faq_id(faq_idx)
+        
+        # Use intent if it has good confidence
+        if intent_idx >= 0 and intent_score >= 0.4:
+            intent_match = catalog.intents[intent_idx]
+            return intent_match.get("response", ""), intent_match.get("name", "unknown"), intent_score, True, None
+        
+        # Fallback to FAQ if available (lower threshold)
+        if faq_idx >= 0:
+            faq_match = catalog.faqs[faq_idx]
+            return faq_match.get("answer", ""), "faq", faq_score, False, catalog.faq_id(faq_idx)
+        
+        return None
+
+    def match_top_k(self, user_input: str, k: int = 3, min_score: float = 0.0) -> Dict[str, List[Dict]]:
+        """
+        The k best FAQs and intents for a message, e.g. for "did you mean" choices
+
+        Uses the same candidate pruning and scores as process_message, so the
+        first entry of each list is what process_message would pick at its
+        threshold. Nothing is recorded in the conversation history.
+
+        Returns:
+            Dict with 'faqs' (id, question, answer, score, confidence) and 'intents'
+            (name, response, score, confidence), best first, each holding up
+            to k entries that score above min_score
+        """
+        catalog = self._current_catalog()
+        normalized_input = self._normalize(catalog, user_input or "")
+        input_words = catalog.encode_words(frozenset(normalized_input.split()))
+        faqs = catalog.top_faqs(normalized_input, input_words, k, min_score) if k > 0 else []
+        intents = catalog.top_intents(input_words, k, min_score) if k > 0 else []
+        return {
+            "faqs": [
+                {"id": catalog.faq_id(idx), "question": catalog.faqs[idx].get("question", ""),
+                 "answer": catalog.faqs[idx].get("answer", ""), "score": score, "confidence": similarity}
+                for idx, score, similarity in faqs
+            ],
+            "intents": [
+                {"name": catalog.intents[intent_idx].get("name", "unknown"),
+                 "response": catalog.intents[intent_idx].get("response", ""),
+                 "score": score, "confidence": confidence}
+                for _, intent_idx, score, confidence in intents
+            ],
         }
+
+    def get_cache_stats(self) -> Dict:
+        """Response cache counters (all zero when the cache is disabled)"""
+        if self._response_cache is None:
+            return ResponseCache(0).stats()
+        return self._response_cache.stats()
+    
+    def set_instrumentation(self, enabled: bool):
+        """Switch stats collection on or off; switching it on starts from zero"""
+        self._stats = EngineStats() if enabled else None
+    
+    def get_stats(self) -> Dict:
+        """
+        Instrumentation collected since it was switched on
+        
+        Returns:
+            Dict with 'enabled', 'messages', per-stage timings in 'stages'
+            (count, total_ms, mean_ms, max_ms), per-intent counts in 'intents',
+            'confidence_histogram', 'candidates_histogram' (FAQ and intent
+            candidates scored per message), the response 'cache' counters and,
+            in fuzzy mode, the spelling correction cache counters in 'fuzzy'
+        """
+        stats = self._stats
+        result = (stats or EngineStats()).snapshot()
+        result["enabled"] = stats is not None
+        result["cache"] = self.get_cache_stats()
+        if self.fuzzy:
+            result["fuzzy"] = self._fuzzy_corrector(self._current_catalog()).cache_stats()
+        return result
+    
+    def update_user_context(self, user_id: str, **values):
+        """Set context values (e.g. order_id) used to personalize a user's responses"""
+        with self._context_lock:
+            # Copy-on-write, so concurrent readers see the old or the new dict
+            context = {**self.user_context.get(user_id, {}), **values}
+            self.user_context[user_id] = context
+            self._history.save_context(user_id, context)
+    
+    @property
+    def conversation_history(self) -> List[Dict]:
+        """Retained messages of all users, in arrival order (a snapshot)"""
+        return list(self._history)
     
     def get_conversation_history(self, user_id: str = "default") -> List[Dict]:
         """Get conversation history for a user"""
-        return [msg for msg in self.conversation_history if msg.get("user_id") == user_id]
+        return self._history.get(user_id)
     
     def clear_history(self, user_id: str = "default"):
         """Clear conversation history for a user"""
-        self.conversation_history = [
-            msg for msg in self.conversation_history if msg.get("user_id") != user_id
-        ]
+        self._history.clear(user_id)
+    
+    def close(self, close_history: bool = True):
+        """
+        Stop the shard and async workers, then release the history store
+
+        Messages already handed to the workers still finish. Engines sharing
+        a store (see engine_registry.py) pass close_history=False to leave it
+        open for the others.
+        """
+        catalog = self._catalog
+        for owner in (catalog, getattr(catalog, "base", None)):
+            matcher = owner.derived.pop("sharded", None) if owner is not None else None
+            if matcher is not None:
+                matcher.close()
+        executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False)
+        if close_history:
+            self._history.close()
 
 
 # Initialize global chatbot instance
 _chatbot_instance = None
+_chatbot_lock = threading.Lock()
 
 def get_chatbot() -> CustomerSupportChatbot:
     """Get or create chatbot instance (singleton pattern)"""
     global _chatbot_instance
     if _chatbot_instance is None:
-        _chatbot_instance = CustomerSupportChatbot()
+        with _chatbot_lock:
+            if _chatbot_instance is None:
+                # Long-lived front ends pick up FAQ edits without a restart;
+                # CHATBOT_HISTORY_DB keeps history and user context across restarts
+                history_db = os.getenv("CHATBOT_HISTORY_DB")
+                _chatbot_instance = CustomerSupportChatbot(
+                    auto_reload=True,
+                    history_store=SQLiteHistoryStore(history_db) if history_db else None,
+                )
     return _chatbot_instance
 
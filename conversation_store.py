@@ -0,0 +1,504 @@
+"""
+Conversation History Store
+Keeps each user's recent messages in a bounded ring buffer and forgets
+users that have been idle for too long. The in-memory store is the default;
+SQLiteHistoryStore persists history and user context across restarts.
+"""
+
+import heapq
+import json
+import logging
+import sqlite3
+import threading
+import time
+import weakref
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from datetime import datetime
+from itertools import count
+from typing import Callable, Deque, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class HistoryEvent:
+    """One message in a user's history
+
+    A slotted record, several times smaller than the equivalent dict. The
+    timestamp is kept as epoch seconds and only formatted by to_dict.
+    """
+
+    __slots__ = ("user_id", "user_message", "timestamp", "seq")
+
+    def __init__(self, user_id: str, user_message: str, timestamp: Optional[float] = None, seq: int = 0):
+        self.user_id = user_id
+        self.user_message = user_message
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.seq = seq  # arrival order, set by the store
+
+    def to_dict(self) -> Dict:
+        """The event as a dict with an ISO-format local timestamp"""
+        return {
+            "user_id": self.user_id,
+            "user_message": self.user_message,
+            "timestamp": datetime.fromtimestamp(self.timestamp).isoformat(),
+        }
+
+
+class HistoryStore(ABC):
+    """Interface of the conversation history backends
+
+    Subclasses must implement the abstract methods; the others default to
+    keeping nothing.
+    """
+
+    @abstractmethod
+    def append(self, user_id: str, event: HistoryEvent):
+        """Record a message for a user"""
+
+    @abstractmethod
+    def events(self, user_id: str) -> List[HistoryEvent]:
+        """A user's messages as records, oldest first"""
+
+    def get(self, user_id: str) -> List[Dict]:
+        """A user's messages as dicts, oldest first"""
+        return [event.to_dict() for event in self.events(user_id)]
+
+    @abstractmethod
+    def clear(self, user_id: str):
+        """Forget a user's messages"""
+
+    def evict_idle(self, now: Optional[float] = None) -> int:
+        """Drop users idle for longer than the TTL; returns how many were dropped"""
+        return 0
+
+    def load_contexts(self) -> Dict[str, Dict]:
+        """Saved user context of every user"""
+        return {}
+
+    def save_context(self, user_id: str, context: Dict):
+        """Persist a user's whole context (no-op for stores that keep nothing)"""
+
+    def load_tenants(self) -> Dict[str, str]:
+        """Saved catalog tenant of every assigned user (see engine_registry.py)"""
+        return {}
+
+    def save_tenant(self, user_id: str, tenant: str):
+        """Persist a user's tenant (no-op for stores that keep nothing)"""
+
+    def flush(self):
+        """Wait until every accepted write is stored"""
+
+    def close(self):
+        """Flush and release the store's resources"""
+
+    @abstractmethod
+    def iter_events(self) -> Iterator[HistoryEvent]:
+        """All retained messages across users as records, in arrival order"""
+
+    def __iter__(self) -> Iterator[Dict]:
+        """All retained messages across users as dicts, in arrival order"""
+        for event in self.iter_events():
+            yield event.to_dict()
+
+    @abstractmethod
+    def __len__(self) -> int:
+        """Number of retained messages across users"""
+
+
+class _Shard:
+    """A slice of the users, guarded by its own lock"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Least recently active user first, so idle users are evicted from the front
+        self.users: "OrderedDict[str, Deque[HistoryEvent]]" = OrderedDict()
+        self.last_seen: Dict[str, float] = {}
+
+
+class InMemoryHistoryStore(HistoryStore):
+    """
+    Per-user conversation history backed by ring buffers
+
+    Users are spread over independently locked shards, so concurrent callers
+    only contend when their users hash to the same shard.
+    """
+
+    def __init__(self, max_messages_per_user: int = 100, idle_ttl: Optional[float] = 86400.0,
+                 clock: Callable[[], float] = time.monotonic, shards: int = 16):
+        """
+        Args:
+            max_messages_per_user: Messages kept per user; older ones are dropped
+            idle_ttl: Seconds without activity after which a user's history is
+                evicted, or None to keep it until cleared
+            clock: Monotonic time source, replaceable in tests
+            shards: Number of independently locked user shards
+        """
+        self.max_messages_per_user = max_messages_per_user
+        self.idle_ttl = idle_ttl
+        self._clock = clock
+        self._shards = [_Shard() for _ in range(shards)]
+        self._seq = count()  # next() on itertools.count is atomic
+        # Kept so engines sharing this store (see engine_registry.py) see each other's context
+        self._contexts: Dict[str, Dict] = {}
+        self._tenants: Dict[str, str] = {}
+
+    def _shard(self, user_id: str) -> _Shard:
+        return self._shards[hash(user_id) % len(self._shards)]
+
+    def append(self, user_id: str, event: HistoryEvent):
+        """Record a message for a user"""
+        event.seq = next(self._seq)
+        shard = self._shard(user_id)
+        with shard.lock:
+            now = self._clock()
+            buffer = shard.users.get(user_id)
+            if buffer is None:
+                buffer = shard.users[user_id] = deque(maxlen=self.max_messages_per_user)
+            else:
+                shard.users.move_to_end(user_id)
+            buffer.append(event)
+            shard.last_seen[user_id] = now
+            self._evict_shard(shard, now)
+
+    def events(self, user_id: str) -> List[HistoryEvent]:
+        """A user's messages as records, oldest first"""
+        shard = self._shard(user_id)
+        with shard.lock:
+            self._evict_shard(shard, self._clock())
+            buffer = shard.users.get(user_id)
+            return list(buffer) if buffer else []
+
+    def clear(self, user_id: str):
+        """Forget a user's messages"""
+        shard = self._shard(user_id)
+        with shard.lock:
+            shard.users.pop(user_id, None)
+            shard.last_seen.pop(user_id, None)
+
+    def _evict_shard(self, shard: _Shard, now: float) -> int:
+        """Drop a shard's idle users; the caller holds its lock"""
+        if self.idle_ttl is None:
+            return 0
+        cutoff = now - self.idle_ttl
+        evicted = 0
+        while shard.users:
+            user_id = next(iter(shard.users))
+            if shard.last_seen[user_id] > cutoff:
+                break
+            del shard.users[user_id]
+            del shard.last_seen[user_id]
+            evicted += 1
+        return evicted
+
+    def evict_idle(self, now: Optional[float] = None) -> int:
+        """Drop users idle for longer than the TTL; returns how many were dropped"""
+        evicted = 0
+        for shard in self._shards:
+            with shard.lock:
+                evicted += self._evict_shard(shard, self._clock() if now is None else now)
+        return evicted
+
+    def iter_events(self) -> Iterator[HistoryEvent]:
+        """All retained messages across users as records, in arrival order"""
+        buffers = []
+        for shard in self._shards:
+            with shard.lock:
+                buffers.extend(list(buffer) for buffer in shard.users.values())
+        return heapq.merge(*buffers, key=lambda event: event.seq)
+
+    def load_contexts(self) -> Dict[str, Dict]:
+        """Saved user context of every user"""
+        return dict(self._contexts)
+
+    def save_context(self, user_id: str, context: Dict):
+        """Keep a user's whole context (replaced, never mutated, by the engine)"""
+        self._contexts[user_id] = context
+
+    def load_tenants(self) -> Dict[str, str]:
+        """Saved catalog tenant of every assigned user"""
+        return dict(self._tenants)
+
+    def save_tenant(self, user_id: str, tenant: str):
+        """Keep a user's tenant"""
+        self._tenants[user_id] = tenant
+
+    def __len__(self) -> int:
+        total = 0
+        for shard in self._shards:
+            with shard.lock:
+                total += sum(len(buffer) for buffer in shard.users.values())
+        return total
+
+
+class _Writer:
+    """Write-behind queue drained by a background thread in batched transactions
+
+    Kept apart from SQLiteHistoryStore so the thread and the finalizer hold
+    no reference to the store itself.
+    """
+
+    def __init__(self, path: str, max_messages_per_user: int, idle_ttl: Optional[float],
+                 batch_size: int, flush_interval: float, clock: Callable[[], float]):
+        self.max_messages_per_user = max_messages_per_user
+        self.idle_ttl = idle_ttl
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.clock = clock
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.cond = threading.Condition()
+        self.queue: List[Tuple] = []
+        self.enqueued = 0
+        self.written = 0
+        # user -> number of their latest queued operation, until it is written
+        self.pending_users: Dict[str, int] = {}
+        self.flushing = 0
+        self.stopping = False
+        self.next_eviction = 0.0
+        self.thread = threading.Thread(target=self.run, name="history-writer", daemon=True)
+        self.thread.start()
+
+    def put(self, op: Tuple):
+        with self.cond:
+            self.queue.append(op)
+            self.enqueued += 1
+            if op[0] in ("append", "clear"):
+                self.pending_users[op[1]] = self.enqueued
+            if len(self.queue) == 1 or len(self.queue) >= self.batch_size:
+                self.cond.notify_all()
+
+    def wait_written(self, user_id: Optional[str] = None):
+        """Block until everything queued so far (or just user_id's messages) has been written"""
+        with self.cond:
+            target = self.enqueued if user_id is None else self.pending_users.get(user_id, 0)
+            self.flushing += 1
+            self.cond.notify_all()
+            while self.written < target and self.thread.is_alive():
+                self.cond.wait()
+            self.flushing -= 1
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.stopping:
+                    self.cond.wait()
+                if not self.queue:
+                    return
+                # Let a batch build up unless a reader is waiting for it
+                deadline = time.monotonic() + self.flush_interval
+                while len(self.queue) < self.batch_size and not self.flushing and not self.stopping:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                batch = self.queue[:self.batch_size]
+                del self.queue[:len(batch)]
+            try:
+                self.write(batch)
+            except sqlite3.Error:
+                logger.exception("Could not write %d history records", len(batch))
+            with self.cond:
+                self.written += len(batch)
+                for op in batch:
+                    if (op[0] in ("append", "clear")
+                            and self.pending_users.get(op[1], self.written + 1) <= self.written):
+                        del self.pending_users[op[1]]
+                self.cond.notify_all()
+
+    def write(self, batch: List[Tuple]):
+        """Apply queued operations in order, in one transaction"""
+        appended: Dict[str, float] = {}  # user -> latest message time in this batch
+        with self.conn:
+            for op in batch:
+                if op[0] == "append":
+                    _, user_id, created, message = op
+                    self.conn.execute(
+                        "INSERT INTO messages (user_id, created, message) VALUES (?, ?, ?)",
+                        (user_id, created, message))
+                    appended[user_id] = max(created, appended.get(user_id, created))
+                elif op[0] == "clear":
+                    self.conn.execute("DELETE FROM messages WHERE user_id = ?", (op[1],))
+                    self.conn.execute("DELETE FROM user_activity WHERE user_id = ?", (op[1],))
+                    appended.pop(op[1], None)
+                elif op[0] == "context":
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO user_context (user_id, context) VALUES (?, ?)",
+                        (op[1], op[2]))
+                elif op[0] == "tenant":
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO user_tenant (user_id, tenant) VALUES (?, ?)",
+                        (op[1], op[2]))
+            self.conn.executemany(
+                "INSERT INTO user_activity (user_id, last_seen) VALUES (?, ?) ON CONFLICT (user_id) "
+                "DO UPDATE SET last_seen = MAX(last_seen, excluded.last_seen)", appended.items())
+            # Keep only each user's latest messages
+            for user_id in appended:
+                self.conn.execute(
+                    "DELETE FROM messages WHERE user_id = ? AND seq <= "
+                    "(SELECT seq FROM messages WHERE user_id = ? ORDER BY seq DESC LIMIT 1 OFFSET ?)",
+                    (user_id, user_id, self.max_messages_per_user))
+            if self.idle_ttl is not None and self.clock() >= self.next_eviction:
+                self.next_eviction = self.clock() + min(self.idle_ttl, 60.0)
+                _evict_users(self.conn, self.clock() - self.idle_ttl)
+
+    def stop(self):
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+        self.thread.join()
+        self.conn.close()
+
+
+def _evict_users(conn: sqlite3.Connection, cutoff: float) -> int:
+    """Delete the messages of users whose latest message is older than cutoff; returns the user count"""
+    # Both lookups are indexed, so eviction never scans the messages table
+    idle = conn.execute("SELECT user_id FROM user_activity WHERE last_seen <= ?", (cutoff,)).fetchall()
+    conn.executemany("DELETE FROM messages WHERE user_id = ?", idle)
+    conn.execute("DELETE FROM user_activity WHERE last_seen <= ?", (cutoff,))
+    return len(idle)
+
+
+class SQLiteHistoryStore(HistoryStore):
+    """
+    Conversation history and user context persisted in a SQLite database
+
+    The database runs in WAL mode, so readers never block the writer. Appends
+    only queue the message; a background thread writes queued messages in
+    batched transactions, off the request path. Reads first wait for the
+    queued writes they depend on (a user's history only for that user's), so
+    they always see earlier writes, and are served by an index on
+    (user_id, seq). Each user's latest activity is kept in an indexed table,
+    so idle eviction never scans the messages.
+    """
+
+    def __init__(self, path: str, max_messages_per_user: int = 100, idle_ttl: Optional[float] = None,
+                 batch_size: int = 256, flush_interval: float = 0.2, clock: Callable[[], float] = time.time):
+        """
+        Args:
+            path: Database file, created if missing
+            max_messages_per_user: Messages kept per user; older ones are deleted
+            idle_ttl: Seconds without activity after which a user's history is
+                deleted, or None to keep it until cleared
+            batch_size: Most queued writes committed in one transaction
+            flush_interval: Longest time a write waits for its batch to fill
+            clock: Wall-clock time source for idle eviction
+        """
+        self.path = path
+        self.max_messages_per_user = max_messages_per_user
+        self.idle_ttl = idle_ttl
+        self._clock = clock
+        with sqlite3.connect(path) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            has_activity = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'user_activity'").fetchone()
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS messages (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    message TEXT NOT NULL  -- the user's text
+                );
+                CREATE INDEX IF NOT EXISTS messages_by_user ON messages (user_id, seq);
+                CREATE TABLE IF NOT EXISTS user_context (
+                    user_id TEXT PRIMARY KEY,
+                    context TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS user_tenant (
+                    user_id TEXT PRIMARY KEY,
+                    tenant TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS user_activity (
+                    user_id TEXT PRIMARY KEY,
+                    last_seen REAL NOT NULL  -- time of the user's latest message
+                );
+                CREATE INDEX IF NOT EXISTS user_activity_by_time ON user_activity (last_seen);
+            """)
+            if not has_activity:
+                # Databases from before the activity table: one scan, once
+                conn.execute("INSERT OR IGNORE INTO user_activity (user_id, last_seen) "
+                             "SELECT user_id, MAX(created) FROM messages GROUP BY user_id")
+        conn.close()
+        self._writer = _Writer(path, max_messages_per_user, idle_ttl, batch_size, flush_interval, clock)
+        self._writer.conn.execute("PRAGMA synchronous=NORMAL")
+        # Read connections, one per thread
+        self._local = threading.local()
+        self._readers: List[sqlite3.Connection] = []
+        self._readers_lock = threading.Lock()
+        self._finalizer = weakref.finalize(self, SQLiteHistoryStore._shutdown, self._writer, self._readers)
+
+    @staticmethod
+    def _shutdown(writer: _Writer, readers: List[sqlite3.Connection]):
+        writer.stop()
+        for conn in readers:
+            conn.close()
+
+    def _reader(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path, check_same_thread=False)
+            with self._readers_lock:
+                self._readers.append(conn)
+        return conn
+
+    def _query(self, sql: str, params: Tuple = (), user_id: Optional[str] = None) -> List[Tuple]:
+        """Run a read once the queued writes it depends on (all, or user_id's) are committed"""
+        self._writer.wait_written(user_id)
+        return self._reader().execute(sql, params).fetchall()
+
+    def append(self, user_id: str, event: HistoryEvent):
+        """Queue a message for a user; it is written in the background"""
+        self._writer.put(("append", user_id, event.timestamp, event.user_message))
+
+    def events(self, user_id: str) -> List[HistoryEvent]:
+        """A user's messages as records, oldest first"""
+        rows = self._query(
+            "SELECT seq, created, message FROM messages WHERE user_id = ? ORDER BY seq DESC LIMIT ?",
+            (user_id, self.max_messages_per_user), user_id)
+        return [HistoryEvent(user_id, message, created, seq) for seq, created, message in reversed(rows)]
+
+    def clear(self, user_id: str):
+        """Forget a user's messages"""
+        self._writer.put(("clear", user_id))
+
+    def evict_idle(self, now: Optional[float] = None) -> int:
+        """Delete users idle for longer than the TTL; returns how many were dropped"""
+        if self.idle_ttl is None:
+            return 0
+        self.flush()
+        conn = self._reader()
+        with conn:
+            return _evict_users(conn, (self._clock() if now is None else now) - self.idle_ttl)
+
+    def load_contexts(self) -> Dict[str, Dict]:
+        """Saved user context of every user"""
+        return {user_id: json.loads(context)
+                for user_id, context in self._query("SELECT user_id, context FROM user_context")}
+
+    def save_context(self, user_id: str, context: Dict):
+        """Queue a user's whole context to be saved"""
+        self._writer.put(("context", user_id, json.dumps(context, ensure_ascii=False)))
+
+    def load_tenants(self) -> Dict[str, str]:
+        """Saved catalog tenant of every assigned user"""
+        return dict(self._query("SELECT user_id, tenant FROM user_tenant"))
+
+    def save_tenant(self, user_id: str, tenant: str):
+        """Queue a user's tenant to be saved"""
+        self._writer.put(("tenant", user_id, tenant))
+
+    def flush(self):
+        """Wait until every queued write is committed"""
+        self._writer.wait_written()
+
+    def close(self):
+        """Write everything still queued and close the database"""
+        self._finalizer()
+
+    def iter_events(self) -> Iterator[HistoryEvent]:
+        """All retained messages across users as records, in arrival order"""
+        for seq, user_id, created, message in self._query(
+                "SELECT seq, user_id, created, message FROM messages ORDER BY seq"):
+            yield HistoryEvent(user_id, message, created, seq)
+
+    def __len__(self) -> int:
+        return self._query("SELECT COUNT(*) FROM messages")[0][0]
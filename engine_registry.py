@@ -0,0 +1,255 @@
+"""
+Engine Registry
+Serves several FAQ catalogs (per brand, per language, ...) from one process.
+Each tenant's engine is loaded on first use, and the least recently used
+ones are dropped when the loaded catalogs exceed a memory budget.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from chatbot_engine import CustomerSupportChatbot
+from conversation_store import HistoryStore, InMemoryHistoryStore, SQLiteHistoryStore
+
+# Bytes of compiled catalog per byte of FAQ JSON, measured on synthetic
+# catalogs of 1k to 50k FAQs
+COMPILED_BYTES_PER_SOURCE_BYTE = 14
+
+
+def estimate_engine_bytes(engine: CustomerSupportChatbot) -> int:
+    """Rough memory held by an engine's catalog
+
+    A snapshot catalog costs at most its mapped file; a compiled one grows
+    with the size of its JSON source.
+    """
+    mapped = getattr(engine._catalog, "_mmap", None)
+    if mapped is not None:
+        return len(mapped)
+    try:
+        return os.path.getsize(engine.faq_file) * COMPILED_BYTES_PER_SOURCE_BYTE
+    except OSError:
+        return 0
+
+
+class EngineRegistry:
+    """
+    Lazily loaded chatbot engines, one per tenant, under a memory budget
+
+    A tenant is a name mapped to a catalog file (through catalogs, or
+    catalog_dir/<name>.json), or a catalog path itself. All engines share
+    one history store and one user context map, so evicting a cold tenant
+    loses neither conversation history nor user context, and their catalogs
+    share interned words. Users' tenants are kept apart from their context
+    and saved in the same store, so assignments survive restarts.
+    """
+
+    def __init__(self, catalogs: Optional[Dict[str, str]] = None, catalog_dir: Optional[str] = None,
+                 default_tenant: str = "default", memory_budget_mb: float = 512.0,
+                 history_store: Optional[HistoryStore] = None, **engine_options):
+        """
+        Args:
+            catalogs: Tenant name -> FAQ JSON file
+            catalog_dir: Directory searched for <tenant>.json when a tenant is
+                not in catalogs
+            default_tenant: Tenant of users that were never assigned one
+            memory_budget_mb: Estimated catalog memory above which the least
+                recently used engines are evicted; the engine in use is always kept
+            history_store: Store shared by all engines; defaults to an
+                InMemoryHistoryStore
+            engine_options: Further CustomerSupportChatbot arguments
+        """
+        self.catalogs = dict(catalogs or {})
+        self.catalog_dir = catalog_dir
+        self.default_tenant = default_tenant
+        self.memory_budget = int(memory_budget_mb * 1024 * 1024)
+        self.history_store = history_store if history_store is not None else InMemoryHistoryStore()
+        self.engine_options = engine_options
+        # Shared by every engine, so a context update is seen by all tenants
+        self.user_context: Dict[str, Dict] = self.history_store.load_contexts()
+        self._context_lock = threading.Lock()
+        # User -> tenant; users never assigned one get the default tenant
+        self.assignments: Dict[str, str] = self.history_store.load_tenants()
+        self._lock = threading.Lock()
+        self._engines: "OrderedDict[str, CustomerSupportChatbot]" = OrderedDict()  # coldest first
+        self._sizes: Dict[str, int] = {}
+        # Held while a tenant loads; dropped once its engine is in _engines
+        self._load_locks: Dict[str, threading.Lock] = {}
+        self.loads = 0
+        self.evictions = 0
+
+    def catalog_path(self, tenant: str) -> str:
+        """The FAQ file of a tenant; raises KeyError for unknown tenants"""
+        if tenant in self.catalogs:
+            return self.catalogs[tenant]
+        if self.catalog_dir:
+            path = os.path.join(self.catalog_dir, f"{tenant}.json")
+            if os.path.exists(path):
+                return path
+        if tenant.endswith(".json") and os.path.exists(tenant):
+            return tenant
+        raise KeyError(f"Unknown tenant: {tenant}")
+
+    def tenants(self) -> List[str]:
+        """Every known tenant name"""
+        names = set(self.catalogs)
+        if self.catalog_dir and os.path.isdir(self.catalog_dir):
+            names.update(name[:-5] for name in os.listdir(self.catalog_dir) if name.endswith(".json"))
+        return sorted(names)
+
+    def get(self, tenant: Optional[str] = None) -> CustomerSupportChatbot:
+        """The tenant's engine, loading it (and evicting cold ones) if needed"""
+        tenant = tenant or self.default_tenant
+        with self._lock:
+            engine = self._engines.get(tenant)
+            if engine is not None:
+                self._engines.move_to_end(tenant)
+                return engine
+        path = self.catalog_path(tenant)  # unknown tenants never get a load lock
+        with self._lock:
+            load_lock = self._load_locks.setdefault(tenant, threading.Lock())
+        # Load outside the registry lock so other tenants stay available
+        with load_lock:
+            with self._lock:
+                engine = self._engines.get(tenant)
+                if engine is not None:
+                    self._engines.move_to_end(tenant)
+                    return engine
+            try:
+                engine = CustomerSupportChatbot(path, history_store=self.history_store,
+                                                user_context=self.user_context, context_lock=self._context_lock,
+                                                **self.engine_options)
+            except BaseException:
+                with self._lock:
+                    self._load_locks.pop(tenant, None)
+                raise
+            size = estimate_engine_bytes(engine)
+            with self._lock:
+                # Callers waiting on this lock recheck _engines above; later
+                # ones find the engine before reaching it
+                self._load_locks.pop(tenant, None)
+                loaded = self._engines.get(tenant)
+                if loaded is None:
+                    self._engines[tenant] = engine
+                    self._sizes[tenant] = size
+                    self.loads += 1
+                    evicted = self._evict_over_budget()
+                else:
+                    # Loaded meanwhile under a newer lock, after ours was dropped
+                    self._engines.move_to_end(tenant)
+                    engine, evicted = loaded, [engine]
+        self._close_engines(evicted)
+        return engine
+
+    def _evict_over_budget(self) -> List[CustomerSupportChatbot]:
+        """Drop the coldest engines until within budget and return them; the caller holds the lock"""
+        evicted = []
+        while len(self._engines) > 1 and sum(self._sizes.values()) > self.memory_budget:
+            tenant, engine = self._engines.popitem(last=False)
+            del self._sizes[tenant]
+            self.evictions += 1
+            evicted.append(engine)
+        return evicted
+
+    @staticmethod
+    def _close_engines(engines: List[CustomerSupportChatbot]):
+        """Stop the workers of dropped engines, leaving the shared history store open"""
+        for engine in engines:
+            engine.close(close_history=False)
+
+    def evict(self, tenant: str) -> bool:
+        """Unload a tenant's engine; it is reloaded on next use"""
+        with self._lock:
+            engine = self._engines.pop(tenant, None)
+            if engine is None:
+                return False
+            del self._sizes[tenant]
+            self.evictions += 1
+        self._close_engines([engine])
+        return True
+
+    def assign(self, user_id: str, tenant: str):
+        """Route a user's messages to a tenant (raises KeyError for unknown tenants)"""
+        self.catalog_path(tenant)
+        with self._lock:
+            self.assignments[user_id] = tenant
+            self.history_store.save_tenant(user_id, tenant)
+
+    def tenant_of(self, user_id: str) -> str:
+        """The tenant a user is routed to"""
+        return self.assignments.get(user_id, self.default_tenant)
+
+    def route(self, user_id: str) -> CustomerSupportChatbot:
+        """The engine that answers a user; may load it, so call it off the event loop"""
+        tenant = self.tenant_of(user_id)
+        try:
+            return self.get(tenant)
+        except KeyError:
+            # A saved assignment can outlive its catalog
+            return self.get(self.default_tenant)
+
+    def loaded(self) -> List[str]:
+        """Tenants with a loaded engine, least recently used first"""
+        with self._lock:
+            return list(self._engines)
+
+    def stats(self) -> Dict:
+        """Loaded tenants, estimated memory against the budget, loads and evictions"""
+        with self._lock:
+            return {
+                "loaded": list(self._engines),
+                "estimated_mb": sum(self._sizes.values()) / (1024 * 1024),
+                "budget_mb": self.memory_budget / (1024 * 1024),
+                "loads": self.loads,
+                "evictions": self.evictions,
+            }
+
+    def close(self):
+        """Close every engine and the shared history store"""
+        with self._lock:
+            engines = list(self._engines.values())
+            self._engines.clear()
+            self._sizes.clear()
+        self._close_engines(engines)
+        self.history_store.close()
+
+
+_registry: Optional[EngineRegistry] = None
+_registry_lock = threading.Lock()
+
+
+def _parse_catalogs(spec: str) -> Dict[str, str]:
+    """Parse "name=path,name=path" into a dict"""
+    catalogs = {}
+    for item in spec.split(","):
+        name, sep, path = item.partition("=")
+        if sep and name.strip() and path.strip():
+            catalogs[name.strip()] = path.strip()
+    return catalogs
+
+
+def get_registry(**engine_options) -> EngineRegistry:
+    """
+    Get or create the process-wide registry
+
+    Configured from the environment: CHATBOT_CATALOGS ("brand-a=a.json,es=es.json"),
+    CHATBOT_CATALOG_DIR, CHATBOT_MEMORY_BUDGET_MB and CHATBOT_HISTORY_DB. The
+    default tenant uses faq_data.json unless CHATBOT_CATALOGS names it.
+    engine_options only apply when the registry is first created.
+    """
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                catalogs = {"default": "faq_data.json", **_parse_catalogs(os.getenv("CHATBOT_CATALOGS", ""))}
+                history_db = os.getenv("CHATBOT_HISTORY_DB")
+                engine_options.setdefault("auto_reload", True)
+                _registry = EngineRegistry(
+                    catalogs,
+                    catalog_dir=os.getenv("CHATBOT_CATALOG_DIR") or None,
+                    memory_budget_mb=float(os.getenv("CHATBOT_MEMORY_BUDGET_MB", "512")),
+                    history_store=SQLiteHistoryStore(history_db) if history_db else None,
+                    **engine_options,
+                )
+    return _registry
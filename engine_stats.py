@@ -0,0 +1,126 @@
+"""
+Engine Statistics
+Per-stage timers, per-intent counters and confidence / candidate histograms
+collected while the chatbot processes messages
+"""
+
+import threading
+import time
+from collections import Counter
+from typing import Dict, List
+
+# Upper edges of the confidence histogram buckets
+CONFIDENCE_BUCKETS = [round(0.1 * i, 1) for i in range(1, 11)]
+
+
+def _candidate_bucket(count: int) -> str:
+    """Power-of-two bucket label for a candidate count: 0, 1, 2-3, 4-7, ..."""
+    if count < 2:
+        return str(count)
+    low = 1 << (count.bit_length() - 1)
+    return f"{low}-{2 * low - 1}"
+
+
+class EngineStats:
+    """Thread-safe collector for the chatbot's instrumentation
+
+    Only touched when instrumentation is switched on; each record is a few
+    dict updates under one lock.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forget everything collected so far"""
+        with self._lock:
+            self.messages = 0
+            self.started = time.time()
+            self._stage_count: Counter = Counter()
+            self._stage_total: Dict[str, float] = {}
+            self._stage_max: Dict[str, float] = {}
+            self._intents: Counter = Counter()
+            self._confidence = [0] * len(CONFIDENCE_BUCKETS)
+            self._candidates: Dict[str, Counter] = {"faq": Counter(), "intent": Counter()}
+
+    def lap(self, stage: str, start: float) -> float:
+        """Record the time since start against a stage; returns the current time"""
+        now = time.perf_counter()
+        elapsed = now - start
+        with self._lock:
+            self._stage_count[stage] += 1
+            self._stage_total[stage] = self._stage_total.get(stage, 0.0) + elapsed
+            if elapsed > self._stage_max.get(stage, 0.0):
+                self._stage_max[stage] = elapsed
+        return now
+
+    def candidates(self, kind: str, count: int):
+        """Record how many FAQ or intent candidates were scored for a message"""
+        with self._lock:
+            self._candidates[kind][_candidate_bucket(count)] += 1
+
+    def result(self, intent: str, confidence: float):
+        """Record the outcome of a message"""
+        bucket = min(int(confidence * 10), len(CONFIDENCE_BUCKETS) - 1)
+        with self._lock:
+            self.messages += 1
+            self._intents[intent or "none"] += 1
+            self._confidence[bucket] += 1
+
+    def snapshot(self) -> Dict:
+        """Copy of the collected statistics, with times in milliseconds"""
+        with self._lock:
+            stages = {}
+            for stage, count in self._stage_count.items():
+                total = self._stage_total[stage]
+                stages[stage] = {
+                    "count": count,
+                    "total_ms": total * 1000,
+                    "mean_ms": total * 1000 / count,
+                    "max_ms": self._stage_max.get(stage, 0.0) * 1000,
+                }
+            low = 0.0
+            confidence = {}
+            for high, count in zip(CONFIDENCE_BUCKETS, self._confidence):
+                confidence[f"{low:.1f}-{high:.1f}"] = count
+                low = high
+            return {
+                "messages": self.messages,
+                "uptime_s": time.time() - self.started,
+                "stages": stages,
+                "intents": dict(self._intents.most_common()),
+                "confidence_histogram": confidence,
+                "candidates_histogram": {
+                    kind: dict(sorted(counts.items(), key=lambda item: int(item[0].split("-")[0])))
+                    for kind, counts in self._candidates.items()
+                },
+            }
+
+
+def format_stats(stats: Dict, top_intents: int = 10) -> str:
+    """Plain-text summary of get_stats() output for chat and log messages"""
+    if not stats.get("enabled"):
+        return "Stats collection is off."
+    lines: List[str] = [f"Messages: {stats['messages']}"]
+    if stats["stages"]:
+        lines.append("Stages (mean / max ms):")
+        for stage, timing in sorted(stats["stages"].items(), key=lambda item: -item[1]["total_ms"]):
+            lines.append(f"  {stage}: {timing['mean_ms']:.3f} / {timing['max_ms']:.3f} ({timing['count']}x)")
+    if stats["intents"]:
+        intents = list(stats["intents"].items())
+        shown = ", ".join(f"{name} {count}" for name, count in intents[:top_intents])
+        if len(intents) > top_intents:
+            shown += f", {len(intents) - top_intents} more"
+        lines.append("Intents: " + shown)
+    buckets = [f"{bucket} {count}" for bucket, count in stats["confidence_histogram"].items() if count]
+    if buckets:
+        lines.append("Confidence: " + ", ".join(buckets))
+    for kind, counts in stats["candidates_histogram"].items():
+        if counts:
+            label = "FAQ" if kind == "faq" else kind.capitalize()
+            lines.append(f"{label} candidates: " + ", ".join(f"{b} {n}" for b, n in counts.items()))
+    cache = stats.get("cache", {})
+    if cache.get("max_size"):
+        lines.append(f"Cache: {cache['hits']} hits, {cache['misses']} misses, {cache['size']}/{cache['max_size']} entries")
+    return "\n".join(lines)
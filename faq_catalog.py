@@ -0,0 +1,752 @@
+"""
+Compiled FAQ Catalog
+Pre-normalizes and pre-tokenizes FAQ questions and intent patterns once,
+and builds the inverted indexes used for candidate retrieval and the
+greeting/goodbye keyword matcher
+"""
+
+import heapq
+import re
+from sys import intern
+from bisect import bisect_right
+from collections import Counter
+from itertools import chain, count
+from typing import Dict, FrozenSet, Iterable, Iterator, List, Optional, Sequence, Set, Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None  # numpy is optional; batch matching falls back to per-message scoring
+
+_NON_WORD = re.compile(r'[^\w\s]')
+_versions = count(1)
+
+
+def next_catalog_version() -> int:
+    """Unique id for a newly built catalog"""
+    return next(_versions)
+
+
+def normalize_text(text: str) -> str:
+    """Normalize text for better matching"""
+    text = text.lower().strip()
+    # Remove special characters but keep spaces
+    return _NON_WORD.sub('', text)
+
+
+def jaccard(words1: FrozenSet[str], words2: FrozenSet[str]) -> float:
+    """Word-set similarity, identical to CustomerSupportChatbot._calculate_similarity"""
+    if not words1 or not words2:
+        return 0.0
+    shared = len(words1 & words2)
+    return shared / (len(words1) + len(words2) - shared)
+
+
+# Used for any rule the FAQ data's "keywords" section does not define
+DEFAULT_KEYWORDS: Dict[str, List[str]] = {
+    "greeting": [
+        "hi", "hello", "hey", "greetings", "good morning",
+        "good afternoon", "good evening", "sup", "what's up",
+    ],
+    "goodbye": [
+        "bye", "goodbye", "see you", "farewell", "exit",
+        "quit", "thanks", "thank you", "done",
+    ],
+}
+
+
+def keyword_config(data: Dict) -> Dict[str, List[str]]:
+    """Keyword lists per rule: the defaults, overridden by data["keywords"]"""
+    config = dict(DEFAULT_KEYWORDS)
+    config.update(data.get("keywords") or {})
+    return config
+
+
+class KeywordRules:
+    """
+    Named keyword sets matched as whole words or phrases
+
+    Keywords are normalized like the input, so "what's up" matches
+    "whats up" and "done" no longer matches inside "abandoned".
+    """
+
+    def __init__(self, rules: Dict[str, Iterable[str]]):
+        self.config: Dict[str, List[str]] = {name: list(keywords) for name, keywords in rules.items()}
+        phrases: Dict[str, set] = {}
+        for name, keywords in self.config.items():
+            for keyword in keywords:
+                phrase = " ".join(normalize_text(keyword).split())
+                if phrase:
+                    phrases.setdefault(phrase, set()).add(name)
+        # At each word the regex reports only the longest phrase starting
+        # there, so a phrase also carries the rules of the phrases it starts
+        # with ("thank you" implies "thank")
+        self._rules: Dict[str, FrozenSet[str]] = {}
+        for phrase in phrases:
+            words = phrase.split()
+            names = set()
+            for end in range(1, len(words) + 1):
+                names |= phrases.get(" ".join(words[:end]), set())
+            self._rules[phrase] = frozenset(names)
+        self.names = frozenset(name for names in self._rules.values() for name in names)
+
+        alternatives = sorted(self._rules, key=len, reverse=True)
+        if alternatives:
+            body = "|".join(r"\s+".join(map(re.escape, phrase.split())) for phrase in alternatives)
+            # Zero-width lookahead so overlapping keywords are all seen
+            self._pattern = re.compile(rf"\b(?=({body})\b)")
+        else:
+            self._pattern = None
+
+    def match(self, normalized: str) -> FrozenSet[str]:
+        """Names of the rules with a keyword in the normalized text"""
+        if self._pattern is None:
+            return frozenset()
+        found: FrozenSet[str] = frozenset()
+        for hit in self._pattern.finditer(normalized):
+            found |= self._rules[" ".join(hit.group(1).split())]
+            if found == self.names:
+                break
+        return found
+
+
+_MISSING = object()
+
+
+def compile_question(question: str) -> Tuple[str, List[str]]:
+    """Normalized question and its words"""
+    normalized = normalize_text(question)
+    # Interned, so catalogs loaded side by side share one copy of each word
+    return normalized, [intern(word) for word in normalized.split()]
+
+
+def compile_pattern(pattern: str) -> Tuple[FrozenSet[str], FrozenSet[str]]:
+    """Normalized and raw word sets of an intent pattern (the same set when they are equal)"""
+    words = frozenset(intern(word) for word in normalize_text(pattern).split())
+    raw_words = frozenset(intern(word) for word in pattern.split())
+    return words, words if raw_words == words else raw_words
+
+
+class CatalogEntry:
+    """Slotted record of a catalog entry, read like the dict it came from
+
+    Known fields live in slots; any other keys of the source dict are kept
+    in extra (None when there are none).
+    """
+
+    __slots__ = ("extra",)
+    FIELDS: Tuple[str, ...] = ()
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "CatalogEntry":
+        entry = cls.__new__(cls)
+        for field in cls.FIELDS:
+            setattr(entry, field, data.get(field))
+        entry.extra = {key: value for key, value in data.items() if key not in cls.FIELDS} or None
+        return entry
+
+    def get(self, key: str, default=None):
+        if key in self.FIELDS:
+            value = getattr(self, key)
+            return default if value is None else value
+        return self.extra.get(key, default) if self.extra else default
+
+    def __getitem__(self, key: str):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def to_dict(self) -> Dict:
+        """The entry as a plain dict, as in faq_data.json"""
+        data = {field: getattr(self, field) for field in self.FIELDS if getattr(self, field) is not None}
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+
+class FAQEntry(CatalogEntry):
+    __slots__ = ("question", "answer")
+    FIELDS = ("question", "answer")
+
+
+class IntentEntry(CatalogEntry):
+    __slots__ = ("name", "patterns", "response")
+    FIELDS = ("name", "patterns", "response")
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "IntentEntry":
+        entry = super().from_dict(data)
+        if entry.patterns is not None:
+            entry.patterns = tuple(entry.patterns)
+        return entry
+
+    def to_dict(self) -> Dict:
+        data = super().to_dict()
+        if self.patterns is not None:
+            data["patterns"] = list(self.patterns)
+        return data
+
+
+class CompiledCatalog:
+    """Immutable, pre-tokenized view of the FAQ data
+
+    Built once per catalog load; matching only reads from it. Entries are
+    kept as slotted records rather than the source dicts; data rebuilds the
+    dict layout on demand.
+    """
+
+    def __init__(self, data: Dict):
+        # Unique per compiled catalog; anything derived from the FAQ data is
+        # keyed on it so it is dropped when the data changes
+        self.version = next_catalog_version()
+        self.faqs: List[FAQEntry] = [FAQEntry.from_dict(faq) for faq in data.get("faqs", [])]
+        self.intents: List[IntentEntry] = [IntentEntry.from_dict(intent) for intent in data.get("intents", [])]
+        # Top-level sections other than the entries (e.g. keywords)
+        self._settings = {key: value for key, value in data.items() if key not in ("faqs", "intents")}
+        self.keywords = KeywordRules(keyword_config(data))
+
+        self.faq_questions: List[str] = []
+        self.faq_words: List[FrozenSet[str]] = []
+        self.faq_sizes: List[int] = []
+        # First slot of each FAQ "id" and intent name, for changes addressed by them
+        self.faq_ids: Dict[object, int] = {}
+        self.intent_slots: Dict[str, int] = {}
+        faq_index: Dict[str, List[int]] = {}
+        faq_short = []
+        for idx, faq in enumerate(self.faqs):
+            normalized_question, words = compile_question(faq.get("question", ""))
+            faq_id = faq.get("id", _MISSING)
+            if faq_id is not _MISSING:
+                self.faq_ids.setdefault(faq_id, idx)
+            self.faq_questions.append(normalized_question)
+            self.faq_words.append(frozenset(words))
+            self.faq_sizes.append(len(self.faq_words[-1]))
+            for word in set(words):
+                faq_index.setdefault(word, []).append(idx)
+            # A question with fewer than three words can be a substring of the
+            # input without sharing a whole word with it, so always score it
+            if len(words) < 3:
+                faq_short.append(idx)
+        self.faq_index: Dict[str, Tuple[int, ...]] = {
+            word: tuple(ids) for word, ids in faq_index.items()
+        }
+        self.faq_short: Tuple[int, ...] = tuple(faq_short)
+
+        # All questions in one string so substring lookups run in a single
+        # str.find pass; normalized text never contains the NUL separator
+        self.faq_corpus = "\x00".join(self.faq_questions)
+        self.faq_starts: List[int] = []
+        offset = 0
+        for question in self.faq_questions:
+            self.faq_starts.append(offset)
+            offset += len(question) + 1
+
+        # Intent patterns flattened in catalog order; ties go to the earliest
+        self.pattern_intent: List[int] = []
+        self.pattern_words: List[FrozenSet[str]] = []
+        self.pattern_sizes: List[int] = []
+        self.pattern_raw_words: List[FrozenSet[str]] = []
+        raw_patterns = []
+        intent_index: Dict[str, List[int]] = {}
+        for intent_idx, intent in enumerate(self.intents):
+            self.intent_slots.setdefault(intent.get("name"), intent_idx)
+            for pattern in intent.get("patterns", []):
+                idx = len(self.pattern_intent)
+                words, raw_words = compile_pattern(pattern)
+                self.pattern_intent.append(intent_idx)
+                self.pattern_words.append(words)
+                self.pattern_sizes.append(len(words))
+                # Raw words drive the subset check, normalized words the similarity.
+                # A raw word can only be an input word if it is also a normalized
+                # pattern word, so the index only needs the normalized ones.
+                if raw_words is not words:
+                    raw_patterns.append(idx)
+                self.pattern_raw_words.append(raw_words)
+                for word in words:
+                    intent_index.setdefault(word, []).append(idx)
+        self.intent_index: Dict[str, Tuple[int, ...]] = {
+            word: tuple(ids) for word, ids in intent_index.items()
+        }
+        self.raw_patterns: FrozenSet[int] = frozenset(raw_patterns)
+        self._batch_scorer = None
+        # Other structures derived from this catalog, owned by their builders
+        self.derived: Dict[str, object] = {}
+
+    @property
+    def data(self) -> Dict:
+        """The FAQ data in the faq_data.json layout, rebuilt from the records"""
+        return {
+            **self._settings,
+            "intents": [intent.to_dict() for intent in self.intents],
+            "faqs": [faq.to_dict() for faq in self.faqs],
+        }
+
+    def faq_id(self, idx: int):
+        """Id reported for an FAQ: its "id" field, or its position in the catalog"""
+        return self.faqs[idx].get("id", idx)
+
+    def extended(self, faqs: Sequence[FAQEntry] = (), intents: Sequence[IntentEntry] = ()) -> "CompiledCatalog":
+        """
+        A new catalog with entries appended to these
+
+        Only the new entries are compiled. The containers are copied rather
+        than shared, so this suits small catalogs like a PatchedCatalog's
+        delta; this catalog is left unchanged.
+        """
+        catalog = CompiledCatalog.__new__(CompiledCatalog)
+        catalog.version = next_catalog_version()
+        catalog.keywords = self.keywords
+        catalog._settings = self._settings
+        catalog.faqs = list(self.faqs) + list(faqs)
+        catalog.intents = list(self.intents) + list(intents)
+        catalog.faq_ids = dict(self.faq_ids)
+        catalog.intent_slots = dict(self.intent_slots)
+
+        catalog.faq_questions = list(self.faq_questions)
+        catalog.faq_words = list(self.faq_words)
+        catalog.faq_sizes = list(self.faq_sizes)
+        catalog.faq_starts = list(self.faq_starts)
+        faq_index = dict(self.faq_index)
+        faq_short = list(self.faq_short)
+        corpus = [self.faq_corpus] if self.faq_questions else []
+        offset = len(self.faq_corpus) + 1 if self.faq_questions else 0
+        for idx, faq in enumerate(faqs, len(self.faqs)):
+            normalized_question, words = compile_question(faq.get("question", ""))
+            faq_id = faq.get("id", _MISSING)
+            if faq_id is not _MISSING:
+                catalog.faq_ids.setdefault(faq_id, idx)
+            catalog.faq_questions.append(normalized_question)
+            catalog.faq_words.append(frozenset(words))
+            catalog.faq_sizes.append(len(catalog.faq_words[-1]))
+            for word in set(words):
+                faq_index[word] = faq_index.get(word, ()) + (idx,)
+            if len(words) < 3:
+                faq_short.append(idx)
+            corpus.append(normalized_question)
+            catalog.faq_starts.append(offset)
+            offset += len(normalized_question) + 1
+        catalog.faq_index = faq_index
+        catalog.faq_short = tuple(faq_short)
+        catalog.faq_corpus = "\x00".join(corpus)
+
+        catalog.pattern_intent = list(self.pattern_intent)
+        catalog.pattern_words = list(self.pattern_words)
+        catalog.pattern_sizes = list(self.pattern_sizes)
+        catalog.pattern_raw_words = list(self.pattern_raw_words)
+        raw_patterns = set(self.raw_patterns)
+        intent_index = dict(self.intent_index)
+        for intent_idx, intent in enumerate(intents, len(self.intents)):
+            catalog.intent_slots.setdefault(intent.get("name"), intent_idx)
+            for pattern in intent.get("patterns", []):
+                idx = len(catalog.pattern_intent)
+                words, raw_words = compile_pattern(pattern)
+                catalog.pattern_intent.append(intent_idx)
+                catalog.pattern_words.append(words)
+                catalog.pattern_sizes.append(len(words))
+                if raw_words is not words:
+                    raw_patterns.add(idx)
+                catalog.pattern_raw_words.append(raw_words)
+                for word in words:
+                    intent_index[word] = intent_index.get(word, ()) + (idx,)
+        catalog.intent_index = intent_index
+        catalog.raw_patterns = frozenset(raw_patterns)
+        catalog._batch_scorer = None
+        catalog.derived = {}
+        return catalog
+
+    def batch_scorer(self) -> "BatchScorer":
+        """Sparse matrix view of the catalog, built on first use (requires numpy)"""
+        if self._batch_scorer is None:
+            self._batch_scorer = BatchScorer(self)
+        return self._batch_scorer
+
+    def warm(self, previous: "CompiledCatalog"):
+        """Build the derived structures that were in use on the previous catalog"""
+        if previous._batch_scorer is not None:
+            self.batch_scorer()
+
+    def indexed_words(self) -> Set[str]:
+        """Words of the question and pattern indexes"""
+        return set(self.faq_index) | set(self.intent_index)
+
+    def vocabulary(self) -> Set[str]:
+        """Every word that can match: indexed question and pattern words, and keyword words"""
+        words = self.indexed_words()
+        for phrases in self.keywords.config.values():
+            for phrase in phrases:
+                words.update(normalize_text(phrase).split())
+        return words
+
+    def encode_words(self, words: FrozenSet[str]) -> FrozenSet[str]:
+        """Input words in the form the word sets and indexes are keyed on"""
+        return words
+
+    def find_in_questions(self, text: str) -> Iterable[int]:
+        """Yield indexes of FAQs whose normalized question contains text"""
+        starts = self.faq_starts
+        pos = self.faq_corpus.find(text) if starts else -1
+        while pos != -1:
+            idx = bisect_right(starts, pos) - 1
+            yield idx
+            if idx + 1 >= len(starts):
+                break
+            pos = self.faq_corpus.find(text, starts[idx + 1])
+
+    def faq_overlaps(self, normalized_input: str, input_words: FrozenSet) -> Dict[int, int]:
+        """
+        Shared word counts for every FAQ that may score above zero
+
+        FAQs that can only match through the substring rule are included
+        with a count of zero.
+        """
+        shared: Dict[int, int] = Counter()
+        for word in input_words:
+            shared.update(self.faq_index.get(word, ()))
+        extra = [self.faq_short]
+        # An input with three or more words can only be inside a question if
+        # its middle word is a whole question word, which the index covers
+        if len(normalized_input.split(None, 2)) < 3:
+            extra.append(self.find_in_questions(normalized_input))
+        for idx in chain.from_iterable(extra):
+            if idx not in shared:
+                shared[idx] = 0
+        return shared
+
+    def pattern_overlaps(self, input_words: FrozenSet) -> Dict[int, int]:
+        """Shared word counts for every intent pattern sharing a word with the input"""
+        shared: Dict[int, int] = Counter()
+        for word in input_words:
+            shared.update(self.intent_index.get(word, ()))
+        return shared
+
+    def pattern_scores(self, input_words: FrozenSet,
+                       shared: Optional[Dict[int, int]] = None) -> Iterator[Tuple[int, float, float]]:
+        """
+        Score the pattern_overlaps candidates (or the given ones) in catalog order
+
+        Yields:
+            (pattern index, score, similarity) per candidate. The score is 0.9
+            when all of the pattern's words are in the input, otherwise the
+            plain word similarity.
+        """
+        n_input = len(input_words)
+        if shared is None:
+            shared = self.pattern_overlaps(input_words)
+        for idx in sorted(shared):
+            common = shared[idx]
+            size = self.pattern_sizes[idx]
+            similarity = common / (n_input + size - common)
+            score = similarity
+            # If all pattern words are in input, it's a strong match
+            if idx in self.raw_patterns:
+                pattern_words = self.pattern_raw_words[idx]
+                if pattern_words and pattern_words <= input_words:
+                    score = 0.9
+            elif common == size:
+                score = 0.9  # High confidence for keyword match
+            yield idx, score, similarity
+
+    def best_faq(self, normalized_input: str, input_words: FrozenSet, threshold: float,
+                 shared: Optional[Dict[int, int]] = None) -> Tuple[int, float, float]:
+        """
+        Best FAQ for a normalized input
+
+        Returns:
+            (index, score, similarity) of the first FAQ with the highest score
+            at or above the threshold, or (-1, 0.0, 0.0)
+        """
+        best = self.top_faqs(normalized_input, input_words, 1, threshold, shared)
+        return best[0] if best else (-1, 0.0, 0.0)
+
+    def best_intent(self, input_words: FrozenSet, threshold: float,
+                    shared: Optional[Dict[int, int]] = None) -> Tuple[int, int, float, float]:
+        """
+        Best intent for the normalized input words
+
+        Returns:
+            (pattern index, intent index, score, confidence) for the first
+            pattern with the highest score at or above the threshold, or
+            (-1, -1, 0.0, 0.0). Confidence is the best plain similarity over
+            all of that intent's patterns.
+        """
+        best_pattern = -1
+        best_score = 0.0
+        # Patterns outside the candidates share no word with the input and score zero
+        intent_scores: Dict[int, float] = {}
+        pattern_intent = self.pattern_intent
+
+        # Check intents - try exact keyword matching first
+        for idx, score, similarity in self.pattern_scores(input_words, shared):
+            intent_idx = pattern_intent[idx]
+            if similarity > intent_scores.get(intent_idx, 0.0):
+                intent_scores[intent_idx] = similarity
+            if score > best_score and score >= threshold:
+                best_score = score
+                best_pattern = idx
+
+        if best_pattern < 0:
+            return -1, -1, 0.0, 0.0
+        intent_idx = pattern_intent[best_pattern]
+        return best_pattern, intent_idx, best_score, intent_scores.get(intent_idx, 0.0)
+
+    def top_faqs(self, normalized_input: str, input_words: FrozenSet, k: int, threshold: float = 0.0,
+                 shared: Optional[Dict[int, int]] = None) -> List[Tuple[int, float, float]]:
+        """
+        The k best FAQs among the faq_overlaps candidates (or the given ones)
+
+        Returns:
+            (index, score, similarity) of up to k FAQs scoring above zero and
+            at or above the threshold, best first; ties keep catalog order.
+            The score ranks exact and substring matches first; similarity is
+            the plain word similarity.
+        """
+        n_input = len(input_words)
+        if shared is None:
+            shared = self.faq_overlaps(normalized_input, input_words)
+        # Bounded min-heap of the k best so far. floor is the score to beat:
+        # zero until the heap is full, then its root, so most candidates cost
+        # one comparison and ties keep the earlier entry.
+        heap: List[Tuple[float, int, float]] = []
+        floor = 0.0
+
+        # Check FAQs - prioritize exact question matches
+        for idx in sorted(shared):
+            common = shared[idx]
+            size = self.faq_sizes[idx]
+            similarity = common / (n_input + size - common) if n_input and size else 0.0
+            normalized_question = self.faq_questions[idx]
+
+            # Check for exact or near-exact match
+            if normalized_input == normalized_question:
+                score = 1.0
+            # Check if question keywords are in input
+            elif normalized_input in normalized_question or normalized_question in normalized_input:
+                score = 0.85
+            else:
+                score = similarity
+
+            if score > floor and score >= threshold:
+                if len(heap) < k:
+                    heapq.heappush(heap, (score, -idx, similarity))
+                    if len(heap) == k:
+                        floor = heap[0][0]
+                else:
+                    heapq.heapreplace(heap, (score, -idx, similarity))
+                    floor = heap[0][0]
+
+        return [(-neg_idx, score, similarity) for score, neg_idx, similarity in sorted(heap, reverse=True)]
+
+    def top_intents(self, input_words: FrozenSet, k: int, threshold: float = 0.0,
+                    shared: Optional[Dict[int, int]] = None) -> List[Tuple[int, int, float, float]]:
+        """
+        The k best intents, best first, each ranked by its best pattern
+
+        Returns:
+            (pattern index, intent index, score, confidence) per intent, as
+            best_intent would report it if that intent stood alone
+        """
+        best: Dict[int, Tuple[int, float]] = {}
+        confidence: Dict[int, float] = {}
+        pattern_intent = self.pattern_intent
+        for idx, score, similarity in self.pattern_scores(input_words, shared):
+            intent_idx = pattern_intent[idx]
+            if similarity > confidence.get(intent_idx, 0.0):
+                confidence[intent_idx] = similarity
+            if score > 0 and score >= threshold and score > best.get(intent_idx, (-1, 0.0))[1]:
+                best[intent_idx] = (idx, score)
+        heap: List[Tuple[float, int, int]] = []
+        for intent_idx, (pattern, score) in best.items():
+            if len(heap) < k:
+                heapq.heappush(heap, (score, -pattern, intent_idx))
+            elif (score, -pattern) > heap[0][:2]:
+                heapq.heapreplace(heap, (score, -pattern, intent_idx))
+        return [(-neg_pattern, intent_idx, score, confidence.get(intent_idx, 0.0))
+                for score, neg_pattern, intent_idx in sorted(heap, reverse=True)]
+
+
+class BatchScorer:
+    """Scores many inputs against the catalog with sparse token-incidence matrices
+
+    Each catalog side (questions, patterns) is stored as a token -> entry
+    incidence matrix in compressed-column form. Word-overlap counts for a
+    batch are the sparse product of the input incidence rows with it, and
+    union sizes follow from the row and column sums, so the only per-pair
+    Python work left is verifying the few substring candidates.
+    """
+
+    # Upper bound on dense score cells and gathered postings per chunk
+    CHUNK_CELLS = 1 << 22
+
+    def __init__(self, catalog: CompiledCatalog):
+        if np is None:
+            raise ImportError("numpy is required for batch matching")
+        self.catalog = catalog
+        self.vocab: Dict[str, int] = {}
+        for words in chain(catalog.faq_words, catalog.pattern_words):
+            for word in words:
+                self.vocab.setdefault(word, len(self.vocab))
+
+        self.faq_ptr, self.faq_ids = self._incidence(catalog.faq_words)
+        self.faq_sizes = np.asarray(catalog.faq_sizes, dtype=np.int64)
+        self.faq_lengths = np.array([len(q) for q in catalog.faq_questions], dtype=np.int64)
+        # Distinct inner words: a question of three or more words can only be
+        # inside the input if all of them are input words
+        inner = [frozenset(q.split()[1:-1]) for q in catalog.faq_questions]
+        self.faq_inner = np.array([len(words) for words in inner], dtype=np.int64)
+        self.faq_long = np.array([len(q.split(None, 2)) == 3 for q in catalog.faq_questions], dtype=bool)
+
+        self.pattern_ptr, self.pattern_ids = self._incidence(catalog.pattern_words)
+        self.pattern_sizes = np.asarray(catalog.pattern_sizes, dtype=np.int64)
+        # Patterns whose raw words differ from the normalized ones need the
+        # subset check done on the raw words
+        self.raw_patterns = sorted(catalog.raw_patterns)
+        self.plain_subset = np.ones(len(catalog.pattern_words), dtype=bool)
+        self.plain_subset[self.raw_patterns] = False
+        self.intent_ranges: List[Tuple[int, int]] = []
+        pattern_intent = catalog.pattern_intent
+        start = 0
+        for intent_idx in range(len(catalog.intents)):
+            end = start
+            while end < len(pattern_intent) and pattern_intent[end] == intent_idx:
+                end += 1
+            self.intent_ranges.append((start, end))
+            start = end
+
+    def _incidence(self, word_sets: Sequence[FrozenSet[str]]) -> Tuple["np.ndarray", "np.ndarray"]:
+        """Token -> entry incidence matrix in compressed-column form"""
+        columns: List[List[int]] = [[] for _ in range(len(self.vocab))]
+        for idx, words in enumerate(word_sets):
+            for word in words:
+                columns[self.vocab[word]].append(idx)
+        ptr = np.zeros(len(columns) + 1, dtype=np.int64)
+        ptr[1:] = np.cumsum([len(col) for col in columns])
+        ids = np.fromiter((idx for col in columns for idx in col), dtype=np.int64, count=int(ptr[-1]))
+        return ptr, ids
+
+    def _overlaps(self, word_sets: Sequence[FrozenSet[str]], col_ptr: "np.ndarray",
+                  col_ids: "np.ndarray", n_entries: int) -> Iterator[Tuple[int, "np.ndarray"]]:
+        """Yield (first row, dense overlap counts) for chunks of the batch"""
+        rows = [[self.vocab[w] for w in words if w in self.vocab] for words in word_sets]
+        col_len = np.diff(col_ptr)
+        row_cost = [int(col_len[tokens].sum()) if tokens else 0 for tokens in rows]
+        start = 0
+        while start < len(rows):
+            end, cost = start, 0
+            while end < len(rows) and (end == start or (
+                    cost + row_cost[end] <= self.CHUNK_CELLS and
+                    (end - start + 1) * n_entries <= self.CHUNK_CELLS)):
+                cost += row_cost[end]
+                end += 1
+            chunk = rows[start:end]
+            tokens = np.fromiter((t for r in chunk for t in r), dtype=np.int64)
+            row_of = np.repeat(np.arange(len(chunk), dtype=np.int64), [len(r) for r in chunk])
+            lengths = col_len[tokens]
+            total = int(lengths.sum())
+            # Gather every posting of every input token: the nonzeros of the product
+            first = np.repeat(col_ptr[tokens] - np.cumsum(lengths) + lengths, lengths)
+            entries = col_ids[first + np.arange(total, dtype=np.int64)]
+            keys = np.repeat(row_of, lengths) * n_entries + entries
+            counts = np.bincount(keys, minlength=len(chunk) * n_entries)
+            yield start, counts.reshape(len(chunk), n_entries)
+            start = end
+
+    @staticmethod
+    def _similarity(shared: "np.ndarray", input_size: "np.ndarray",
+                    entry_sizes: "np.ndarray") -> "np.ndarray":
+        """Jaccard scores from overlap counts and set sizes"""
+        union = input_size[:, None] + entry_sizes[None, :] - shared
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scores = shared / union
+        scores[(input_size[:, None] == 0) | (entry_sizes[None, :] == 0)] = 0.0
+        return scores
+
+    @staticmethod
+    def _best(scores: "np.ndarray", threshold: float) -> int:
+        """First index of the best score at or above the threshold, or -1"""
+        if not len(scores):
+            return -1
+        idx = int(np.argmax(scores))
+        return idx if scores[idx] >= threshold else -1
+
+    def match_faqs(self, normalized_inputs: Sequence[str], word_sets: Sequence[FrozenSet[str]],
+                   threshold: float, masked: Sequence[int] = ()) -> List[Tuple[int, float, float]]:
+        """(index, score, similarity) of the best FAQ for each input, as in CompiledCatalog.best_faq
+
+        FAQs listed in masked are never picked.
+        """
+        catalog = self.catalog
+        masked = np.asarray(masked, dtype=np.int64)
+        n_faqs = len(catalog.faqs)
+        results: List[Tuple[int, float, float]] = []
+        if not n_faqs:
+            return [(-1, 0.0, 0.0)] * len(word_sets)
+        for start, shared in self._overlaps(word_sets, self.faq_ptr, self.faq_ids, n_faqs):
+            chunk = range(start, start + len(shared))
+            input_size = np.array([len(word_sets[i]) for i in chunk], dtype=np.int64)
+            similarity = self._similarity(shared, input_size, self.faq_sizes)
+            for row, i in enumerate(chunk):
+                text = normalized_inputs[i]
+                words = text.split()
+                scores = similarity[row].copy()
+                # Exact and substring matches outrank plain similarity
+                if len(words) < 3:
+                    inside = set(catalog.find_in_questions(text))
+                else:
+                    inside = np.flatnonzero(
+                        (self.faq_lengths >= len(text)) &
+                        (shared[row] >= len(frozenset(words[1:-1])))).tolist()
+                contains = np.flatnonzero(
+                    (self.faq_lengths <= len(text)) &
+                    (~self.faq_long | (shared[row] >= self.faq_inner))).tolist()
+                for idx in set(inside).union(contains):
+                    question = catalog.faq_questions[idx]
+                    if text == question:
+                        scores[idx] = 1.0
+                    elif text in question or question in text:
+                        scores[idx] = 0.85
+                scores[masked] = -1.0
+                best = self._best(scores, threshold)
+                if best < 0:
+                    results.append((-1, 0.0, 0.0))
+                else:
+                    results.append((best, float(scores[best]), float(similarity[row, best])))
+        return results
+
+    def match_intents(self, word_sets: Sequence[FrozenSet[str]], threshold: float,
+                      masked: Sequence[int] = ()) -> List[Tuple[int, int, float, float]]:
+        """(pattern, intent, score, confidence) of the best intent for each input, as in CompiledCatalog.best_intent
+
+        Patterns listed in masked are never picked; they must make up whole intents.
+        """
+        catalog = self.catalog
+        masked = np.asarray(masked, dtype=np.int64)
+        n_patterns = len(catalog.pattern_words)
+        results: List[Tuple[int, int, float, float]] = []
+        if not n_patterns:
+            return [(-1, -1, 0.0, 0.0)] * len(word_sets)
+        for start, shared in self._overlaps(word_sets, self.pattern_ptr, self.pattern_ids, n_patterns):
+            chunk = range(start, start + len(shared))
+            input_size = np.array([len(word_sets[i]) for i in chunk], dtype=np.int64)
+            similarity = self._similarity(shared, input_size, self.pattern_sizes)
+            # All pattern words present in the input is a strong keyword match
+            subset = (shared == self.pattern_sizes[None, :]) & (self.pattern_sizes > 0)[None, :]
+            scores = np.where(subset & self.plain_subset[None, :], 0.9, similarity)
+            for row, i in enumerate(chunk):
+                for idx in self.raw_patterns:
+                    raw_words = catalog.pattern_raw_words[idx]
+                    if raw_words and raw_words <= word_sets[i]:
+                        scores[row, idx] = 0.9
+                scores[row, masked] = -1.0
+                best = self._best(scores[row], threshold)
+                if best < 0:
+                    results.append((-1, -1, 0.0, 0.0))
+                    continue
+                intent_idx = catalog.pattern_intent[best]
+                first, last = self.intent_ranges[intent_idx]
+                results.append((best, intent_idx, float(scores[row, best]),
+                                float(similarity[row, first:last].max())))
+        return results
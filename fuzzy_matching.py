@@ -0,0 +1,136 @@
+"""
+Fuzzy Matching
+Corrects misspelled input words to catalog words ("refnd" -> "refund")
+using a character-trigram index and a bounded edit distance
+"""
+
+import copy
+from collections import Counter
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+def _trigrams(word: str) -> List[str]:
+    """Trigrams of a word padded with one boundary marker on each side"""
+    padded = f"${word}$"
+    return [padded[i:i + 3] for i in range(len(padded) - 2)]
+
+
+def bounded_edit_distance(a: str, b: str, limit: int) -> int:
+    """
+    Edit distance between a and b (insertions, deletions, substitutions and
+    adjacent transpositions), or limit + 1 once it is known to exceed limit
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous2: List[int] = []
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            value = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                value = min(value, previous2[j - 2] + 1)
+            current[j] = value
+        if min(current) > limit:
+            return limit + 1
+        previous2, previous = previous, current
+    return min(previous[-1], limit + 1)
+
+
+class FuzzyCorrector:
+    """
+    Maps input words missing from the catalog vocabulary to the closest
+    catalog word
+
+    Catalog words are indexed by (length, trigram), so a lookup only touches
+    words of a compatible length that share a trigram with the input word,
+    never the whole vocabulary. Those candidates are filtered by how many
+    trigrams they share before the edit distance is computed, with a cutoff
+    at the allowed distance. Results, including "no correction", are cached.
+    """
+
+    def __init__(self, vocabulary: Iterable[str], min_length: int = 4, cache_size: int = 10000):
+        """
+        Args:
+            vocabulary: Catalog words (normalized)
+            min_length: Shorter input words are never corrected
+            cache_size: Corrections remembered
+        """
+        self.min_length = min_length
+        self.words: List[str] = sorted(set(vocabulary))
+        self._known = frozenset(self.words)
+        index: Dict[Tuple[int, str], List[int]] = {}
+        for idx, word in enumerate(self.words):
+            for gram in set(_trigrams(word)):
+                index.setdefault((len(word), gram), []).append(idx)
+        self._index: Dict[Tuple[int, str], Tuple[int, ...]] = {key: tuple(ids) for key, ids in index.items()}
+        self.cache_size = cache_size
+        self._cached_correction = lru_cache(cache_size)(self._correction)
+
+    def extended(self, words: Iterable[str]) -> "FuzzyCorrector":
+        """
+        A corrector that also leaves words alone, sharing this one's index
+
+        Used when a few catalog entries change: their new words are never
+        corrected away, but typos of them are only corrected by a corrector
+        built over the full vocabulary.
+        """
+        new_words = set(words) - self._known
+        if not new_words:
+            return self
+        corrector = copy.copy(self)
+        corrector._known = self._known | new_words
+        corrector._cached_correction = lru_cache(self.cache_size)(corrector._correction)
+        return corrector
+
+    @staticmethod
+    def max_distance(word: str) -> int:
+        """Edits allowed when correcting a word of this length"""
+        return 1 if len(word) < 8 else 2
+
+    def correct_word(self, word: str) -> str:
+        """The closest catalog word within the allowed distance, or word itself"""
+        if word in self._known or len(word) < self.min_length or not word.isalpha():
+            return word
+        return self._cached_correction(word)
+
+    def _correction(self, word: str) -> str:
+        return self._closest(word) or word
+
+    def _closest(self, word: str) -> Optional[str]:
+        limit = self.max_distance(word)
+        grams = set(_trigrams(word))
+        shared: Counter = Counter()
+        for length in range(max(1, len(word) - limit), len(word) + limit + 1):
+            for gram in grams:
+                shared.update(self._index.get((length, gram), ()))
+        # Each edit changes at most four trigram occurrences (a transposition
+        # touches four), so closer words must share at least this many
+        needed = max(1, len(grams) - 4 * limit)
+        best: Optional[Tuple[int, int, str]] = None
+        for idx, common in shared.items():
+            if common < needed:
+                continue
+            candidate = self.words[idx]
+            distance = bounded_edit_distance(word, candidate, limit)
+            if distance > limit:
+                continue
+            # Fewest edits, then most shared trigrams, then alphabetical
+            key = (distance, -common, candidate)
+            if best is None or key < best:
+                best = key
+                limit = distance
+        return best[2] if best else None
+
+    def correct(self, normalized: str) -> str:
+        """Normalized text with misspelled words replaced by catalog words"""
+        words = normalized.split()
+        corrected = [self.correct_word(word) for word in words]
+        return " ".join(corrected) if corrected != words else normalized
+
+    def cache_stats(self) -> Dict[str, int]:
+        """Hit, miss and size counters of the correction cache"""
+        info = self._cached_correction.cache_info()
+        return {"hits": info.hits, "misses": info.misses, "size": info.currsize, "max_size": info.maxsize}
@@ -0,0 +1,302 @@
+"""
+HTTP/JSON Service
+Serves the chatbot to other backend services over HTTP/1.1 with keep-alive,
+using only asyncio
+
+Endpoints:
+    POST /message  {"message": "...", "user_id": "..."}  -> process_message result
+    POST /batch    {"messages": ["...", {"message": "...", "user_id": "..."}],
+                    "user_id": "...", "record_history": true}  -> {"results": [...]}
+    GET  /health   -> {"status": "ok", "queued": n}
+    GET  /stats    -> get_stats()
+
+Run with: python http_server.py --port 8080
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from chatbot_engine import CustomerSupportChatbot, get_chatbot
+
+logger = logging.getLogger(__name__)
+
+REASONS = {
+    200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+    408: "Request Timeout", 411: "Length Required", 413: "Payload Too Large",
+    431: "Request Header Fields Too Large", 500: "Internal Server Error",
+    503: "Service Unavailable",
+}
+
+
+class HTTPError(Exception):
+    """A request that is answered with an error status"""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class ChatServer:
+    """
+    asyncio HTTP server in front of one chatbot engine
+
+    Requests are parsed on the event loop; matching runs on a pool of worker
+    threads fed from a bounded queue. When the queue is full new work is
+    refused at once with 503 and a Retry-After header instead of piling up,
+    so callers see backpressure rather than growing latency. Connections are
+    kept alive between requests until the client closes them or they sit
+    idle for idle_timeout seconds.
+    """
+
+    def __init__(self, chatbot: CustomerSupportChatbot, host: str = "127.0.0.1", port: int = 8080,
+                 workers: Optional[int] = None, queue_size: int = 256, idle_timeout: float = 30.0,
+                 max_body: int = 1 << 20, max_batch: int = 1000):
+        """
+        Args:
+            chatbot: Engine to serve
+            host, port: Address to listen on; port 0 picks a free port
+            workers: Worker threads doing the matching; defaults to the CPU count
+            queue_size: Requests waiting for a worker before new ones get 503
+            idle_timeout: Seconds a kept-alive connection may wait for its next request
+            max_body: Largest accepted request body in bytes
+            max_batch: Most messages accepted by one /batch request
+        """
+        self.chatbot = chatbot
+        self.host = host
+        self.port = port
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.queue_size = queue_size
+        self.idle_timeout = idle_timeout
+        self.max_body = max_body
+        self.max_batch = max_batch
+        self._queue: Optional[asyncio.Queue] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._worker_tasks: List[asyncio.Task] = []
+        self._connections: Set[asyncio.Task] = set()
+        self.rejected = 0
+
+    async def start(self):
+        """Start listening; self.port holds the bound port afterwards"""
+        self._queue = asyncio.Queue(self.queue_size)
+        self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="chat-http")
+        self._worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def serve_forever(self):
+        if self._server is None:
+            await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def close(self):
+        """Stop accepting connections, drop open ones and shut the workers down"""
+        if self._server is not None:
+            self._server.close()
+        tasks = list(self._connections) + self._worker_tasks
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._worker_tasks = []
+        if self._server is not None:
+            await self._server.wait_closed()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+    async def _worker(self):
+        """Run queued jobs on the thread pool, one at a time"""
+        loop = asyncio.get_running_loop()
+        while True:
+            func, args, future = await self._queue.get()
+            try:
+                if not future.cancelled():
+                    result = await loop.run_in_executor(self._executor, func, *args)
+                    if not future.cancelled():
+                        future.set_result(result)
+            except Exception as e:
+                if not future.cancelled():
+                    future.set_exception(e)
+            finally:
+                self._queue.task_done()
+
+    async def _submit(self, func: Callable, *args):
+        """Queue a job for the workers and wait for its result; 503 when the queue is full"""
+        future = asyncio.get_running_loop().create_future()
+        try:
+            self._queue.put_nowait((func, args, future))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise HTTPError(503, "Server busy, retry later")
+        return await future
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(self._read_request(reader), self.idle_timeout)
+                except asyncio.TimeoutError:
+                    break
+                except HTTPError as e:
+                    await self._write_response(writer, e.status, {"error": str(e)}, keep_alive=False)
+                    break
+                if request is None:
+                    break
+                method, path, headers, body, keep_alive = request
+                try:
+                    status, payload = 200, await self._dispatch(method, path, body)
+                except HTTPError as e:
+                    status, payload = e.status, {"error": str(e)}
+                except Exception:
+                    logger.exception("Error handling %s %s", method, path)
+                    status, payload = 500, {"error": "Internal server error"}
+                await self._write_response(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> Optional[Tuple[str, str, Dict[str, str], bytes, bool]]:
+        """Parse one request; None when the client closed the connection"""
+        try:
+            line = await reader.readline()
+        except ValueError:  # longer than the stream limit
+            raise HTTPError(431, "Request line too long")
+        if not line:
+            return None
+        parts = line.decode("latin-1").split()
+        if len(parts) != 3 or not parts[2].startswith("HTTP/1."):
+            raise HTTPError(400, "Malformed request line")
+        method, path, version = parts
+        headers: Dict[str, str] = {}
+        while True:
+            try:
+                line = await reader.readline()
+            except ValueError:
+                raise HTTPError(431, "Header line too long")
+            if line in (b"\r\n", b"\n", b""):
+                break
+            if len(headers) >= 100:
+                raise HTTPError(431, "Too many headers")
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        if "chunked" in headers.get("transfer-encoding", "").lower():
+            raise HTTPError(411, "Chunked bodies are not supported; send Content-Length")
+        try:
+            length = int(headers.get("content-length", "0"))
+        except ValueError:
+            raise HTTPError(400, "Invalid Content-Length")
+        if length < 0 or length > self.max_body:
+            raise HTTPError(413, f"Body larger than {self.max_body} bytes")
+        body = await reader.readexactly(length) if length else b""
+
+        connection = headers.get("connection", "").lower()
+        keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+        return method, path.split("?", 1)[0], headers, body, keep_alive
+
+    async def _dispatch(self, method: str, path: str, body: bytes) -> Dict:
+        """Route a request to its endpoint"""
+        if path == "/health":
+            self._expect(method, "GET")
+            return {"status": "ok", "queued": self._queue.qsize(), "rejected": self.rejected}
+        if path == "/stats":
+            self._expect(method, "GET")
+            return self.chatbot.get_stats()
+        if path == "/message":
+            self._expect(method, "POST")
+            data = self._json(body)
+            message = data.get("message")
+            if not isinstance(message, str):
+                raise HTTPError(400, "'message' must be a string")
+            return await self._submit(self.chatbot.process_message, message,
+                                      str(data.get("user_id", "default")))
+        if path == "/batch":
+            self._expect(method, "POST")
+            data = self._json(body)
+            messages = data.get("messages")
+            if not isinstance(messages, list):
+                raise HTTPError(400, "'messages' must be a list")
+            if len(messages) > self.max_batch:
+                raise HTTPError(413, f"At most {self.max_batch} messages per batch")
+            user_id = str(data.get("user_id", "default"))
+            record_history = data.get("record_history", True)
+            if not isinstance(record_history, bool):
+                raise HTTPError(400, "'record_history' must be true or false")
+            batch = []
+            for position, item in enumerate(messages):
+                message = item.get("message") if isinstance(item, dict) else item
+                if not isinstance(message, str):
+                    raise HTTPError(400, f"Message {position} must be a string or have a string 'message'")
+                batch.append((message, str(item.get("user_id", user_id))) if isinstance(item, dict) else message)
+            results = await self._submit(self.chatbot.process_messages, batch, user_id, record_history)
+            return {"results": results}
+        raise HTTPError(404, f"No endpoint {path}")
+
+    @staticmethod
+    def _expect(method: str, allowed: str):
+        if method != allowed:
+            raise HTTPError(405, f"Use {allowed}")
+
+    @staticmethod
+    def _json(body: bytes) -> Dict:
+        try:
+            data = json.loads(body or b"{}")
+        except ValueError:
+            raise HTTPError(400, "Body is not valid JSON")
+        if not isinstance(data, dict):
+            raise HTTPError(400, "Body must be a JSON object")
+        return data
+
+    async def _write_response(self, writer: asyncio.StreamWriter, status: int, payload: Dict, keep_alive: bool):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        head = [
+            f"HTTP/1.1 {status} {REASONS.get(status, '')}",
+            "Content-Type: application/json",
+            f"Content-Length: {len(body)}",
+            "Connection: " + ("keep-alive" if keep_alive else "close"),
+        ]
+        if status == 503:
+            head.append("Retry-After: 1")
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Serve get_chatbot() over HTTP"""
+    parser = argparse.ArgumentParser(description="Serve the chatbot over HTTP/JSON")
+    parser.add_argument("--host", default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--port", type=int, default=8080, help="port to listen on")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="matching worker threads")
+    parser.add_argument("--queue-size", type=int, default=256, help="requests waiting for a worker before 503s")
+    parser.add_argument("--idle-timeout", type=float, default=30.0, help="seconds to keep an idle connection")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    server = ChatServer(get_chatbot(), args.host, args.port, args.workers, args.queue_size, args.idle_timeout)
+
+    async def run():
+        await server.start()
+        logger.info("Serving on http://%s:%d", server.host, server.port)
+        await server.serve_forever()
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
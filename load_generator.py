@@ -0,0 +1,129 @@
+"""
+Load Generator
+Drives the HTTP service (http_server.py) with synthetic traffic over
+kept-alive connections and reports latency percentiles and throughput
+
+Run with: python load_generator.py --port 8080 --requests 5000 --concurrency 16
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+from collections import Counter
+from itertools import count
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from benchmark import generate_queries, percentile
+
+
+async def _request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, host: str,
+                   path: str, payload: Dict) -> Tuple[int, Dict]:
+    """Send one POST on an open connection and read the response"""
+    body = json.dumps(payload).encode("utf-8")
+    writer.write((f"POST {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+                  f"Content-Length: {len(body)}\r\n\r\n").encode("latin-1") + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        if name.strip().lower() == "content-length":
+            length = int(value)
+    return status, json.loads(await reader.readexactly(length)) if length else {}
+
+
+async def run_load(host: str, port: int, queries: Sequence[str], requests: int = 1000,
+                   concurrency: int = 8, batch_size: int = 0) -> Dict:
+    """
+    Send requests over concurrency kept-alive connections
+
+    Args:
+        queries: Messages to send, cycled through
+        requests: Total requests to send
+        batch_size: Messages per /batch request; 0 sends single /message requests
+
+    Returns:
+        Request and message counts, status counts, latency_ms percentiles and
+        messages_per_s
+    """
+    sequence = count()
+    latencies: List[float] = []
+    statuses: Counter = Counter()
+
+    async def connection(number: int):
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            while True:
+                index = next(sequence)
+                if index >= requests:
+                    return
+                user_id = f"load-{number}"
+                if batch_size:
+                    start = index * batch_size
+                    payload = {"messages": [queries[(start + i) % len(queries)] for i in range(batch_size)],
+                               "user_id": user_id}
+                    path = "/batch"
+                else:
+                    payload = {"message": queries[index % len(queries)], "user_id": user_id}
+                    path = "/message"
+                started = time.perf_counter()
+                status, _ = await _request(reader, writer, host, path, payload)
+                latencies.append(time.perf_counter() - started)
+                statuses[status] += 1
+        finally:
+            writer.close()
+            await writer.wait_closed()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(connection(number) for number in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    messages = statuses[200] * (batch_size or 1)
+    return {
+        "requests": len(latencies),
+        "messages": messages,
+        "statuses": dict(statuses),
+        "elapsed_s": elapsed,
+        "latency_ms": {
+            "p50": percentile(latencies, 0.50) * 1000,
+            "p95": percentile(latencies, 0.95) * 1000,
+            "p99": percentile(latencies, 0.99) * 1000,
+            "max": (latencies[-1] if latencies else 0.0) * 1000,
+        },
+        "messages_per_s": messages / elapsed if elapsed else 0.0,
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Load-test a running HTTP service"""
+    parser = argparse.ArgumentParser(description="Generate load against the chatbot HTTP service")
+    parser.add_argument("--host", default="127.0.0.1", help="service address")
+    parser.add_argument("--port", type=int, default=8080, help="service port")
+    parser.add_argument("--faq-file", default="faq_data.json", help="catalog to draw queries from")
+    parser.add_argument("--requests", type=int, default=2000, help="requests to send")
+    parser.add_argument("--concurrency", type=int, default=8, help="kept-alive connections")
+    parser.add_argument("--batch-size", type=int, default=0, help="messages per /batch request (0: /message)")
+    parser.add_argument("--seed", type=int, default=0, help="seed for the query mix")
+    args = parser.parse_args(argv)
+
+    with open(args.faq_file, "r", encoding="utf-8") as f:
+        catalog = json.load(f)
+    queries = generate_queries(catalog, 1000, args.seed)
+    report = asyncio.run(run_load(args.host, args.port, queries, args.requests,
+                                  args.concurrency, args.batch_size))
+    latency = report["latency_ms"]
+    print(f"{report['requests']} requests ({report['messages']} messages) in {report['elapsed_s']:.2f}s: "
+          f"{report['messages_per_s']:.0f} messages/s")
+    print(f"Latency ms: p50 {latency['p50']:.2f}, p95 {latency['p95']:.2f}, "
+          f"p99 {latency['p99']:.2f}, max {latency['max']:.2f}")
+    print("Statuses: " + ", ".join(f"{status} {n}" for status, n in sorted(report["statuses"].items())))
+    return 0 if set(report["statuses"]) <= {200} else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
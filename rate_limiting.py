@@ -0,0 +1,218 @@
+"""
+Rate Limiting and Load Shedding
+Per-user token buckets, a global in-flight limit and chat-action coalescing
+for chat front ends. Nothing here depends on the Telegram library; handlers
+only use the attributes of the update and context objects they are given.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Optional
+
+from chatbot_engine import PerUserQueue
+
+logger = logging.getLogger(__name__)
+
+SHED_REPLY = "We're handling a lot of requests right now. Please try again in a moment."
+RATE_LIMITED_REPLY = "You're sending messages too quickly. Please wait a few seconds and try again."
+
+
+class TokenBucketLimiter:
+    """
+    Per-user token buckets: each user may send burst messages at once and
+    then rate messages per second
+
+    Buckets of users that have been idle long enough to be full again carry
+    no state and are dropped once more than max_users are tracked.
+    """
+
+    def __init__(self, rate: float = 1.0, burst: int = 5, max_users: int = 100000,
+                 clock: Callable[[], float] = time.monotonic):
+        """
+        Args:
+            rate: Tokens added per second
+            burst: Bucket capacity
+            max_users: Buckets kept before idle ones are dropped
+            clock: Monotonic time source, replaceable in tests
+        """
+        self.rate = rate
+        self.burst = burst
+        self.max_users = max_users
+        self._clock = clock
+        self._lock = threading.Lock()
+        # user -> (tokens, last refill); least recently seen first
+        self._buckets: "OrderedDict[str, tuple]" = OrderedDict()
+
+    def allow(self, user_id: str) -> bool:
+        """Take a token for the user; False when the bucket is empty"""
+        with self._lock:
+            now = self._clock()
+            tokens, last = self._buckets.pop(user_id, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            allowed = tokens >= 1.0
+            if allowed:
+                tokens -= 1.0
+            self._buckets[user_id] = (tokens, now)
+            if len(self._buckets) > self.max_users:
+                self._prune(now)
+            return allowed
+
+    def _prune(self, now: float):
+        """Drop buckets that have refilled completely; the caller holds the lock"""
+        full_after = self.burst / self.rate if self.rate > 0 else float("inf")
+        while len(self._buckets) > self.max_users:
+            user_id, (_, last) = next(iter(self._buckets.items()))
+            if now - last < full_after:
+                break
+            del self._buckets[user_id]
+
+
+class InFlightLimiter:
+    """Caps the number of messages being processed at once"""
+
+    def __init__(self, max_in_flight: int = 64):
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.shed = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self) -> bool:
+        """Claim a slot; False (and counted as shed) when all are taken"""
+        with self._lock:
+            if self.in_flight >= self.max_in_flight:
+                self.shed += 1
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+
+
+class ChatActionCoalescer:
+    """
+    Sends a chat action (e.g. "typing") at most once per interval per chat
+
+    Telegram shows an action for about five seconds, so repeating it for
+    every message of a burst only costs API calls.
+    """
+
+    def __init__(self, interval: float = 4.0, max_chats: int = 100000,
+                 clock: Callable[[], float] = time.monotonic):
+        self.interval = interval
+        self.max_chats = max_chats
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._last_sent: "OrderedDict[object, float]" = OrderedDict()
+
+    def should_send(self, chat_id) -> bool:
+        """True when no action was sent to this chat within the interval (and records it as sent)"""
+        with self._lock:
+            now = self._clock()
+            last = self._last_sent.get(chat_id)
+            if last is not None and now - last < self.interval:
+                return False
+            self._last_sent.pop(chat_id, None)
+            self._last_sent[chat_id] = now
+            while len(self._last_sent) > self.max_chats:
+                self._last_sent.popitem(last=False)
+            return True
+
+
+class GuardedMessageHandler:
+    """
+    Message handler that rate-limits users and sheds load before matching
+
+    A user over their rate gets one RATE_LIMITED_REPLY per burst; further
+    messages of that burst are dropped without a reply. When max_in_flight
+    messages are already being processed, new ones get the canned
+    SHED_REPLY without being matched. Typing indicators are coalesced per
+    chat.
+    """
+
+    def __init__(self, chatbot=None, limiter: Optional[TokenBucketLimiter] = None,
+                 in_flight: Optional[InFlightLimiter] = None,
+                 chat_actions: Optional[ChatActionCoalescer] = None,
+                 shed_reply: str = SHED_REPLY, rate_limited_reply: str = RATE_LIMITED_REPLY,
+                 route: Optional[Callable[[str], object]] = None):
+        """
+        Args:
+            chatbot: Engine answering the messages
+            limiter: Per-user rate limiter; None disables rate limiting
+            in_flight: Global in-flight limit; None disables load shedding
+            chat_actions: Typing indicator coalescer; None sends one per message
+            route: Maps a user id to the engine answering them (e.g.
+                EngineRegistry.route); used instead of chatbot when given. It
+                may block loading an engine, so it runs on a worker thread
+        """
+        if chatbot is None and route is None:
+            raise ValueError("Either chatbot or route is required")
+        self.chatbot = chatbot
+        self.route = route
+        self.limiter = limiter
+        self.in_flight = in_flight
+        self.chat_actions = chat_actions
+        self.shed_reply = shed_reply
+        self.rate_limited_reply = rate_limited_reply
+        self.rate_limited = 0
+        self._notified: Dict[str, bool] = {}  # users told they are rate limited in this burst
+        # Each user's messages are routed in order, like the engine processes them
+        self._route_queue = PerUserQueue()
+
+    async def __call__(self, update, context):
+        user_message = update.message.text
+        user_id = str(update.effective_user.id)
+
+        if self.limiter is not None:
+            if not self.limiter.allow(user_id):
+                self.rate_limited += 1
+                if not self._notified.get(user_id):
+                    if len(self._notified) >= self.limiter.max_users:
+                        self._notified.clear()
+                    self._notified[user_id] = True
+                    await update.message.reply_text(self.rate_limited_reply)
+                return
+            self._notified.pop(user_id, None)
+
+        if self.in_flight is not None and not self.in_flight.try_acquire():
+            await update.message.reply_text(self.shed_reply)
+            return
+        try:
+            # Queue the message before any await so each user's messages are answered in order;
+            # matching runs on a worker thread and doesn't block other chats
+            if self.route is None:
+                pending = self.chatbot.process_message_async(user_message, user_id)
+            else:
+                pending = self._route_queue.submit(
+                    user_id, lambda: self._route_and_process(user_message, user_id))
+
+            chat_id = update.effective_chat.id
+            if self.chat_actions is None or self.chat_actions.should_send(chat_id):
+                await context.bot.send_chat_action(chat_id=chat_id, action="typing")
+
+            response = await pending
+            await update.message.reply_text(response["response"])
+        finally:
+            if self.in_flight is not None:
+                self.in_flight.release()
+
+        logger.info(f"User {user_id}: {user_message}")
+        logger.info(f"Bot response (intent: {response['intent']}, confidence: {response['confidence']:.2f})")
+
+    async def _route_and_process(self, user_message: str, user_id: str) -> Dict:
+        """Route and process a message without blocking the loop"""
+        # A cold or evicted tenant is loaded on a worker thread, not on the loop
+        chatbot = await asyncio.get_running_loop().run_in_executor(None, self.route, user_id)
+        return await chatbot.process_message_async(user_message, user_id)
+
+    def stats(self) -> Dict[str, int]:
+        """Counts of rate-limited and shed messages"""
+        return {
+            "rate_limited": self.rate_limited,
+            "shed": self.in_flight.shed if self.in_flight else 0,
+            "in_flight": self.in_flight.in_flight if self.in_flight else 0,
+        }
@@ -0,0 +1,182 @@
+"""
+Sharded Matching
+Splits the FAQ and intent catalog across worker processes so matching one
+large catalog can use more than one core
+"""
+
+import os
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from faq_catalog import CompiledCatalog, np
+
+# Per-process state of a shard worker, set by _load_shard
+_shard: Optional[CompiledCatalog] = None
+_offsets = (0, 0, 0)
+
+ShardHit = Tuple[int, float, float, int, int, float, float]
+
+
+def _load_shard(data: Dict, faq_offset: int, pattern_offset: int, intent_offset: int):
+    """Compile this worker's slice of the catalog (process pool initializer)"""
+    global _shard, _offsets
+    _shard = CompiledCatalog(data)
+    _offsets = (faq_offset, pattern_offset, intent_offset)
+
+
+def _local(masked: Sequence[int], offset: int, size: int) -> List[int]:
+    """The catalog-wide indexes in masked that fall in this shard, as shard indexes"""
+    return [idx - offset for idx in masked if offset <= idx < offset + size]
+
+
+def _unmasked(shared: Dict[int, int], masked: Sequence[int]) -> Dict[int, int]:
+    """Candidates without the masked entries"""
+    for idx in masked:
+        shared.pop(idx, None)
+    return shared
+
+
+def _score_shard(normalized_inputs: Sequence[str], faq_threshold: float, intent_threshold: float,
+                 masked_faqs: Sequence[int] = (), masked_patterns: Sequence[int] = ()) -> List[ShardHit]:
+    """
+    Best FAQ and intent of this shard for each normalized input
+
+    Masked FAQs and patterns (catalog-wide indexes) are never picked.
+
+    Returns:
+        (faq index, faq score, faq similarity, pattern index, intent index,
+        intent score, confidence) per input, with catalog-wide indexes
+    """
+    catalog = _shard
+    faq_offset, pattern_offset, intent_offset = _offsets
+    masked_faqs = _local(masked_faqs, faq_offset, len(catalog.faqs))
+    masked_patterns = _local(masked_patterns, pattern_offset, len(catalog.pattern_words))
+    word_sets = [frozenset(text.split()) for text in normalized_inputs]
+    if np is not None and len(normalized_inputs) > 1:
+        scorer = catalog.batch_scorer()
+        faq_hits = scorer.match_faqs(normalized_inputs, word_sets, faq_threshold, masked_faqs)
+        intent_hits = scorer.match_intents(word_sets, intent_threshold, masked_patterns)
+    else:
+        faq_hits, intent_hits = [], []
+        for text, words in zip(normalized_inputs, word_sets):
+            shared = _unmasked(catalog.faq_overlaps(text, words), masked_faqs) if masked_faqs else None
+            faq_hits.append(catalog.best_faq(text, words, faq_threshold, shared))
+            shared = _unmasked(catalog.pattern_overlaps(words), masked_patterns) if masked_patterns else None
+            intent_hits.append(catalog.best_intent(words, intent_threshold, shared))
+
+    results = []
+    for (faq_idx, faq_score, similarity), (pattern, intent_idx, intent_score, confidence) in zip(faq_hits, intent_hits):
+        results.append((
+            faq_idx + faq_offset if faq_idx >= 0 else -1, faq_score, similarity,
+            pattern + pattern_offset if pattern >= 0 else -1,
+            intent_idx + intent_offset if intent_idx >= 0 else -1, intent_score, confidence,
+        ))
+    return results
+
+
+def _split(sizes: Sequence[int], parts: int) -> List[Tuple[int, int]]:
+    """Cut a sequence into contiguous ranges of roughly equal total size"""
+    total = sum(sizes)
+    ranges = []
+    start = 0
+    running = 0
+    for part in range(1, parts + 1):
+        end = start
+        target = total * part / parts
+        while end < len(sizes) and (running + sizes[end] <= target or part == parts):
+            running += sizes[end]
+            end += 1
+        ranges.append((start, end))
+        start = end
+    return ranges
+
+
+class ShardedMatcher:
+    """
+    Scores messages against a catalog split over a pool of worker processes
+
+    Each shard owns a contiguous slice of the FAQs and whole intents (an
+    intent's confidence depends on all of its patterns), compiled once in a
+    dedicated process. A message is scored on every shard in parallel and the
+    per-shard winners are merged in catalog order, so ties still go to the
+    earliest entry and results match the in-process matcher.
+    """
+
+    def __init__(self, data: Dict, shards: Optional[int] = None):
+        """
+        Args:
+            data: FAQ data in the faq_data.json layout
+            shards: Worker processes to use; defaults to the CPU count
+        """
+        faqs = list(data.get("faqs", []))
+        intents = list(data.get("intents", []))
+        self.shards = max(1, shards or os.cpu_count() or 1)
+        faq_ranges = _split([1] * len(faqs), self.shards)
+        intent_ranges = _split([len(intent.get("patterns", [])) for intent in intents], self.shards)
+
+        self._pools: List[ProcessPoolExecutor] = []
+        pattern_offset = 0
+        for (faq_start, faq_end), (intent_start, intent_end) in zip(faq_ranges, intent_ranges):
+            shard_data = {"faqs": faqs[faq_start:faq_end], "intents": intents[intent_start:intent_end]}
+            self._pools.append(ProcessPoolExecutor(
+                max_workers=1, initializer=_load_shard,
+                initargs=(shard_data, faq_start, pattern_offset, intent_start),
+            ))
+            pattern_offset += sum(len(intent.get("patterns", [])) for intent in shard_data["intents"])
+        self._finalizer = weakref.finalize(self, ShardedMatcher._shutdown, self._pools)
+
+    @staticmethod
+    def _shutdown(pools: List[ProcessPoolExecutor]):
+        # Garbage collection or interpreter exit; close() is the orderly way
+        for pool in pools:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def close(self):
+        """Stop the worker processes once their queued work is done, waiting for them to exit"""
+        if self._finalizer.detach() is None:
+            return  # already closed
+        for pool in self._pools:
+            pool.shutdown(wait=True)
+
+    def hits(self, normalized_inputs: Sequence[str], faq_threshold: float, intent_threshold: float,
+             masked_faqs: Sequence[int] = (), masked_patterns: Sequence[int] = ()
+             ) -> Tuple[List[Tuple[int, float, float]], List[Tuple[int, int, float, float]]]:
+        """
+        Best FAQ and intent for each normalized input, in the BatchScorer formats
+
+        Masked FAQs and patterns are never picked; masked patterns must make
+        up whole intents.
+
+        Returns:
+            (index, score, similarity) FAQ hits and (pattern, intent, score,
+            confidence) intent hits, one per input
+        """
+        inputs = list(normalized_inputs)
+        futures = [pool.submit(_score_shard, inputs, faq_threshold, intent_threshold,
+                               list(masked_faqs), list(masked_patterns))
+                   for pool in self._pools]
+        merged = [[-1, 0.0, 0.0, -1, -1, 0.0, 0.0] for _ in inputs]
+        # Shards are in catalog order; only a strictly better score replaces
+        # the current best, as in the in-process matcher
+        for future in futures:
+            for best, (faq_idx, faq_score, similarity, pattern, intent_idx, intent_score, confidence) in zip(
+                    merged, future.result()):
+                if faq_idx >= 0 and faq_score > best[1]:
+                    best[0:3] = faq_idx, faq_score, similarity
+                if intent_idx >= 0 and intent_score > best[5]:
+                    best[3:7] = pattern, intent_idx, intent_score, confidence
+        return [tuple(best[0:3]) for best in merged], [tuple(best[3:7]) for best in merged]
+
+    def match(self, normalized_inputs: Sequence[str], faq_threshold: float,
+              intent_threshold: float) -> List[Tuple[int, float, int, float]]:
+        """
+        Best FAQ and intent for each normalized input
+
+        Returns:
+            (faq index, faq similarity, intent index, intent confidence) per
+            input, with -1 and 0.0 where nothing reaches the threshold
+        """
+        faq_hits, intent_hits = self.hits(normalized_inputs, faq_threshold, intent_threshold)
+        return [(faq_idx, similarity, intent_idx, confidence)
+                for (faq_idx, _, similarity), (_, intent_idx, _, confidence) in zip(faq_hits, intent_hits)]
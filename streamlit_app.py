@@ -5,7 +5,8 @@ Run with: streamlit run streamlit_app.py
 
 import streamlit as st
 import json
-from chatbot_engine import get_chatbot, CustomerSupportChatbot
+from chatbot_engine import CustomerSupportChatbot
+from engine_registry import EngineRegistry, get_registry
 from datetime import datetime
 
 # Page configuration
@@ -41,20 +42,78 @@ st.markdown("""
     </style>
 """, unsafe_allow_html=True)
 
+# Answers below this confidence come with "did you mean" suggestions
+SUGGESTION_CONFIDENCE = 0.6
+# Messages kept in a session; older ones stay in the engine's history only
+MAX_SESSION_MESSAGES = 200
+# Messages rendered at first, and added by each "load earlier" click
+PAGE_SIZE = 20
+
+
+@st.cache_resource
+def load_registry() -> EngineRegistry:
+    """The process-wide engine registry, shared by every session
+
+    Its engines watch their FAQ files and swap in edits themselves, so a
+    cached engine never serves a stale catalog.
+    """
+    return get_registry()
+
+
+def load_chatbot() -> CustomerSupportChatbot:
+    """The engine of this session's tenant, loaded on first use"""
+    return load_registry().route(st.session_state.user_id)
+
+
+def send_message(text: str):
+    """Process a user message and add it and the reply to the chat"""
+    chatbot = load_chatbot()
+    response = chatbot.process_message(text, st.session_state.user_id)
+    st.session_state.messages.append({
+        "role": "user",
+        "content": text,
+        "timestamp": datetime.now().isoformat()
+    })
+    # Offer the closest FAQs when the answer is a guess or a fallback
+    suggestions = []
+    if response["intent"] in ("faq", "fallback") and response["confidence"] < SUGGESTION_CONFIDENCE:
+        for faq in chatbot.match_top_k(text, 3)["faqs"]:
+            if faq["id"] != response["faq_id"]:
+                suggestions.append(faq["question"])
+    st.session_state.messages.append({
+        "role": "assistant",
+        "content": response["response"],
+        "intent": response["intent"],
+        "confidence": response["confidence"],
+        "suggestions": suggestions,
+        "timestamp": response["timestamp"]
+    })
+    del st.session_state.messages[:-MAX_SESSION_MESSAGES]
+
+
 # Initialize session state
-if 'chatbot' not in st.session_state:
-    st.session_state.chatbot = get_chatbot()
+if 'messages' not in st.session_state:
     st.session_state.messages = []
+    st.session_state.visible_messages = PAGE_SIZE
     st.session_state.user_id = f"user_{datetime.now().timestamp()}"
 
 # Sidebar
 with st.sidebar:
     st.title("🤖 Chatbot Settings")
     
+    registry = load_registry()
+    tenants = registry.tenants()
+    if len(tenants) > 1:
+        current = registry.tenant_of(st.session_state.user_id)
+        tenant = st.selectbox("Catalog", tenants, index=tenants.index(current) if current in tenants else 0)
+        if tenant != current:
+            registry.assign(st.session_state.user_id, tenant)
+    
     st.markdown("### Quick Actions")
     if st.button("🔄 Clear Chat History"):
         st.session_state.messages = []
-        st.session_state.chatbot.clear_history(st.session_state.user_id)
+        st.session_state.visible_messages = PAGE_SIZE
+        load_chatbot().clear_history(st.session_state.user_id)
         st.rerun()
     
     st.markdown("---")
@@ -73,24 +132,36 @@ with st.sidebar:
     for question in sample_questions:
         if st.button(f"💬 {question}", key=f"sample_{question}"):
             # Process the sample question
-            response = st.session_state.chatbot.process_message(
-                question, 
-                st.session_state.user_id
-            )
-            st.session_state.messages.append({
-                "role": "user",
-                "content": question,
-                "timestamp": datetime.now().isoformat()
-            })
-            st.session_state.messages.append({
-                "role": "assistant",
-                "content": response["response"],
-                "intent": response["intent"],
-                "confidence": response["confidence"],
-                "timestamp": response["timestamp"]
-            })
+            send_message(question)
             st.rerun()
     
+    st.markdown("---")
+    with st.expander("📊 Engine Stats"):
+        chatbot = load_chatbot()
+        stats = chatbot.get_stats()
+        collect = st.checkbox("Collect stats", value=stats["enabled"],
+                              help="Time each matching stage and count results")
+        if collect != stats["enabled"]:
+            chatbot.set_instrumentation(collect)
+            stats = chatbot.get_stats()
+        if stats["enabled"]:
+            st.metric("Messages", stats["messages"])
+            if stats["stages"]:
+                st.markdown("**Stage timings (ms)**")
+                st.table([
+                    {"stage": stage, "mean": round(t["mean_ms"], 3), "max": round(t["max_ms"], 3), "count": t["count"]}
+                    for stage, t in stats["stages"].items()
+                ])
+            if stats["intents"]:
+                st.markdown("**Intents**")
+                st.bar_chart({"messages": stats["intents"]})
+            st.markdown("**Confidence**")
+            st.bar_chart({"messages": stats["confidence_histogram"]})
+            for kind, counts in stats["candidates_histogram"].items():
+                if counts:
+                    st.markdown(f"**{kind.upper() if kind == 'faq' else kind.capitalize()} candidates scored**")
+                    st.bar_chart({"messages": counts})
+    
     st.markdown("---")
     st.markdown("### ℹ️ About")
     st.info("""
@@ -111,10 +182,17 @@ with st.sidebar:
 st.title("🤖 Customer Support Chatbot")
 st.markdown("Welcome! I'm here to help you with your questions. Type your message below or click a sample question from the sidebar.")
 
-# Display chat history
+# Display the latest messages; earlier ones are rendered on request
+messages = st.session_state.messages
+first_shown = max(0, len(messages) - st.session_state.visible_messages)
+if first_shown:
+    if st.button(f"⬆️ Load earlier messages ({first_shown} more)"):
+        st.session_state.visible_messages += PAGE_SIZE
+        st.rerun()
 chat_container = st.container()
 with chat_container:
-    for message in st.session_state.messages:
+    for index in range(first_shown, len(messages)):
+        message = messages[index]
         if message["role"] == "user":
             with st.chat_message("user"):
                 st.write(message["content"])
@@ -124,33 +202,21 @@ with chat_container:
                 # Show intent and confidence in a small text
                 if message.get("intent") and message.get("intent") != "fallback":
                     st.caption(f"Intent: {message.get('intent')} | Confidence: {message.get('confidence', 0):.2f}")
+                # "Did you mean" choices, only under the latest answer
+                if message.get("suggestions") and index == len(messages) - 1:
+                    st.caption("Did you mean:")
+                    for number, suggestion in enumerate(message["suggestions"]):
+                        if st.button(suggestion, key=f"suggestion_{index}_{number}"):
+                            send_message(suggestion)
+                            st.rerun()
 
 # Chat input
 user_input = st.chat_input("Type your message here...")
 
 if user_input:
-    # Add user message to chat
-    st.session_state.messages.append({
-        "role": "user",
-        "content": user_input,
-        "timestamp": datetime.now().isoformat()
-    })
-    
-    # Get bot response
+    # Get bot response and add both messages to chat
     with st.spinner("Thinking..."):
-        response = st.session_state.chatbot.process_message(
-            user_input,
-            st.session_state.user_id
-        )
-    
-    # Add bot response to chat
-    st.session_state.messages.append({
-        "role": "assistant",
-        "content": response["response"],
-        "intent": response["intent"],
-        "confidence": response["confidence"],
-        "timestamp": response["timestamp"]
-    })
+        send_message(user_input)
     
     st.rerun()
 
@@ -5,13 +5,29 @@ Run with: python telegram_bot.py
 Before running, set your Telegram Bot Token in environment variable:
 export TELEGRAM_BOT_TOKEN="your_bot_token_here"
 Or create a .env file with TELEGRAM_BOT_TOKEN=your_token
+
+Optionally set TELEGRAM_ADMIN_IDS to a comma-separated list of Telegram user
+IDs allowed to use the /stats command.
+
+Flood protection (see rate_limiting.py) is configured with:
+TELEGRAM_USER_RATE         messages per second each user may send (default 1)
+TELEGRAM_USER_BURST        messages a user may send at once (default 5)
+TELEGRAM_MAX_IN_FLIGHT     messages processed at once before new ones get a
+                           canned "busy" reply (default 64)
+TELEGRAM_TYPING_INTERVAL   seconds between typing indicators per chat (default 4)
+
+Several FAQ catalogs can be served at once (see engine_registry.py for
+CHATBOT_CATALOGS and CHATBOT_CATALOG_DIR); users pick theirs with /tenant.
 """
 
+import asyncio
 import os
 import logging
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from chatbot_engine import get_chatbot
+from engine_registry import get_registry
+from engine_stats import format_stats
+from rate_limiting import ChatActionCoalescer, GuardedMessageHandler, InFlightLimiter, TokenBucketLimiter
 
 # Try to load from .env file
 try:
@@ -27,17 +43,26 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Get bot token from environment variable
+# Get bot token from environment variable (checked when the bot starts)
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 
-if not TELEGRAM_BOT_TOKEN:
-    logger.error("TELEGRAM_BOT_TOKEN environment variable is not set!")
-    logger.info("Please set it using: export TELEGRAM_BOT_TOKEN='your_token_here'")
-    logger.info("Or create a .env file with TELEGRAM_BOT_TOKEN=your_token")
-    exit(1)
-
-# Initialize chatbot
-chatbot = get_chatbot()
+# Telegram user IDs allowed to run admin commands such as /stats
+ADMIN_USER_IDS = {
+    user_id.strip() for user_id in os.getenv('TELEGRAM_ADMIN_IDS', '').split(',') if user_id.strip()
+}
+
+# Engines per tenant catalog, loaded on first use; instrumented so /stats has something to show
+registry = get_registry(instrument=bool(ADMIN_USER_IDS))
+
+# Regular messages: per-user rate limit, global in-flight limit, coalesced typing indicators,
+# answered by the engine of the user's tenant
+handle_message = GuardedMessageHandler(
+    route=registry.route,
+    limiter=TokenBucketLimiter(float(os.getenv('TELEGRAM_USER_RATE', '1')),
+                               int(os.getenv('TELEGRAM_USER_BURST', '5'))),
+    in_flight=InFlightLimiter(int(os.getenv('TELEGRAM_MAX_IN_FLIGHT', '64'))),
+    chat_actions=ChatActionCoalescer(float(os.getenv('TELEGRAM_TYPING_INTERVAL', '4'))),
+)
 
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -65,6 +90,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 /start - Start the chatbot
 /help - Show this help message
 /clear - Clear conversation history
+/tenant - Show or switch the catalog you are talking to
 
 💡 Sample Questions:
 • "Where is my order?"
@@ -81,43 +107,63 @@ Just ask me anything!
 async def clear_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /clear command"""
     user_id = str(update.effective_user.id)
-    chatbot.clear_history(user_id)
+    # History lives in the shared store, so no engine needs loading
+    registry.history_store.clear(user_id)
     await update.message.reply_text("✅ Conversation history cleared!")
 
 
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle regular text messages"""
-    user_message = update.message.text
+async def tenant_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /tenant [name] command"""
     user_id = str(update.effective_user.id)
-    
-    # Show typing indicator
-    await context.bot.send_chat_action(
-        chat_id=update.effective_chat.id,
-        action='typing'
+    if context.args:
+        try:
+            registry.assign(user_id, context.args[0])
+        except KeyError:
+            await update.message.reply_text(f"Unknown catalog: {context.args[0]}")
+            return
+    await update.message.reply_text(
+        f"You are talking to: {registry.tenant_of(user_id)}\n"
+        f"Available: {', '.join(registry.tenants())}"
+    )
+
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /stats admin command"""
+    user_id = str(update.effective_user.id)
+    if user_id not in ADMIN_USER_IDS:
+        await update.message.reply_text("⛔ This command is for administrators only.")
+        return
+    guard = handle_message.stats()
+    engine = await asyncio.get_running_loop().run_in_executor(None, registry.route, user_id)
+    tenants = registry.stats()
+    await update.message.reply_text(
+        f"📊 Engine stats ({registry.tenant_of(user_id)})\n" + format_stats(engine.get_stats())
+        + f"\nTenants loaded: {', '.join(tenants['loaded'])} (~{tenants['estimated_mb']:.0f} of "
+          f"{tenants['budget_mb']:.0f} MB, {tenants['evictions']} evictions)"
+        + f"\nFlood control: {guard['rate_limited']} rate limited, {guard['shed']} shed, "
+          f"{guard['in_flight']} in flight"
     )
-    
-    # Process message with chatbot
-    response = chatbot.process_message(user_message, user_id)
-    
-    # Send response
-    await update.message.reply_text(response["response"])
-    
-    # Log the interaction
-    logger.info(f"User {user_id}: {user_message}")
-    logger.info(f"Bot response (intent: {response['intent']}, confidence: {response['confidence']:.2f})")
 
 
 def main():
     """Start the Telegram bot"""
+    if not TELEGRAM_BOT_TOKEN:
+        logger.error("TELEGRAM_BOT_TOKEN environment variable is not set!")
+        logger.info("Please set it using: export TELEGRAM_BOT_TOKEN='your_token_here'")
+        logger.info("Or create a .env file with TELEGRAM_BOT_TOKEN=your_token")
+        exit(1)
+    
     logger.info("Starting Telegram bot...")
     
-    # Create application
-    application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+    # Create application; updates are handled concurrently so one slow chat doesn't stall the others
+    application = Application.builder().token(TELEGRAM_BOT_TOKEN).concurrent_updates(True).build()
     
     # Register handlers
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("clear", clear_history))
+    application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CommandHandler("tenant", tenant_command))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     
     # Start the bot
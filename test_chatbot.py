@@ -3,8 +3,27 @@ Simple test script to verify the chatbot is working correctly
 Run with: python test_chatbot.py
 """
 
+import asyncio
+import json
+import os
+import sqlite3
 import sys
+import threading
+from datetime import datetime
+from types import SimpleNamespace
+from batch_eval import run_evaluation
+from benchmark import benchmark_catalog, compare_reports, generate_catalog, generate_queries
+from catalog_changes import ChangeLog, change_log_path
+from catalog_snapshot import load_snapshot, write_snapshot
 from chatbot_engine import CustomerSupportChatbot
+from conversation_store import HistoryEvent, HistoryStore, SQLiteHistoryStore
+from engine_registry import EngineRegistry
+from faq_catalog import FAQEntry, IntentEntry, normalize_text
+from fuzzy_matching import FuzzyCorrector, bounded_edit_distance
+from http_server import ChatServer
+from load_generator import _request, run_load
+from rate_limiting import (RATE_LIMITED_REPLY, SHED_REPLY, ChatActionCoalescer, GuardedMessageHandler,
+                           InFlightLimiter, TokenBucketLimiter)
 
 # Fix encoding for Windows console
 if sys.platform == 'win32':
@@ -40,6 +59,766 @@ def test_chatbot():
     
     print("\nChatbot test completed!")
 
+
+def test_index_keeps_substring_matches():
+    """Partial-word inputs still reach FAQs through the substring rule"""
+    chatbot = CustomerSupportChatbot()
+
+    def words(normalized):
+        return chatbot._catalog.encode_words(frozenset(normalized.split()))
+
+    def match_faq(text):
+        normalized = normalize_text(text)
+        return chatbot._match_faq(normalized, words(normalized))
+
+    def match_intent(text):
+        return chatbot._match_intent(words(normalize_text(text)))
+
+    # "rn" shares no word with any question but is inside "return"
+    faq, score = match_faq("rn")
+    assert faq["question"] == "What is your return policy?"
+    assert score == 0.0
+    assert match_faq("track my order")[0]["question"] == "How can I track my order?"
+    intent, score = match_intent("where is my order")
+    assert intent["name"] == "order_status"
+    assert score == 1.0
+    assert match_intent("xyz qwerty") == (None, 0.0)
+
+
+def test_process_messages_matches_process_message():
+    """Batch scoring gives the same answers as one message at a time"""
+    messages = [
+        "Hello", "Where is my order?", "What is your return policy?", "rn",
+        "refund", "Thank you, goodbye!", "", "do you ship worldwide",
+        "This is a random question that doesn't match anything",
+    ]
+    single = [CustomerSupportChatbot().process_message(m) for m in messages]
+    batch = CustomerSupportChatbot().process_messages(messages)
+    for one, other in zip(single, batch):
+        assert one["intent"] == other["intent"]
+        assert one["confidence"] == other["confidence"]
+        if one["intent"] not in ("greeting", "fallback"):
+            assert one["response"] == other["response"]
+
+
+def test_sharded_matching_matches_in_process():
+    """Splitting the catalog over worker processes does not change any answer"""
+    messages = [
+        "Hello", "Where is my order?", "What is your return policy?", "rn",
+        "refund", "do you ship worldwide", "cancel my order please",
+        "This is a random question that doesn't match anything",
+    ]
+    local = CustomerSupportChatbot()
+    sharded = CustomerSupportChatbot(shards=3)
+    try:
+        expected = [local.process_message(m) for m in messages]
+        for results in ([sharded.process_message(m) for m in messages], sharded.process_messages(messages)):
+            for one, other in zip(expected, results):
+                assert one["intent"] == other["intent"]
+                assert one["confidence"] == other["confidence"]
+                if one["intent"] not in ("greeting", "fallback"):
+                    assert one["response"] == other["response"]
+    finally:
+        matcher = sharded._current_catalog().derived["sharded"]
+        workers = [process for pool in matcher._pools for process in pool._processes.values()]
+        matcher.close()
+    # close() returns once the worker processes have exited
+    assert workers and not any(process.is_alive() for process in workers)
+
+
+def test_history_is_per_user_and_bounded():
+    """Each user keeps only their latest messages, and idle users are evicted"""
+    now = [0.0]
+    chatbot = CustomerSupportChatbot(max_history_per_user=3, history_ttl=60)
+    chatbot._history._clock = lambda: now[0]
+    for i in range(5):
+        chatbot.process_message(f"message {i}", "alice")
+    chatbot.process_message("hello", "bob")
+    assert [m["user_message"] for m in chatbot.get_conversation_history("alice")] == [
+        "message 2", "message 3", "message 4"]
+    assert len(chatbot.conversation_history) == 4
+
+    chatbot.clear_history("alice")
+    assert chatbot.get_conversation_history("alice") == []
+    assert len(chatbot.get_conversation_history("bob")) == 1
+
+    now[0] = 61.0
+    chatbot.process_message("still here?", "carol")
+    assert chatbot.get_conversation_history("bob") == []
+    assert len(chatbot.get_conversation_history("carol")) == 1
+
+
+def test_response_cache():
+    """Deterministic answers are cached; random and personalized ones are not"""
+    chatbot = CustomerSupportChatbot(response_cache_size=2)
+    first = chatbot.process_message("Where is my order?")
+    again = chatbot.process_message("where is my order")
+    assert again["response"] == first["response"]
+    assert chatbot.get_cache_stats()["hits"] == 1
+
+    chatbot.process_message("Hello")
+    chatbot.process_message("Hello")
+    assert chatbot.get_cache_stats()["size"] == 1
+
+    data = {"faqs": [], "intents": [
+        {"name": "order_status", "patterns": ["order status"], "response": "Order {order_id} is on its way"}]}
+    chatbot.faq_data = data
+    chatbot.user_context["alice"] = {"order_id": "A1"}
+    assert chatbot.process_message("order status", "alice")["response"] == "Order A1 is on its way"
+    assert chatbot.process_message("order status", "bob")["response"] == "Order {order_id} is on its way"
+    stats = chatbot.get_cache_stats()
+    assert stats["invalidations"] == 1
+    assert stats["hits"] == 2
+
+    chatbot.process_message("what is up")
+    chatbot.process_message("bye")
+    chatbot.process_message("thanks")
+    assert chatbot.get_cache_stats()["evictions"] == 1
+
+
+def test_reload_swaps_catalog(tmp_path):
+    """Reloading picks up edits and keeps the old catalog if the file is broken"""
+    faq_file = tmp_path / "faq_data.json"
+    faq_file.write_text(json.dumps({"intents": [], "faqs": [
+        {"question": "Do you have a mobile app?", "answer": "Not yet."}]}))
+    chatbot = CustomerSupportChatbot(str(faq_file))
+    assert chatbot.process_message("Do you have a mobile app?")["response"] == "Not yet."
+
+    faq_file.write_text(json.dumps({"intents": [], "faqs": [
+        {"question": "Do you have a mobile app?", "answer": "Yes, on iOS and Android."}]}))
+    assert chatbot.reload()
+    assert chatbot.process_message("Do you have a mobile app?")["response"] == "Yes, on iOS and Android."
+
+    faq_file.write_text('{"faqs": [')
+    assert not chatbot.reload()
+    assert chatbot.process_message("Do you have a mobile app?")["response"] == "Yes, on iOS and Android."
+
+
+def test_snapshot_matches_json_catalog(tmp_path):
+    """The memory-mapped snapshot answers like the JSON catalog and goes stale on edits"""
+    faq_file = tmp_path / "faq_data.json"
+    with open("faq_data.json", encoding="utf-8") as f:
+        faq_file.write_text(f.read(), encoding="utf-8")
+    write_snapshot(str(faq_file))
+    from_snapshot = CustomerSupportChatbot(str(faq_file))
+    from_json = CustomerSupportChatbot(str(faq_file), use_snapshot=False)
+    assert type(from_snapshot._catalog).__name__ == "SnapshotCatalog"
+    for question in ["Where is my order?", "rn", "refund please", "Do you have a mobile app?", "xyz"]:
+        one = from_snapshot.process_message(question)
+        other = from_json.process_message(question)
+        assert (one["intent"], one["confidence"]) == (other["intent"], other["confidence"])
+    assert from_snapshot.faq_data == from_json.faq_data
+    assert from_snapshot._catalog.keywords.config == from_json._catalog.keywords.config
+
+    stat = os.stat(faq_file)
+    os.utime(faq_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert load_snapshot(str(faq_file)) is None
+
+
+def test_concurrent_process_message():
+    """Many threads sharing one engine keep every user's history intact"""
+    chatbot = CustomerSupportChatbot(max_history_per_user=5000, response_cache_size=8)
+    questions = ["Where is my order?", "refund", "Hello", "rn", "do you ship", "xyz"]
+    n_threads, n_messages = 16, 150
+    errors = []
+
+    def worker(thread_idx):
+        try:
+            for i in range(n_messages):
+                question = questions[i % len(questions)]
+                chatbot.process_message(f"{question} {i}", f"user-{thread_idx}")
+                chatbot.process_message(question, "shared")
+                if i % 50 == 0:
+                    chatbot.update_user_context(f"user-{thread_idx}", order_id=str(i))
+        except Exception as e:  # surfaced in the main thread
+            errors.append(e)
+
+    def reloader():
+        for _ in range(20):
+            chatbot.reload()
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(n_threads)]
+    threads.append(threading.Thread(target=reloader))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    for thread_idx in range(n_threads):
+        history = chatbot.get_conversation_history(f"user-{thread_idx}")
+        assert [m["user_message"] for m in history] == [
+            f"{questions[i % len(questions)]} {i}" for i in range(n_messages)]
+    assert len(chatbot.get_conversation_history("shared")) == n_threads * n_messages
+    assert len(chatbot.conversation_history) == 2 * n_threads * n_messages
+
+
+def test_process_message_async_keeps_per_user_order():
+    """Async calls for one user finish in call order while others run alongside"""
+    chatbot = CustomerSupportChatbot(max_history_per_user=1000)
+
+    async def run():
+        tasks = [chatbot.process_message_async(f"message {i}", f"user-{i % 3}") for i in range(60)]
+        return await asyncio.gather(*tasks)
+
+    results = asyncio.run(run())
+    assert len(results) == 60
+    for user in range(3):
+        history = chatbot.get_conversation_history(f"user-{user}")
+        assert [m["user_message"] for m in history] == [f"message {i}" for i in range(user, 60, 3)]
+    assert len(chatbot._async_queue) == 0
+
+
+def test_benchmark_harness(tmp_path):
+    """Synthetic catalogs and traffic benchmark cleanly and compare between runs"""
+    catalog = generate_catalog(50, seed=1)
+    assert len(catalog["faqs"]) == 50 and catalog == generate_catalog(50, seed=1)
+    faq_file = tmp_path / "faq_data.json"
+    faq_file.write_text(json.dumps(catalog))
+    queries = generate_queries(catalog, 200, seed=1)
+    assert len(queries) == 200 and any(q.lower() in ("hi", "hello") for q in queries)
+
+    run = benchmark_catalog(str(faq_file), queries, warmup=10)
+    assert run["faqs"] == 50 and run["queries"] == 200
+    assert 0 < run["latency_ms"]["p50"] <= run["latency_ms"]["p95"] <= run["latency_ms"]["p99"]
+    assert run["throughput_per_s"] > 0 and run["peak_memory_mb"] > 0
+    assert not os.path.exists(str(faq_file) + ".snapshot")
+
+    slower = json.loads(json.dumps(run))
+    slower["latency_ms"]["p95"] *= 2
+    rows = compare_reports({"runs": [run]}, {"runs": [slower]})
+    assert [row["metric"] for row in rows if row["regression"]] == ["latency_ms.p95"]
+
+
+def test_stats_instrumentation():
+    """Instrumentation times every stage and counts results only when switched on"""
+    chatbot = CustomerSupportChatbot()
+    chatbot.process_message("Where is my order?")
+    assert chatbot.get_stats()["enabled"] is False
+    assert chatbot.get_stats()["messages"] == 0
+
+    chatbot.set_instrumentation(True)
+    for message in ["Where is my order?", "Hello", "bye", "zzz qqq"]:
+        chatbot.process_message(message)
+    # The goodbye stops before matching
+    assert sum(chatbot.get_stats()["candidates_histogram"]["faq"].values()) == 3
+    chatbot.process_messages(["What is your return policy?", "refund"])
+    stats = chatbot.get_stats()
+    assert stats["enabled"] and stats["messages"] == 6
+    assert sum(stats["intents"].values()) == 6
+    assert stats["intents"]["goodbye"] == 1 and stats["intents"]["fallback"] == 1
+    assert sum(stats["confidence_histogram"].values()) == 6
+    for stage in ("keywords", "faq_candidates", "faq_score", "intent_candidates",
+                  "intent_score", "total"):
+        assert stats["stages"][stage]["count"] >= 1
+    assert stats["stages"]["total"]["count"] == 4
+
+
+def test_keyword_rules():
+    """Greeting and goodbye keywords match whole words and come from the FAQ data"""
+    chatbot = CustomerSupportChatbot()
+    assert chatbot.process_message("Thanks, I'm done!")["intent"] == "goodbye"
+    assert chatbot.process_message("Hey, what's up?")["intent"] == "greeting"
+    # "done" inside "abandoned" and "hi" inside "shipping" are not keywords
+    assert chatbot.process_message("abandoned cart")["intent"] != "goodbye"
+    assert chatbot.process_message("zzz shipping")["intent"] != "greeting"
+
+    chatbot.faq_data = {"intents": [], "faqs": [], "keywords": {"greeting": ["hola", "buenos dias"]}}
+    assert chatbot.process_message("Buenos   dias!")["intent"] == "greeting"
+    assert chatbot.process_message("hello")["intent"] == "fallback"
+    assert chatbot.process_message("ok bye")["intent"] == "goodbye"  # default goodbye list
+
+
+def test_match_top_k():
+    """Top-k lists are ranked best first and lead with the single best match"""
+    chatbot = CustomerSupportChatbot()
+    top = chatbot.match_top_k("How do I return or cancel my order?", k=3)
+    assert 1 <= len(top["faqs"]) <= 3 and 1 <= len(top["intents"]) <= 3
+    for matches in top.values():
+        scores = [match["score"] for match in matches]
+        assert scores == sorted(scores, reverse=True)
+
+    normalized = normalize_text("track my order")
+    words = chatbot._catalog.encode_words(frozenset(normalized.split()))
+    best_faq, faq_confidence = chatbot._match_faq(normalized, words)
+    best_intent, intent_confidence = chatbot._match_intent(words)
+    top = chatbot.match_top_k("track my order", k=5)
+    assert top["faqs"][0]["question"] == best_faq["question"]
+    assert top["faqs"][0]["confidence"] == faq_confidence
+    assert top["intents"][0]["name"] == best_intent["name"]
+    assert top["intents"][0]["confidence"] == intent_confidence
+    assert len({faq["question"] for faq in top["faqs"]}) == len(top["faqs"])
+
+    assert chatbot.match_top_k("xyz qwerty") == {"faqs": [], "intents": []}
+    assert chatbot.match_top_k("track order", k=0) == {"faqs": [], "intents": []}
+    assert chatbot.get_conversation_history() == []
+
+
+def test_batch_evaluation(tmp_path):
+    """Replaying a log writes one result per message, a summary and a diff; malformed lines are skipped"""
+    messages = tmp_path / "messages.jsonl"
+    messages.write_text("\n".join(json.dumps(record) for record in [
+        {"id": "a", "message": "What is your return policy?"},
+        {"id": "b", "message": "where is my order"},
+        {"id": "c", "message": ""},
+        "thanks, bye",
+    ]) + "\n{\"id\": \"d\", \"message\": \n")
+    first = tmp_path / "first.jsonl"
+    summary = run_evaluation(str(messages), str(first), chunk_size=2)
+    results = [json.loads(line) for line in first.read_text().splitlines()]
+    assert [r["id"] for r in results] == ["a", "b", "c", "4"]
+    assert results[0]["intent"] == "faq" and results[0]["faq_id"] == 0
+    assert results[1]["intent"] == "order_status" and results[1]["faq_id"] is None
+    assert results[2]["intent"] is None and results[3]["intent"] == "goodbye"
+    assert summary["messages"] == 4 and summary["intents"]["faq"] == 1
+    assert summary["skipped_lines"] == 1
+    assert json.loads((tmp_path / "first.jsonl.summary.json").read_text()) == summary
+
+    # Drop the return policy FAQ and compare with the first run, via CSV output
+    with open("faq_data.json", encoding="utf-8") as f:
+        data = json.load(f)
+    data["faqs"] = [faq for faq in data["faqs"] if "return" not in faq["question"].lower()]
+    faq_file = tmp_path / "faq_data.json"
+    faq_file.write_text(json.dumps(data))
+    diff_file = tmp_path / "diff.jsonl"
+    summary = run_evaluation(str(messages), str(tmp_path / "second.csv"), faq_file=str(faq_file),
+                             previous=str(first), diff_path=str(diff_file))
+    assert summary["diff"]["compared"] == 4 and summary["diff"]["unaligned"] == 0
+    changed = [json.loads(line) for line in diff_file.read_text().splitlines()]
+    assert [row["id"] for row in changed] == ["a"]
+    assert changed[0]["faq_id_before"] == 0 and changed[0]["intent_after"] == "fallback"
+
+
+def test_sqlite_history_store(tmp_path):
+    """SQLite history is bounded per user and survives a restart, with user context"""
+    path = str(tmp_path / "history.db")
+    chatbot = CustomerSupportChatbot(history_store=SQLiteHistoryStore(path, max_messages_per_user=3))
+    for i in range(5):
+        chatbot.process_message(f"message {i}", user_id="alice")
+    chatbot.process_message("hello", user_id="bob")
+    chatbot.update_user_context("alice", order_id="A-1")
+    assert [m["user_message"] for m in chatbot.get_conversation_history("alice")] == [
+        "message 2", "message 3", "message 4"]
+    chatbot.clear_history("bob")
+    assert chatbot.get_conversation_history("bob") == []
+    chatbot.close()
+
+    restarted = CustomerSupportChatbot(history_store=SQLiteHistoryStore(path, max_messages_per_user=3))
+    assert len(restarted.conversation_history) == 3
+    assert restarted.get_conversation_history("alice")[-1]["user_message"] == "message 4"
+    assert restarted.user_context == {"alice": {"order_id": "A-1"}}
+    restarted.close()
+
+    # A store missing part of the interface fails when it is built, not when used
+    class PartialStore(HistoryStore):
+        def append(self, user_id, event):
+            pass
+
+    try:
+        PartialStore()
+    except TypeError:
+        pass
+    else:
+        raise AssertionError("incomplete stores are rejected")
+
+
+def test_sqlite_idle_eviction(tmp_path):
+    """SQLite idle eviction follows each user's latest message; reads wait only for their own writes"""
+    path = str(tmp_path / "history.db")
+    store = SQLiteHistoryStore(path, idle_ttl=10, clock=lambda: 0.0)
+    store.append("alice", HistoryEvent("alice", "old", 100.0))
+    store.append("bob", HistoryEvent("bob", "old", 100.0))
+    store.append("bob", HistoryEvent("bob", "new", 195.0))
+    assert [e.user_message for e in store.events("alice")] == ["old"]
+    assert store.evict_idle(now=200.0) == 1
+    assert store.events("alice") == [] and len(store.events("bob")) == 2
+    store.clear("bob")
+    assert store.evict_idle(now=1000.0) == 0
+    store.flush()
+    assert store._writer.pending_users == {}
+    store.close()
+
+    # A database from before the activity table is backfilled on open
+    with sqlite3.connect(path) as conn:
+        conn.execute("INSERT INTO messages (user_id, created, message) VALUES ('carol', 50.0, 'hi')")
+        conn.execute("DROP TABLE user_activity")
+    conn.close()
+    store = SQLiteHistoryStore(path, idle_ttl=10)
+    assert store.evict_idle(now=100.0) == 1
+    store.close()
+
+
+def test_http_server():
+    """The HTTP service answers single and batch requests and sheds load when its queue is full"""
+    chatbot = CustomerSupportChatbot()
+
+    async def scenario():
+        server = ChatServer(chatbot, port=0, workers=2, queue_size=4)
+        await server.start()
+        try:
+            report = await run_load("127.0.0.1", server.port, ["where is my order", "hello"],
+                                    requests=20, concurrency=4)
+            assert report["statuses"] == {200: 20}
+            report = await run_load("127.0.0.1", server.port, ["track my order"], requests=3,
+                                    concurrency=1, batch_size=5)
+            assert report["messages"] == 15
+
+            reader, writer = await asyncio.open_connection("127.0.0.1", server.port)
+            status, body = await _request(reader, writer, "localhost", "/message",
+                                          {"message": "What is your return policy?", "user_id": "svc"})
+            assert status == 200 and body["intent"] == "faq"
+            status, body = await _request(reader, writer, "localhost", "/batch",
+                                          {"messages": ["hello", {"message": "bye", "user_id": "other"}],
+                                           "user_id": "svc", "record_history": False})
+            assert [r["intent"] for r in body["results"]] == ["greeting", "goodbye"]
+            assert (await _request(reader, writer, "localhost", "/nope", {}))[0] == 404
+            assert (await _request(reader, writer, "localhost", "/message", {"text": 1}))[0] == 400
+            for bad in ({"messages": [{"message": None}]}, {"messages": [3]},
+                        {"messages": ["hi"], "record_history": "false"}):
+                assert (await _request(reader, writer, "localhost", "/batch", bad))[0] == 400
+            writer.close()
+            assert len(chatbot.get_conversation_history("svc")) == 1
+
+            # Slow matching fills the queue; the overflow is refused with 503
+            release = threading.Event()
+            chatbot.process_message = lambda *args: release.wait() and {}
+            report_task = asyncio.create_task(run_load("127.0.0.1", server.port, ["hi"],
+                                                       requests=12, concurrency=12))
+            while server.rejected < 6:
+                await asyncio.sleep(0.01)
+            release.set()
+            report = await report_task
+            statuses = report["statuses"]
+            assert statuses[200] >= 1 and statuses[503] >= 6 and statuses[200] + statuses[503] == 12
+        finally:
+            await server.close()
+
+    asyncio.run(scenario())
+
+
+def test_fuzzy_matching():
+    """Misspelled words are corrected to catalog words within a bounded edit distance"""
+    assert bounded_edit_distance("refnd", "refund", 1) == 1
+    assert bounded_edit_distance("retrun", "return", 1) == 1
+    assert bounded_edit_distance("order", "shipping", 2) == 3
+
+    corrector = FuzzyCorrector(["refund", "return", "shipping", "order"])
+    assert corrector.correct("i want a refnd") == "i want a refund"
+    assert corrector.correct("shiping order 12345") == "shipping order 12345"
+    assert corrector.correct("xyzzy ordr ord") == "xyzzy order ord"  # too far off, too short
+    corrector.correct("i want a refnd")
+    assert corrector.cache_stats()["hits"] >= 1
+
+    plain = CustomerSupportChatbot()
+    fuzzy = CustomerSupportChatbot(fuzzy=True)
+    assert plain.process_message("shiping cost")["intent"] == "fallback"
+    assert fuzzy.process_message("shiping cost")["intent"] == "shipping"
+    assert fuzzy.process_message("helo")["intent"] == "greeting"
+    for message in ["Where is my order?", "What is your return policy?", "thanks, bye"]:
+        assert fuzzy.process_message(message)["intent"] == plain.process_message(message)["intent"]
+    assert [r["intent"] for r in fuzzy.process_messages(["shiping cost", "retrun policy"])] == [
+        fuzzy.process_message("shiping cost")["intent"], fuzzy.process_message("retrun policy")["intent"]]
+
+
+def test_compact_records():
+    """Catalog entries and history events are slotted records with dict views"""
+    faq = FAQEntry.from_dict({"question": "Q?", "answer": "A.", "id": "faq-1"})
+    assert not hasattr(faq, "__dict__")
+    assert (faq["question"], faq.get("id"), faq.get("category", "none")) == ("Q?", "faq-1", "none")
+    assert "answer" in faq and "category" not in faq
+    assert faq.to_dict() == {"question": "Q?", "answer": "A.", "id": "faq-1"}
+    intent = IntentEntry.from_dict({"name": "n", "patterns": ["p q"], "response": "r"})
+    assert intent.patterns == ("p q",) and intent.to_dict()["patterns"] == ["p q"]
+
+    event = HistoryEvent("alice", "hi", 0.0)
+    assert not hasattr(event, "__dict__") and isinstance(event.timestamp, float)
+    assert event.to_dict()["timestamp"] == datetime.fromtimestamp(0.0).isoformat()
+
+    chatbot = CustomerSupportChatbot(use_snapshot=False)
+    with open("faq_data.json", encoding="utf-8") as f:
+        assert chatbot.faq_data == json.load(f)
+    result = chatbot.process_message("Where is my order?", "alice")
+    history = chatbot.get_conversation_history("alice")
+    assert set(history[0]) == {"user_id", "user_message", "timestamp"}
+    assert datetime.fromisoformat(history[0]["timestamp"]) <= datetime.fromisoformat(result["timestamp"])
+    assert chatbot.conversation_history == history
+
+
+def test_message_rate_limiting():
+    """Floods are rate limited per user, shed when busy and typing indicators coalesced"""
+    now = [0.0]
+    clock = lambda: now[0]
+    replies, actions = [], []
+
+    async def send_chat_action(chat_id, action):
+        actions.append((chat_id, action))
+
+    def update(user_id, text):
+        async def reply_text(reply):
+            replies.append((user_id, reply))
+        return SimpleNamespace(message=SimpleNamespace(text=text, reply_text=reply_text),
+                               effective_user=SimpleNamespace(id=user_id),
+                               effective_chat=SimpleNamespace(id=user_id))
+
+    context = SimpleNamespace(bot=SimpleNamespace(send_chat_action=send_chat_action))
+    handler = GuardedMessageHandler(
+        CustomerSupportChatbot(),
+        limiter=TokenBucketLimiter(rate=1.0, burst=2, clock=clock),
+        in_flight=InFlightLimiter(8),
+        chat_actions=ChatActionCoalescer(interval=4.0, clock=clock),
+    )
+
+    async def flood():
+        for _ in range(5):
+            await handler(update(1, "Where is my order?"), context)
+        await handler(update(2, "What is your return policy?"), context)
+        now[0] = 1.0  # one token back
+        await handler(update(1, "Where is my order?"), context)
+
+    asyncio.run(flood())
+    user_replies = [reply for user, reply in replies if user == 1]
+    assert len(user_replies) == 4 and user_replies[2] == RATE_LIMITED_REPLY
+    assert RATE_LIMITED_REPLY not in user_replies[3:]
+    assert handler.stats()["rate_limited"] == 3
+    assert actions == [(1, "typing"), (2, "typing")]
+
+    # With every slot taken, new messages get the canned reply without matching
+    release = None
+
+    class SlowChatbot:
+        def process_message_async(self, text, user_id):
+            return release
+
+    handler = GuardedMessageHandler(SlowChatbot(), in_flight=InFlightLimiter(1))
+    replies.clear()
+
+    async def busy():
+        nonlocal release
+        release = asyncio.get_running_loop().create_future()
+        first = asyncio.create_task(handler(update(3, "hello"), context))
+        await asyncio.sleep(0)
+        await handler(update(4, "hello"), context)
+        release.set_result({"response": "done", "intent": "greeting", "confidence": 1.0})
+        await first
+
+    asyncio.run(busy())
+    assert replies == [(4, SHED_REPLY), (3, "done")]
+    assert handler.stats() == {"rate_limited": 0, "shed": 1, "in_flight": 0}
+
+
+def test_engine_registry(tmp_path):
+    """Tenants load lazily, cold ones are evicted, and history survives eviction"""
+    with open("faq_data.json", "r", encoding="utf-8") as f:
+        data = json.load(f)
+    spanish = dict(data, faqs=[{"question": "Donde esta mi pedido?", "answer": "Esta en camino."}])
+    (tmp_path / "default.json").write_text(json.dumps(data), encoding="utf-8")
+    (tmp_path / "es.json").write_text(json.dumps(spanish), encoding="utf-8")
+
+    # A zero budget keeps only the engine in use
+    registry = EngineRegistry(catalog_dir=str(tmp_path), memory_budget_mb=0)
+    assert registry.tenants() == ["default", "es"] and registry.loaded() == []
+    try:
+        registry.assign("u1", "missing")
+    except KeyError:
+        pass
+    else:
+        raise AssertionError("unknown tenants are rejected")
+
+    registry.assign("u1", "es")
+    assert registry.route("u1").process_message("donde esta mi pedido", "u1")["response"] == "Esta en camino."
+    registry.route("u1").update_user_context("u1", order_id="A1")
+    english = registry.route("u2")
+    assert english.process_message("What is your return policy?", "u2")["intent"] == "faq"
+    assert registry.loaded() == ["default"]
+    assert registry.stats()["loads"] == 2 and registry.stats()["evictions"] == 1
+
+    # The reloaded tenant still sees the user's history and context
+    reloaded = registry.route("u1")
+    assert len(reloaded.get_conversation_history("u1")) == 1
+    assert reloaded.user_context["u1"]["order_id"] == "A1"
+
+    # Catalogs share interned words (both use the same intents)
+    words = lambda engine: {word: word for pattern in engine._catalog.pattern_words for word in pattern}
+    shared = words(english).keys() & words(reloaded).keys()
+    assert shared and all(words(english)[w] is words(reloaded)[w] for w in shared)
+
+    # The Telegram handler answers each user from their tenant's engine
+    replies = []
+
+    def update(user_id, text):
+        async def reply_text(reply):
+            replies.append(reply)
+        return SimpleNamespace(message=SimpleNamespace(text=text, reply_text=reply_text),
+                               effective_user=SimpleNamespace(id=user_id),
+                               effective_chat=SimpleNamespace(id=user_id))
+
+    async def send_chat_action(chat_id, action):
+        pass
+
+    handler = GuardedMessageHandler(route=registry.route)
+    asyncio.run(handler(update("u1", "donde esta mi pedido"),
+                        SimpleNamespace(bot=SimpleNamespace(send_chat_action=send_chat_action))))
+    assert replies == ["Esta en camino."]
+
+    # Evicted engines stop their workers, and loads leave no lock behind
+    spanish = registry.route("u1")
+    assert spanish._executor is not None
+    registry.route("u2")
+    assert spanish._executor is None
+    try:
+        registry.get("missing")
+    except KeyError:
+        pass
+    else:
+        raise AssertionError("unknown tenants are rejected")
+    assert registry._load_locks == {}
+    registry.close()
+
+
+def test_engine_registry_shared_context(tmp_path):
+    """Engines loaded at once share user context, and tenant assignments survive a restart"""
+    intents = [{"name": "order_status", "patterns": ["where is my order"],
+                "response": "Order {order_id} is on its way."}]
+    for name in ("default", "es"):
+        (tmp_path / f"{name}.json").write_text(json.dumps({"intents": intents, "faqs": []}), encoding="utf-8")
+    path = str(tmp_path / "history.db")
+    registry = EngineRegistry(catalog_dir=str(tmp_path), history_store=SQLiteHistoryStore(path))
+    english, spanish = registry.get("default"), registry.get("es")
+    assert registry.loaded() == ["default", "es"]
+    english.update_user_context("u1", order_id="A1")
+    assert spanish.process_message("where is my order", "u1")["response"] == "Order A1 is on its way."
+    assert english.user_context is spanish.user_context
+
+    registry.assign("u1", "es")
+    # Assignments are kept apart from the context, which cannot overwrite them
+    english.update_user_context("u1", tenant="default")
+    assert registry.tenant_of("u1") == "es"
+    assert english.user_context["u1"] == {"order_id": "A1", "tenant": "default"}
+    registry.close()
+    restarted = EngineRegistry(catalog_dir=str(tmp_path), history_store=SQLiteHistoryStore(path))
+    assert restarted.tenant_of("u1") == "es" and restarted.tenant_of("u2") == "default"
+    assert restarted.route("u1").user_context["u1"]["order_id"] == "A1"
+    assert restarted.loaded() == ["es"]
+
+    # Routing a cold tenant loads it on a worker thread, not on the event loop
+    loop_threads = []
+    route = restarted.route
+    restarted.route = lambda user_id: loop_threads.append(threading.current_thread()) or route(user_id)
+    handler = GuardedMessageHandler(route=restarted.route)
+    replies = []
+
+    async def reply_text(reply):
+        replies.append(reply)
+
+    async def send_chat_action(chat_id, action):
+        pass
+
+    update = SimpleNamespace(message=SimpleNamespace(text="where is my order", reply_text=reply_text),
+                             effective_user=SimpleNamespace(id="u2"), effective_chat=SimpleNamespace(id=2))
+    asyncio.run(handler(update, SimpleNamespace(bot=SimpleNamespace(send_chat_action=send_chat_action))))
+    assert replies == ["Order {order_id} is on its way."]
+    assert loop_threads and threading.main_thread() not in loop_threads
+    assert restarted.loaded() == ["es", "default"]
+    restarted.close()
+
+
+def test_incremental_catalog_changes(tmp_path):
+    """FAQ and pattern edits apply at once, match like a full rebuild and survive restarts"""
+    faq_file = tmp_path / "faq_data.json"
+    with open("faq_data.json", "r", encoding="utf-8") as f:
+        faq_file.write_text(f.read(), encoding="utf-8")
+    options = dict(use_snapshot=False, persist_changes=True, compact_after=1000)
+    chatbot = CustomerSupportChatbot(str(faq_file), **options)
+    questions = [faq["question"] for faq in chatbot.faq_data["faqs"]]
+
+    new_id = chatbot.add_faq("Do you sell gift cards?", "Yes, in any amount.")
+    assert new_id == len(questions)
+    chatbot.update_faq(0, answer="Changed answer")
+    chatbot.remove_faq(1)
+    chatbot.add_intent_pattern("order_status", "parcel whereabouts")
+    chatbot.add_intent_pattern("loyalty", "reward points", response="You have points.")
+    try:
+        chatbot.remove_intent_pattern("order_status", "no such pattern")
+    except KeyError:
+        pass
+    else:
+        raise AssertionError("unknown patterns are rejected")
+
+    result = chatbot.process_message("Do you sell gift cards?")
+    assert result["response"] == "Yes, in any amount." and result["faq_id"] == len(questions) - 1
+    assert chatbot.process_message(questions[0])["response"] == "Changed answer"
+    assert chatbot.process_message(questions[2])["faq_id"] == 1  # moved up after the removal
+    assert chatbot.process_message("parcel whereabouts")["intent"] == "order_status"
+    assert chatbot.process_message("my reward points")["response"] == "You have points."
+
+    # Same answers as a catalog compiled from scratch, one message or a batch at a time
+    rebuilt = CustomerSupportChatbot(str(tmp_path / "missing.json"), use_snapshot=False)
+    rebuilt.faq_data = chatbot.faq_data
+    messages = questions + ["parcel whereabouts", "reward points", "gift cards", "refund my order"]
+    for mine, theirs in zip(chatbot.process_messages(messages), rebuilt.process_messages(messages)):
+        if theirs["intent"] not in ("greeting", "fallback"):
+            assert (mine["response"], mine["faq_id"]) == (theirs["response"], theirs["faq_id"])
+        assert mine["confidence"] == theirs["confidence"]
+
+    # The change log is replayed on restart, and compaction folds it into the FAQ file
+    assert CustomerSupportChatbot(str(faq_file), **options).faq_data == chatbot.faq_data
+    assert chatbot.compact()
+    with open(faq_file, "r", encoding="utf-8") as f:
+        assert json.load(f) == chatbot.faq_data
+    assert ChangeLog(change_log_path(str(faq_file))).read(chatbot._file_stamp()) == []
+    assert CustomerSupportChatbot(str(faq_file), **options).faq_data == chatbot.faq_data
+
+
+def test_catalog_changes_keep_fast_paths():
+    """Batch and sharded matching keep using the compiled catalog after an edit"""
+    messages = ["Do you sell gift cards?", "What is your return policy?", "parcel whereabouts", "hello"]
+    for shards in (0, 2):
+        chatbot = CustomerSupportChatbot(use_snapshot=False, shards=shards)
+        compiled = chatbot._current_catalog()
+        try:
+            chatbot.process_messages(messages)
+            chatbot.add_faq("Do you sell gift cards?", "Yes, in any amount.")
+            chatbot.update_faq(0, answer="Changed answer")
+            chatbot.add_intent_pattern("order_status", "parcel whereabouts")
+            results = chatbot.process_messages(messages)
+            assert results[0]["response"] == "Yes, in any amount."
+            assert results[2]["intent"] == "order_status"
+            question = chatbot.faq_data["faqs"][0]["question"]
+            assert chatbot.process_message(question)["response"] == "Changed answer"
+            patched = chatbot._current_catalog()
+            assert patched.base is compiled
+            if shards:
+                # The workers of the compiled catalog answer; no pool is started per edit
+                assert "sharded" in compiled.derived and "sharded" not in patched.derived
+            else:
+                assert patched._batch_scorer is not None
+                assert patched._batch_scorer.base is compiled.batch_scorer()
+        finally:
+            if "sharded" in compiled.derived:
+                compiled.derived["sharded"].close()
+
+
+def test_catalog_changes_over_snapshot(tmp_path):
+    """Edits to a snapshot-loaded catalog are layered over the mapped snapshot, not a recompiled catalog"""
+    faq_file = tmp_path / "faq_data.json"
+    with open("faq_data.json", "r", encoding="utf-8") as f:
+        data = json.load(f)
+    data["faqs"][0]["id"] = "returns"
+    faq_file.write_text(json.dumps(data), encoding="utf-8")
+    write_snapshot(str(faq_file))
+    chatbot = CustomerSupportChatbot(str(faq_file))
+    snapshot = chatbot._current_catalog()
+    assert type(snapshot).__name__ == "SnapshotCatalog" and snapshot.faq_ids == {"returns": 0}
+
+    chatbot.update_faq("returns", answer="Changed answer")
+    chatbot.add_faq("Do you sell gift cards?", "Yes, in any amount.")
+    chatbot.add_intent_pattern("order_status", "parcel whereabouts")
+    assert chatbot._current_catalog().base is snapshot
+    assert chatbot.process_message(data["faqs"][0]["question"])["response"] == "Changed answer"
+    results = chatbot.process_messages(["Do you sell gift cards?", "parcel whereabouts"])
+    assert results[0]["response"] == "Yes, in any amount." and results[1]["intent"] == "order_status"
+    assert chatbot.faq_data["faqs"][0]["answer"] == "Changed answer"
+
+
 if __name__ == "__main__":
     test_chatbot()
-